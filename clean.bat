@@ -7,12 +7,26 @@ if exist tasks.json (
     del /f /q tasks.json
 )
 
+REM Delete the SQLite queue database and its WAL files
+for %%f in (tasks.db tasks.db-wal tasks.db-shm) do (
+    if exist %%f (
+        echo Deleting %%f...
+        del /f /q %%f
+    )
+)
+
 REM Check if output folder exists and delete it
 if exist output (
     echo Deleting output folder...
     rmdir /s /q output
 )
 
+REM Check if batches folder exists and delete it
+if exist batches (
+    echo Deleting batches folder...
+    rmdir /s /q batches
+)
+
 echo Cleanup complete!
 echo.
 echo All task files and chapter data have been removed.
@@ -8,12 +8,26 @@ if [ -f "tasks.json" ]; then
     rm -f tasks.json
 fi
 
+# Delete the SQLite queue database and its WAL files
+for f in tasks.db tasks.db-wal tasks.db-shm; do
+    if [ -f "$f" ]; then
+        echo "Deleting $f..."
+        rm -f "$f"
+    fi
+done
+
 # Check if output folder exists and delete it
 if [ -d "output" ]; then
     echo "Deleting output folder..."
     rm -rf output
 fi
 
+# Check if batches folder exists and delete it
+if [ -d "batches" ]; then
+    echo "Deleting batches folder..."
+    rm -rf batches
+fi
+
 echo "Cleanup complete!"
 echo ""
 echo "All task files and chapter data have been removed."
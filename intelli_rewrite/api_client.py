@@ -1,27 +1,135 @@
 import os
-from openai import OpenAI
+import random
+import threading
+import time
+import openai
 from dotenv import load_dotenv
-from typing import Dict, Any, Optional, Tuple, List
+from concurrent.futures import FIRST_COMPLETED, Future, wait
+from typing import Callable, Dict, Any, Optional, Tuple, List
+from .cache import ResponseCache
+from .endpoints import Endpoint, EndpointPool
+from .hedging import HedgePolicy
+from .prompts import SYSTEM_PROMPT, build_messages, prompt_hash, prompt_tokens_saved
+from .rate_limiter import parse_retry_after
+from .streaming import PartialOutput
+from .text_processor import StreamTokenCounter, approximate_tokens
 
 # Load environment variables from .env file
 load_dotenv()
 
+# Sent after the part of an answer that arrived before its stream broke off
+CONTINUE_PROMPT = "Your previous answer was cut off. Continue it from exactly where it stops, without repeating anything."
+
+class APIRequestError(Exception):
+    """A chunk request failed with a non-retryable error or ran out of retries."""
+
+class FatalAPIError(APIRequestError):
+    """The API rejected the client itself (bad key, unknown model), no request can succeed."""
+
+class StreamInterruptedError(Exception):
+    """A streamed response ended before its final event."""
+
+RETRYABLE = "retryable"
+CHUNK_FATAL = "chunk_fatal"
+RUN_FATAL = "run_fatal"
+
+def classify_error(error: Exception) -> str:
+    """
+    Decide how to handle a failed API call.
+    
+    Returns:
+        RETRYABLE for rate limits, timeouts, connection and server errors,
+        RUN_FATAL for errors that every request would hit, and CHUNK_FATAL
+        for errors caused by this request, such as an over-long prompt
+    """
+    if isinstance(error, (openai.RateLimitError, openai.APITimeoutError, openai.APIConnectionError, openai.InternalServerError)):
+        return RETRYABLE
+    if isinstance(error, StreamInterruptedError):
+        return RETRYABLE
+    if isinstance(error, (openai.AuthenticationError, openai.PermissionDeniedError, openai.NotFoundError)):
+        return RUN_FATAL
+    if isinstance(error, openai.APIStatusError):
+        if error.status_code in (408, 409) or error.status_code >= 500:
+            return RETRYABLE
+        return CHUNK_FATAL
+    return CHUNK_FATAL
+
+def _result(content: str, reasoning_content: Optional[str], retries: int, endpoint: str, hedged: bool, **details) -> Dict[str, Any]:
+    return {
+        "reasoning_content": reasoning_content,
+        "content": content,
+        "assistant_message": {"role": "assistant", "content": content},
+        "retries": retries,
+        "endpoint": endpoint,
+        "hedged": hedged,
+        "model": details.get("model"),
+        "usage": details.get("usage"),  # prompt_tokens, completion_tokens and reasoning_tokens as reported by the API
+        "latency": details.get("latency"),
+        "ttft": details.get("ttft"),
+        "throttle_wait": details.get("throttle_wait", 0.0),
+        "elapsed": details.get("elapsed", 0.0),
+        "prompt_hash": details.get("prompt_hash"),  # Hash of the exact messages sent
+        "prompt_tokens_saved": details.get("prompt_tokens_saved", 0)
+    }
+
+def _usage(usage) -> Optional[Dict[str, int]]:
+    """Token counts of a response's usage block, None if the API sent none."""
+    if not usage:
+        return None
+    details = getattr(usage, "completion_tokens_details", None)
+    return {
+        "prompt_tokens": usage.prompt_tokens or 0,
+        "completion_tokens": usage.completion_tokens or 0,
+        "reasoning_tokens": getattr(details, "reasoning_tokens", None) or 0,
+        # Prompt tokens served from the provider's prefix cache, DeepSeek and OpenAI report them differently
+        "cached_tokens": getattr(usage, "prompt_cache_hit_tokens", None)
+            or getattr(getattr(usage, "prompt_tokens_details", None), "cached_tokens", None) or 0
+    }
+
+def _run_in_thread(fn: Callable, *args) -> Future:
+    """Run a blocking call on its own thread, hedged requests must not wait for a pool slot."""
+    future = Future()
+    
+    def run():
+        try:
+            future.set_result(fn(*args))
+        except BaseException as e:
+            future.set_exception(e)
+    
+    threading.Thread(target=run, daemon=True).start()
+    return future
+
 class DeepSeekAPI:
-    def __init__(self):
-        """Initialize the DeepSeek API client."""
-        api_key = os.getenv("API_KEY")
-        base_url = os.getenv("BASE_URL", "https://api.deepseek.com/v1")
-        self.max_tokens = int(os.getenv("MAX_TOKENS", "4096"))
-        
-        if not api_key:
-            raise ValueError("API_KEY environment variable is not set")
+    def __init__(self, cache: Optional[ResponseCache] = None, pool: Optional[EndpointPool] = None, stream: bool = False):
+        """
+        Initialize the DeepSeek API client.
         
-        self.client = OpenAI(api_key=api_key, base_url=base_url)
-        self.model = os.getenv("MODEL_NAME")
-        if not self.model:
-            raise ValueError("MODEL_NAME environment variable is not set")
+        Args:
+            cache: Optional response cache consulted before every API call
+            pool: Endpoints to send requests to, by default read from
+                ENDPOINTS_FILE or the API_KEY, BASE_URL and MODEL_NAME variables
+            stream: Stream responses, so they can be written out as they arrive
+        """
+        self.max_tokens = int(os.getenv("MAX_TOKENS", "4096"))
+        self.pool = pool or EndpointPool.from_env()
+        self.model = self.pool.endpoints[0].model
+        self.cache = cache
+        self.stream = stream
+        self.max_retries = int(os.getenv("MAX_RETRIES", "6"))
+        self.backoff_base = float(os.getenv("BACKOFF_BASE", "1.0"))
+        self.backoff_max = float(os.getenv("BACKOFF_MAX", "60.0"))
+        self.hedging = HedgePolicy.from_env()
     
-    def generate_response(self, prompt: str, memory_context: List[Dict[str, str]] = None, max_tokens: Optional[int] = None) -> Dict[str, Any]:
+    def generate_response(
+        self,
+        prompt: str,
+        memory_context: List[Dict[str, str]] = None,
+        max_tokens: Optional[int] = None,
+        partial: Optional[PartialOutput] = None,
+        on_tokens: Optional[Callable[[int], None]] = None,
+        model: Optional[str] = None,
+        system_prompt: str = SYSTEM_PROMPT
+    ) -> Dict[str, Any]:
         """
         Generate a response from the DeepSeek Reasoner model.
         
@@ -29,54 +137,298 @@ class DeepSeekAPI:
             prompt: The input prompt
             memory_context: Optional list of previous messages for context
             max_tokens: Maximum number of tokens for the response (overrides environment variable)
+            partial: Files to stream the response into; a finished one is returned
+                as is, and an unfinished answer is continued instead of started over
+            on_tokens: Called with the estimated number of tokens received as a response streams in
+            model: Model to ask instead of the endpoints' own, e.g. a cheaper fallback
+            system_prompt: Instructions of the request, the rewriting instructions by default
             
         Returns:
-            Dictionary containing the reasoning_content and content
-        """
-        try:
-            # Initialize messages with the system prompt
-            system_prompt = "Act as a college professor working on an advanced robotics&deep learning textbook. You are good at making complex ideas simple and understandable. Following is a draft of one section, rewrite it into more understsabdable and fluent format. Do not ignore any math formulas, you need to explain the math like a math teacher, inventing formulas, analyze the idea behind them, not just introduce them. Clarify missing steps and concepts for your students. Do not say trivially or hint. Draft: "
-            messages = [
-                {"role": "system", "content": system_prompt}
-            ]
-            
-            # Add memory context if provided
-            if memory_context:
-                messages.extend(memory_context)
+            Dictionary containing the reasoning_content and content, plus the
+            endpoint, token usage, latency and retries of the request
             
-            # Format the prompt with the content
-            formatted_prompt = f"{system_prompt}\n\n{prompt}"
-            messages.append({"role": "user", "content": formatted_prompt})
+        Raises:
+            FatalAPIError: If every endpoint rejects the client itself
+            APIRequestError: If the request fails with a non-retryable error or runs out of retries
+        """
+        max_tokens = max_tokens if max_tokens is not None else self.max_tokens
+        messages = build_messages(prompt, memory_context, system_prompt)
+        # Partial and cached results record the prompt they answer, but no prompt was sent for them, so nothing was saved
+        prompt_details = {"prompt_hash": prompt_hash(messages)}
+        
+        # A complete response from an earlier, interrupted run
+        if partial is not None and partial.finished:
+            content, reasoning_content = partial.load()
+            return _result(content, reasoning_content or None, 0, "partial", False, **prompt_details)
+        
+        # Serve the response from the cache if this exact request was made before
+        if self.cache is not None:
+            models = [model] if model else dict.fromkeys(endpoint.model for endpoint in self.pool.endpoints)
+            for cached_model in models:
+                cached = self.cache.get(self.cache.make_key(cached_model, system_prompt, memory_context, prompt, max_tokens))
+                if cached is not None:
+                    return _result(cached["content"], cached.get("reasoning_content"), 0, "cache", False, model=cached_model, **prompt_details)
+        
+        started = time.monotonic()
+        if self.hedging is not None:
+            content, reasoning_content, endpoint, attempts, details, hedged = self._call_hedged(messages, max_tokens, partial, on_tokens, model)
+        else:
+            content, reasoning_content, endpoint, attempts, details = self._call(messages, max_tokens, partial=partial, on_tokens=on_tokens, model=model)
+            hedged = False
+        if partial is not None:
+            partial.finish(content, reasoning_content or "")
+        
+        # Return the response and the assistant's message for memory context
+        result = _result(
+            content, reasoning_content, attempts, endpoint.name, hedged,
+            model=model or endpoint.model, elapsed=time.monotonic() - started, **details, **prompt_details,
+            prompt_tokens_saved=prompt_tokens_saved(memory_context)
+        )
+        
+        # Only successful responses are cached
+        if self.cache is not None:
+            self.cache.put(self.cache.make_key(model or endpoint.model, system_prompt, memory_context, prompt, max_tokens), result)
+        return result
+    
+    def _call(
+        self,
+        messages: List[Dict[str, str]],
+        max_tokens: int,
+        avoid: Optional[Endpoint] = None,
+        cancelled: Optional[threading.Event] = None,
+        partial: Optional[PartialOutput] = None,
+        on_tokens: Optional[Callable[[int], None]] = None,
+        model: Optional[str] = None
+    ) -> Tuple[str, Optional[str], Endpoint, int, Dict[str, Any]]:
+        """
+        Send one chat completion request, retrying on other endpoints or after a backoff.
+        
+        Args:
+            messages: The chat messages
+            max_tokens: Maximum number of tokens for the response
+            avoid: Endpoint to stay away from if another one is available
+            cancelled: Set when the result is no longer needed, stops further attempts
+            partial: Files a streamed response is written to, see generate_response
+            on_tokens: Called with the estimated number of tokens received while streaming
+            model: Model to ask instead of the endpoint's own
             
-            # Make the API call
-            response = self.client.chat.completions.create(
-                model=self.model,
-                messages=messages,
-                max_tokens=max_tokens if max_tokens is not None else self.max_tokens
-            )
+        Returns:
+            Tuple containing (content, reasoning_content, endpoint that answered, number of retries,
+            usage, latency, ttft and throttle_wait of the request)
+        """
+        attempt = 0
+        throttle_wait = 0.0
+        endpoint = avoid
+        received = ("", "")  # Answer and reasoning kept from a stream that broke off
+        while True:
+            if cancelled is not None and cancelled.is_set():
+                raise APIRequestError("Cancelled, another request finished first")
+            endpoint = self.pool.acquire(avoid=endpoint)
+            if endpoint is None:
+                raise FatalAPIError("Every endpoint rejected the client")
             
-            # Extract content
-            content = response.choices[0].message.content
+            if self.stream and partial is not None:
+                received = partial.load()
+                if not received[0]:
+                    # Nothing of the answer arrived, reasoning alone is not worth continuing
+                    partial.reset()
+                    received = ("", "")
+            request_messages = messages
+            if received[0]:
+                # Ask the model to carry on from the part of the answer that arrived
+                request_messages = messages + [
+                    {"role": "assistant", "content": received[0]},
+                    {"role": "user", "content": CONTINUE_PROMPT}
+                ]
             
-            # Check if reasoning_content exists
-            reasoning_content = None
-            if hasattr(response.choices[0].message, 'reasoning_content'):
-                reasoning_content = response.choices[0].message.reasoning_content
+            # Reserve the prompt plus the whole completion budget, the difference is given back on success
+            estimated_tokens = sum(approximate_tokens(message["content"]) for message in request_messages) + max_tokens
+            waited = time.monotonic()
+            endpoint.rate_limiter.acquire(estimated_tokens)
+            started = time.monotonic()
+            throttle_wait += started - waited
+            first_token_at = None
+            try:
+                if self.stream:
+                    content, reasoning_content, usage, headers, first_token_at = self._stream(
+                        endpoint, request_messages, max_tokens, partial, on_tokens, cancelled, received, model
+                    )
+                else:
+                    # Make the API call, the raw response carries the rate limit headers
+                    raw_response = endpoint.client.chat.completions.with_raw_response.create(
+                        model=model or endpoint.model,
+                        messages=request_messages,
+                        max_tokens=max_tokens
+                    )
+                    response = raw_response.parse()
+                    message = response.choices[0].message
+                    content = message.content
+                    reasoning_content = getattr(message, 'reasoning_content', None)
+                    usage = _usage(getattr(response, "usage", None))
+                    headers = raw_response.headers
+            except Exception as e:
+                kind = classify_error(e)
+                headers = e.response.headers if isinstance(e, openai.APIStatusError) else None
+                retry_after = parse_retry_after(headers)
+                
+                if kind == RUN_FATAL:
+                    # Only this key or model is bad, the other endpoints take over
+                    self.pool.release(endpoint, "disabled", f"{type(e).__name__}: {e}")
+                    if self.pool.all_disabled():
+                        raise FatalAPIError(f"{endpoint.name}: {type(e).__name__}: {e}") from e
+                    continue
+                if isinstance(e, openai.RateLimitError):
+                    # The endpoint's limiter slows down and waits for Retry-After on its own
+                    endpoint.rate_limiter.on_rate_limited(retry_after, headers)
+                    retry_after = None
+                    self.pool.release(endpoint, "neutral")
+                else:
+                    self.pool.release(endpoint, "failure" if kind == RETRYABLE else "neutral")
+                
+                if kind == CHUNK_FATAL or attempt >= self.max_retries:
+                    raise APIRequestError(f"{type(e).__name__} after {attempt + 1} attempt(s): {e}") from e
+                
+                # Exponential backoff with full jitter, never sooner than the server asked,
+                # unless another endpoint can take the retry right away
+                if not self.pool.has_alternative(endpoint):
+                    delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+                    if retry_after is not None:
+                        delay = max(delay, retry_after)
+                    time.sleep(delay)
+                attempt += 1
+                continue
             
-            # Return the response and the assistant's message for memory context
-            return {
-                "reasoning_content": reasoning_content,
-                "content": content,
-                "assistant_message": {"role": "assistant", "content": content}
+            latency = time.monotonic() - started
+            if self.hedging is not None:
+                self.hedging.record_latency(latency)
+            total_tokens = usage["prompt_tokens"] + usage["completion_tokens"] if usage else None
+            endpoint.rate_limiter.on_success(estimated_tokens, total_tokens, headers)
+            self.pool.release(endpoint, "success")
+            return content, reasoning_content, endpoint, attempt, {
+                "usage": usage,
+                "latency": latency,
+                "ttft": first_token_at - started if first_token_at is not None else None,
+                "throttle_wait": throttle_wait
             }
+    
+    def _stream(
+        self,
+        endpoint: Endpoint,
+        messages: List[Dict[str, str]],
+        max_tokens: int,
+        partial: Optional[PartialOutput],
+        on_tokens: Optional[Callable[[int], None]],
+        cancelled: Optional[threading.Event],
+        received: Tuple[str, str],
+        model: Optional[str] = None
+    ) -> Tuple[str, Optional[str], Optional[Dict[str, int]], Any, Optional[float]]:
+        """
+        Stream one response, appending it to the partial files as it arrives.
+        
+        Returns:
+            Tuple containing (content, reasoning_content, usage if reported, response headers,
+            monotonic time of the first token)
+        """
+        raw_response = endpoint.client.chat.completions.with_raw_response.create(
+            model=model or endpoint.model,
+            messages=messages,
+            max_tokens=max_tokens,
+            stream=True,
+            stream_options={"include_usage": True}
+        )
+        stream = raw_response.parse()
+        answer_parts = [received[0]]
+        reasoning_parts = [received[1]]
+        usage = None
+        first_token_at = None
+        finished = False
+        # Events carry any number of tokens, the count is estimated from the text received
+        token_counter = StreamTokenCounter()
+        try:
+            for event in stream:
+                if cancelled is not None and cancelled.is_set():
+                    raise APIRequestError("Cancelled, another request finished first")
+                if getattr(event, "usage", None):
+                    usage = _usage(event.usage)
+                if not event.choices:
+                    continue
+                choice = event.choices[0]
+                answer = choice.delta.content or ""
+                reasoning = getattr(choice.delta, "reasoning_content", None) or ""
+                if answer or reasoning:
+                    if first_token_at is None:
+                        first_token_at = time.monotonic()
+                    answer_parts.append(answer)
+                    reasoning_parts.append(reasoning)
+                    if partial is not None:
+                        partial.append(answer, reasoning)
+                    if on_tokens is not None:
+                        new_tokens = token_counter.add(answer + reasoning)
+                        if new_tokens:
+                            on_tokens(new_tokens)
+                if choice.finish_reason:
+                    finished = True
+        except (APIRequestError, openai.APIError):
+            raise
         except Exception as e:
-            print(f"Error calling DeepSeek API: {str(e)}")
-            # Return a mock response in case of error
-            return {
-                "reasoning_content": f"Error: {str(e)}",
-                "content": "An error occurred while generating the response. Please try again later.",
-                "assistant_message": {"role": "assistant", "content": "An error occurred while generating the response. Please try again later."}
-            }
+            # The connection broke while the stream was read, this is not wrapped by the client
+            raise StreamInterruptedError(f"{type(e).__name__}: {e}") from e
+        finally:
+            # Closing the stream also drops the connection of a cancelled request
+            stream.close()
+        if not finished:
+            raise StreamInterruptedError("The stream ended before the response was complete")
+        reasoning_content = "".join(reasoning_parts)
+        return "".join(answer_parts), reasoning_content or None, usage, raw_response.headers, first_token_at
+    
+    def _call_hedged(
+        self,
+        messages: List[Dict[str, str]],
+        max_tokens: int,
+        partial: Optional[PartialOutput],
+        on_tokens: Optional[Callable[[int], None]],
+        model: Optional[str] = None
+    ) -> Tuple[str, Optional[str], Endpoint, int, Dict[str, Any], bool]:
+        """
+        Send a request and, if it runs past the hedging delay, a duplicate; the first success wins.
+        
+        A streamed loser is closed as soon as the winner finishes. Without
+        streaming the synchronous client cannot abort a request in flight, so
+        the slower request is left to finish in the background and its answer
+        is dropped. Only the first request writes to the partial files.
+        
+        Returns:
+            Tuple containing (content, reasoning_content, endpoint, number of retries,
+            request details as returned by _call, whether the hedge won)
+        """
+        self.hedging.record_request()
+        cancelled = threading.Event()
+        primary = _run_in_thread(self._call, messages, max_tokens, None, cancelled, partial, on_tokens, model)
+        
+        delay = self.hedging.delay()
+        done, _ = wait([primary], timeout=delay)
+        if done or not self.hedging.try_hedge():
+            return (*primary.result(), False)
+        
+        hedge = _run_in_thread(self._call, messages, max_tokens, None, cancelled, None, None, model)
+        pending = {primary, hedge}
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    content, reasoning_content, endpoint, attempts, details = future.result()
+                except FatalAPIError:
+                    cancelled.set()
+                    raise
+                except APIRequestError as e:
+                    error = error or e
+                    continue
+                cancelled.set()
+                if future is hedge:
+                    self.hedging.record_hedge_win()
+                return content, reasoning_content, endpoint, attempts, details, future is hedge
+        raise error
             
     def parse_response(self, response: Dict[str, Any]) -> Tuple[str, Optional[str]]:
         """
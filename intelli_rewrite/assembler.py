@@ -0,0 +1,74 @@
+import os
+from typing import Dict, Iterable
+from .models import QAPair
+
+# Written after every chunk of the output file
+SEPARATOR = "\n\n"
+
+def chunk_text(qa: QAPair) -> str:
+    """Get the text a chunk contributes to the output file, failed chunks leave a marker that repair replaces."""
+    if qa.error:
+        reason = " ".join(qa.error.split()).replace("--", "- -")
+        return f"<!-- Chunk {qa.chunk_index + 1} failed: {reason} -->"
+    return qa.answer
+
+class OutputAssembler:
+    """
+    Build a task's output file from its chunk results, in chunk order.
+
+    Results are kept by chunk index, so they can arrive in any order. The
+    output file only ever holds the contiguous run of finished chunks from
+    chunk 0: a result that extends the run is appended together with the
+    finished chunks after it, any other result waits until the gap before it
+    is filled.
+
+    write() replaces the whole file through a temporary file and an atomic
+    rename. It is called when a task starts, so an append that a crash lost
+    or repeated is repaired from the journal, and when the task completes.
+    """
+
+    def __init__(self, output_path: str, qa_pairs: Iterable[QAPair] = ()):
+        self.output_path = output_path
+        self.results: Dict[int, QAPair] = {qa.chunk_index: qa for qa in qa_pairs}
+        self.assembled = 0  # Chunks 0 to assembled - 1 are in the output file
+
+    def __contains__(self, chunk_index: int) -> bool:
+        return chunk_index in self.results
+
+    def add(self, qa: QAPair):
+        """Record the result of a chunk and append the chunks it makes contiguous to the output file."""
+        self.results[qa.chunk_index] = qa
+        if qa.chunk_index < self.assembled:
+            # The file already covers the chunk's position, e.g. a replaced result, only a full write puts it in place
+            self.write(complete=True)
+            return
+        if qa.chunk_index != self.assembled:
+            return
+        end = self.assembled
+        while end in self.results:
+            end += 1
+        with open(self.output_path, 'a', encoding='utf-8') as f:
+            for chunk_index in range(self.assembled, end):
+                f.write(chunk_text(self.results[chunk_index]))
+                f.write(SEPARATOR)
+        self.assembled = end
+
+    def write(self, complete: bool = False):
+        """
+        Write the output file from the results, replacing it atomically.
+
+        Args:
+            complete: Write every result in chunk order, including those after a
+                gap, instead of the contiguous run from chunk 0
+        """
+        tmp_path = f"{self.output_path}.tmp"
+        end = 0
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for chunk_index in sorted(self.results):
+                if chunk_index != end and not complete:
+                    break
+                f.write(chunk_text(self.results[chunk_index]))
+                f.write(SEPARATOR)
+                end = chunk_index + 1
+        os.replace(tmp_path, self.output_path)
+        self.assembled = end
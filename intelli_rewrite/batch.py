@@ -0,0 +1,118 @@
+import json
+import os
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+from .endpoints import Endpoint
+from .models import BatchJob, BatchStatus
+from .storage import DateTimeEncoder
+
+# Provider batch states that will not change any more
+FINAL_STATES = ("completed", "failed", "expired", "cancelled")
+
+class BatchStore:
+    """Batch jobs, their request files and their results, kept in BATCH_DIR (default batches/)."""
+
+    def __init__(self, base_dir: Optional[str] = None):
+        self.base_dir = Path(base_dir or os.getenv("BATCH_DIR", "batches"))
+        self.base_dir.mkdir(exist_ok=True)
+
+    def requests_path(self, job_id: str) -> str:
+        return str(self.base_dir / f"{job_id}.requests.jsonl")
+
+    def results_path(self, job_id: str) -> str:
+        return str(self.base_dir / f"{job_id}.results.jsonl")
+
+    def save(self, job: BatchJob):
+        path = self.base_dir / f"{job.id}.json"
+        tmp_path = path.with_suffix(".json.tmp")
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(job.model_dump(), f, indent=2, cls=DateTimeEncoder)
+        os.replace(tmp_path, path)
+
+    def list_jobs(self, status: Optional[BatchStatus] = None) -> List[BatchJob]:
+        """List jobs in submission order, optionally filtered by status."""
+        jobs = []
+        for path in self.base_dir.glob("*.json"):
+            with open(path, 'r', encoding='utf-8') as f:
+                job = BatchJob(**json.load(f))
+            if status is None or job.status == status:
+                jobs.append(job)
+        return sorted(jobs, key=lambda job: job.created_at)
+
+    def find_jobs_by_prefix(self, job_id_prefix: str) -> List[BatchJob]:
+        return [job for job in self.list_jobs() if job.id.startswith(job_id_prefix)]
+
+def make_request_line(custom_id: str, model: str, messages: List[Dict[str, str]], max_tokens: int) -> str:
+    """Format one chat completion request of a batch input file."""
+    return json.dumps({
+        "custom_id": custom_id,
+        "method": "POST",
+        "url": "/v1/chat/completions",
+        "body": {"model": model, "messages": messages, "max_tokens": max_tokens}
+    }, ensure_ascii=False)
+
+def chunk_custom_id(task_id: str, chunk_index: int) -> str:
+    return f"{task_id}/{chunk_index}"
+
+def parse_custom_id(custom_id: str) -> Tuple[str, int]:
+    task_id, _, chunk_index = custom_id.rpartition("/")
+    return task_id, int(chunk_index)
+
+def iter_results(results_file: str) -> Iterator[Tuple[str, Optional[dict], Optional[dict], Optional[str]]]:
+    """
+    Read a batch output or error file.
+
+    Yields:
+        Tuples of (custom_id, message, usage, error); message and usage are the
+        assistant message and token usage of a successful request, error
+        describes a failed one
+    """
+    with open(results_file, 'r', encoding='utf-8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            response = record.get("response") or {}
+            body = response.get("body") or {}
+            if record.get("error") or response.get("status_code") != 200 or not body.get("choices"):
+                error = record.get("error") or body.get("error") or f"status {response.get('status_code')}"
+                yield record["custom_id"], None, None, json.dumps(error) if not isinstance(error, str) else error
+                continue
+            yield record["custom_id"], body["choices"][0]["message"], body.get("usage"), None
+
+def iter_requests(requests_file: str) -> Iterator[Tuple[str, List[Dict[str, str]]]]:
+    """Read a batch input file, yields tuples of (custom_id, messages)."""
+    with open(requests_file, 'r', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                request = json.loads(line)
+                yield request["custom_id"], request["body"]["messages"]
+
+class BatchClient:
+    """Thin wrapper around the OpenAI-compatible files and batches API of one endpoint."""
+
+    def __init__(self, endpoint: Endpoint):
+        self.endpoint = endpoint
+        self.client = endpoint.client
+
+    def submit(self, requests_file: str) -> str:
+        """Upload a request file and start a batch, returns the provider's batch ID."""
+        with open(requests_file, 'rb') as f:
+            uploaded = self.client.files.create(file=f, purpose="batch")
+        batch = self.client.batches.create(
+            input_file_id=uploaded.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h"
+        )
+        return batch.id
+
+    def retrieve(self, remote_id: str):
+        return self.client.batches.retrieve(remote_id)
+
+    def download(self, file_id: str, path: str, append: bool = False):
+        """Save an output or error file of a batch."""
+        content = self.client.files.content(file_id).content
+        with open(path, 'ab' if append else 'wb') as f:
+            f.write(content)
+            if content and not content.endswith(b"\n"):
+                f.write(b"\n")
@@ -0,0 +1,215 @@
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+from .file_manager import FileManager
+from .journal import TaskJournal
+from .metrics import percentile
+from .mock_server import MockConfig, create_server
+
+def make_document(path: str, chunks: int, chunk_size: int = 800):
+    """Write a synthetic markdown document that splits into `chunks` chunks of about chunk_size characters."""
+    sentence = "The eigenvalues of a symmetric matrix are real and its eigenvectors can be chosen orthonormal. "
+    paragraph_length = int(chunk_size * 0.9)
+    body = (sentence * (paragraph_length // len(sentence) + 1))[:paragraph_length - 20].rstrip()
+    with open(path, 'w', encoding='utf-8') as f:
+        for index in range(chunks):
+            # One heading line and one paragraph per chunk, together just under the budget
+            f.write(f"## Section {index}\n{body}\n\n")
+
+def _run(args: List[str], env: Dict[str, str], cwd: str) -> Dict[str, float]:
+    """Run a CLI command and measure its wall time and, where the OS reports it, its peak RSS."""
+    started = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "intelli_rewrite.cli", *args],
+        env=env,
+        cwd=cwd,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE
+    )
+    # Drain stderr on a thread so a chatty failure cannot block the child
+    stderr = []
+    reader = threading.Thread(target=lambda: stderr.append(process.stderr.read()), daemon=True)
+    reader.start()
+    peak_rss = None
+    if hasattr(os, "wait4"):
+        _, status, usage = os.wait4(process.pid, 0)
+        returncode = os.waitstatus_to_exitcode(status)
+        process.returncode = returncode
+        # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+        peak_rss = usage.ru_maxrss if sys.platform == "darwin" else usage.ru_maxrss * 1024
+    else:
+        returncode = process.wait()
+    reader.join()
+    if returncode != 0:
+        raise RuntimeError(f"{args[0]} failed with exit code {returncode}: {stderr[0].decode('utf-8', 'replace')[-2000:]}")
+    return {"seconds": time.perf_counter() - started, "peak_rss": peak_rss}
+
+def _directory_size(path: Path, exclude: Path) -> int:
+    # Hardlinked blobs are counted once, they take the space once
+    sizes = {}
+    for f in path.rglob("*"):
+        if f.is_file() and f != exclude:
+            stat = f.stat()
+            sizes[(stat.st_dev, stat.st_ino)] = stat.st_size
+    return sum(sizes.values())
+
+def run_benchmark(
+    sizes: List[int],
+    concurrency: int = 8,
+    chunk_size: int = 800,
+    stream: bool = False,
+    config: Optional[MockConfig] = None,
+    keep: bool = False
+) -> List[Dict[str, float]]:
+    """
+    Run add-task and process-tasks on synthetic documents against the mock server.
+
+    Each size runs in a fresh working directory with its own queue, output
+    directory and cache, in separate processes so that start-up cost and
+    peak memory are measured the way a user sees them.
+
+    Args:
+        sizes: Document sizes in chunks
+        concurrency: --concurrency of process-tasks
+        chunk_size: --chunk-size of add-task
+        stream: Run process-tasks with --stream
+        config: Latency and error behaviour of the mock server
+        keep: Leave the working directories in place for inspection
+
+    Returns:
+        One dictionary of measurements per size
+    """
+    results = []
+    package_root = str(Path(__file__).resolve().parent.parent)
+    for size in sizes:
+        server = create_server(port=0, config=config or MockConfig())
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        workdir = Path(tempfile.mkdtemp(prefix="intelli_rewrite_bench_"))
+        try:
+            document = workdir / f"bench_{size}.md"
+            make_document(str(document), size, chunk_size)
+            env = {
+                **os.environ,
+                "PYTHONPATH": os.pathsep.join(filter(None, [package_root, os.getenv("PYTHONPATH")])),
+                "API_KEY": "mock",
+                "BASE_URL": f"http://127.0.0.1:{server.server_address[1]}/v1",
+                "MODEL_NAME": "mock",
+                "OUTPUT_DIR": str(workdir / "output"),
+                "QUEUE_FILE": str(workdir / ("tasks.json" if os.getenv("QUEUE_BACKEND") == "json" else "tasks.db")),
+                "CACHE_FILE": str(workdir / "response_cache.db"),
+                "ENDPOINTS_FILE": str(workdir / "endpoints.json"),  # Never picks up the user's endpoints
+                "BACKOFF_BASE": os.getenv("BACKOFF_BASE", "0.1")
+            }
+
+            add = _run(["add-task", str(document), "--chunk-size", str(chunk_size)], env, str(workdir))
+            chunks_file = next((workdir / "output").glob("*/chunks.json"))
+            with open(chunks_file, 'r', encoding='utf-8') as f:
+                total_chunks = len(json.load(f))
+
+            process_args = ["process-tasks", "--concurrency", str(concurrency), "--no-cache"]
+            if stream:
+                process_args.append("--stream")
+            process = _run(process_args, env, str(workdir))
+
+            # Request latencies as the client saw them, from the chunk metrics
+            journal = TaskJournal(FileManager(str(workdir / "output")), chunks_file.parent.name)
+            chunk_metrics = [qa.metrics.model_dump() for qa in journal.load_qa_pairs() if qa.metrics]
+            latencies = [m["latency"] for m in chunk_metrics if m.get("latency") is not None]
+            ttfts = [m["ttft"] for m in chunk_metrics if m.get("ttft") is not None]
+            state = server.state
+            results.append({
+                "chunks": total_chunks,
+                "add_seconds": add["seconds"],
+                "process_seconds": process["seconds"],
+                "chunks_per_second": total_chunks / process["seconds"],
+                "p50": percentile(latencies, 50),
+                "p95": percentile(latencies, 95),
+                "p99": percentile(latencies, 99),
+                "ttft_p50": percentile(ttfts, 50),
+                "retries": sum(m.get("retries", 0) for m in chunk_metrics),
+                "requests": state.requests,
+                "errors": state.errors,
+                "rate_limited": state.rate_limited,
+                "bytes_written": _directory_size(workdir, document),
+                "peak_rss": process["peak_rss"],
+                "workdir": str(workdir) if keep else None
+            })
+        finally:
+            server.shutdown()
+            server.server_close()
+            if not keep:
+                shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+def _fill_queue(queue_file: str, count: int) -> List[str]:
+    """Put `count` tasks with made-up files into a new SQLite queue, returns their IDs."""
+    import uuid
+    from datetime import datetime, timedelta
+    from .models import RewriteTask, TaskStatus
+    from .storage import SqliteTaskStore
+
+    store = SqliteTaskStore(queue_file, legacy_json_file=None)
+    started = datetime.now() - timedelta(days=1)
+    task_ids = []
+    for index in range(count):
+        task_dir = str(uuid.uuid4())
+        task = RewriteTask(
+            id=str(uuid.uuid4()),
+            task_id=task_dir,
+            input_file=f"output/{task_dir}/chapter_{index}.md",
+            output_file=f"output/{task_dir}/rewritten_chapter_{index}.md",
+            status=TaskStatus.COMPLETED if index % 4 else TaskStatus.PENDING,
+            created_at=started + timedelta(seconds=index),
+            total_chunks=60,
+            processed_chunks=60 if index % 4 else 0
+        )
+        store.save_task(task)
+        task_ids.append(task.id)
+    store.conn.close()
+    return task_ids
+
+def run_startup_benchmark(tasks: int = 5000, runs: int = 5) -> List[Dict[str, float]]:
+    """
+    Time CLI start-up against a queue of `tasks` tasks.
+
+    Every command runs `runs` times in a fresh process, like a user typing it,
+    next to a bare interpreter start for reference.
+
+    Returns:
+        One dictionary per command with its median and fastest wall time in seconds
+    """
+    workdir = Path(tempfile.mkdtemp(prefix="intelli_rewrite_startup_"))
+    try:
+        queue_file = str(workdir / "tasks.db")
+        task_ids = _fill_queue(queue_file, tasks)
+        env = {
+            **os.environ,
+            "PYTHONPATH": os.pathsep.join(filter(None, [str(Path(__file__).resolve().parent.parent), os.getenv("PYTHONPATH")])),
+            "QUEUE_BACKEND": "sqlite",
+            "QUEUE_FILE": queue_file,
+            "OUTPUT_DIR": str(workdir / "output")
+        }
+        commands = [
+            ("python -c pass", [sys.executable, "-c", "pass"]),
+            ("--help", [sys.executable, "-m", "intelli_rewrite.cli", "--help"]),
+            ("list-tasks", [sys.executable, "-m", "intelli_rewrite.cli", "list-tasks"]),
+            ("show-task", [sys.executable, "-m", "intelli_rewrite.cli", "show-task", task_ids[-1]])
+        ]
+        results = []
+        for name, args in commands:
+            timings = []
+            for _ in range(runs):
+                started = time.perf_counter()
+                subprocess.run(args, env=env, cwd=str(workdir), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+                timings.append(time.perf_counter() - started)
+            results.append({"command": name, "median": percentile(timings, 50), "min": min(timings)})
+        return results
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
@@ -0,0 +1,195 @@
+import gzip
+import hashlib
+import os
+import shutil
+import time
+import uuid
+from pathlib import Path
+from typing import Iterator, Optional, Set, Tuple
+
+# Compression of blobs and compacted Q&A files, the suffix records the codec so
+# files written with one setting stay readable with another
+CODECS = {"zstd": ".zst", "gzip": ".gz"}
+
+def default_codec() -> str:
+    """Get the codec set by BLOB_COMPRESSION, by default zstd if the zstandard package is installed and gzip otherwise."""
+    codec = os.getenv("BLOB_COMPRESSION")
+    if codec:
+        if codec not in CODECS:
+            raise ValueError(f"Unknown BLOB_COMPRESSION '{codec}', use one of: {', '.join(CODECS)}")
+        return codec
+    try:
+        import zstandard  # noqa: F401
+        return "zstd"
+    except ImportError:
+        return "gzip"
+
+def compress(data: bytes, codec: str) -> bytes:
+    if codec == "zstd":
+        import zstandard
+        return zstandard.ZstdCompressor(level=3).compress(data)
+    return gzip.compress(data, compresslevel=6)
+
+def decompress(data: bytes, suffix: str) -> bytes:
+    """Decompress the content of a file by its suffix, files without a codec suffix are returned as they are."""
+    if suffix == CODECS["zstd"]:
+        try:
+            import zstandard
+        except ImportError:
+            raise RuntimeError("Reading zstd-compressed files needs the zstandard package (pip install zstandard)")
+        return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    if suffix == CODECS["gzip"]:
+        return gzip.decompress(data)
+    return data
+
+def file_digest(path: str) -> str:
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+class BlobStore:
+    """
+    Content-addressed files, named by the SHA-256 of their content.
+
+    Raw blobs hold input files and chunks.json. They are hardlinked into the
+    task directories, so tasks with the same input or the same chunks share
+    one copy on disk; where hardlinks are not possible the file is copied.
+    Linked files are only ever replaced, never written in place, since every
+    link is the same file. Compressed blobs hold reasoning, which is only
+    read when it is shown.
+
+    A raw blob is in use while a task directory links to it, a compressed
+    blob while a Q&A pair refers to it; gc removes the others.
+    """
+
+    def __init__(self, root: str, codec: Optional[str] = None):
+        self.root = Path(root)
+        self.codec = codec or default_codec()
+
+    def _path(self, digest: str, suffix: str = "") -> Path:
+        return self.root / digest[:2] / f"{digest}{suffix}"
+
+    def _find(self, digest: str) -> Optional[Path]:
+        for suffix in ("",) + tuple(CODECS.values()):
+            path = self._path(digest, suffix)
+            if path.exists():
+                return path
+        return None
+
+    def _install(self, tmp_path: Path, path: Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(tmp_path, path)
+
+    def put(self, data: bytes, compressed: bool = False) -> str:
+        """
+        Store content once.
+
+        Returns:
+            The SHA-256 of the content, which get() takes
+        """
+        digest = hashlib.sha256(data).hexdigest()
+        path = self._path(digest, CODECS[self.codec] if compressed else "")
+        if not path.exists():
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = path.with_name(f"{path.name}.{uuid.uuid4().hex}.tmp")
+            tmp_path.write_bytes(compress(data, self.codec) if compressed else data)
+            self._install(tmp_path, path)
+        elif compressed:
+            # Written again, gc keeps it as long as a new blob. Raw blobs are not
+            # touched, their mtime is the mtime of every file linked to them
+            os.utime(path)
+        return digest
+
+    def get(self, digest: str) -> bytes:
+        path = self._find(digest)
+        if path is None:
+            raise FileNotFoundError(f"Blob {digest} is missing, it may have been removed by gc")
+        return decompress(path.read_bytes(), "".join(path.suffixes[-1:]))
+
+    def get_text(self, digest: str) -> str:
+        return self.get(digest).decode('utf-8')
+
+    def store_file(self, source: str, target: str, move: bool = False) -> str:
+        """
+        Put a file into the store as a raw blob and link it to target, replacing target atomically.
+
+        Args:
+            source: File to store, left in place unless move is set
+            target: Path the blob is linked to, e.g. in a task directory
+            move: Move source into the store instead of copying it, for temporary files
+
+        Returns:
+            The SHA-256 of the file
+        """
+        digest = file_digest(source)
+        path = self._path(digest)
+        # An existing blob is linked as it is. It is not touched: its mtime is the
+        # mtime of every file linked to it, and the new link keeps it from gc
+        try:
+            self.link(digest, target)
+        except FileNotFoundError:
+            # Not stored yet, or removed by gc after its last link was dropped
+            path.parent.mkdir(parents=True, exist_ok=True)
+            if move:
+                self._install(Path(source), path)
+            else:
+                tmp_path = path.with_name(f"{path.name}.{uuid.uuid4().hex}.tmp")
+                shutil.copyfile(source, tmp_path)
+                self._install(tmp_path, path)
+            self.link(digest, target)
+        else:
+            if move:
+                os.unlink(source)
+        return digest
+
+    def link(self, digest: str, target: str):
+        """Make target the raw blob, through a hardlink where the file system allows it."""
+        target_path = Path(target)
+        tmp_path = target_path.with_name(f".{target_path.name}.{uuid.uuid4().hex}.tmp")
+        try:
+            os.link(self._path(digest), tmp_path)
+        except OSError:
+            shutil.copyfile(self._path(digest), tmp_path)
+        os.replace(tmp_path, target_path)
+
+    def iter_blobs(self) -> Iterator[Path]:
+        if not self.root.exists():
+            return
+        for path in self.root.glob("*/*"):
+            if path.is_file():
+                yield path
+
+    def gc(self, referenced: Set[str], min_age: float = 3600.0, dry_run: bool = False) -> Tuple[int, int]:
+        """
+        Remove the blobs nothing refers to.
+
+        Args:
+            referenced: Digests of the compressed blobs Q&A pairs refer to, raw
+                blobs count as in use while they have another link
+            min_age: Seconds a blob is kept after it was written, so blobs of
+                tasks being added are not removed before they are linked
+            dry_run: Only count what would be removed
+
+        Returns:
+            Tuple of the number of blobs removed and their size in bytes
+        """
+        now = time.time()
+        removed = 0
+        size = 0
+        for path in self.iter_blobs():
+            stat = path.stat()
+            if now - stat.st_mtime < min_age:
+                continue
+            # Temporary files are left over from interrupted writes
+            if not path.name.endswith(".tmp"):
+                digest = path.name.split(".")[0]
+                in_use = stat.st_nlink > 1 if not path.suffix else digest in referenced
+                if in_use:
+                    continue
+            removed += 1
+            size += stat.st_size
+            if not dry_run:
+                path.unlink()
+        return removed, size
@@ -0,0 +1,114 @@
+import os
+import threading
+from dataclasses import dataclass
+from typing import Optional, Tuple
+from .metrics import Pricing
+from .models import ChunkMetrics
+
+# What to do once the projected spend of a run exceeds its budget
+BUDGET_ACTIONS = ("slow", "pause", "fallback")
+
+# Answered chunks needed before the rest of a run or task is projected
+MIN_SAMPLES = 3
+
+class BudgetExceededError(Exception):
+    """A task spent its budget, it is paused until the budget is raised."""
+
+@dataclass
+class Budget:
+    """Limit on the tokens (prompt and completion) and the estimated cost of a run or task."""
+    tokens: Optional[int] = None
+    cost: Optional[float] = None
+
+    def __bool__(self) -> bool:
+        return self.tokens is not None or self.cost is not None
+
+    def exceeded(self, tokens: float, cost: float) -> Optional[str]:
+        """Describe which limit the given spend reaches, None if it stays within both."""
+        if self.tokens is not None and tokens >= self.tokens:
+            return f"{tokens:,.0f} of {self.tokens:,} tokens"
+        if self.cost is not None and cost >= self.cost:
+            return f"${cost:.2f} of ${self.cost:.2f}"
+        return None
+
+@dataclass
+class Spend:
+    """Tokens and estimated cost of the chunks answered by the API."""
+    tokens: int = 0
+    cost: float = 0.0
+    chunks: int = 0
+
+    def add(self, metrics: ChunkMetrics, pricing: Pricing):
+        # Cached and resumed answers cost nothing
+        if metrics.source not in ("api", "batch"):
+            return
+        self.tokens += metrics.prompt_tokens + metrics.completion_tokens
+        self.cost += pricing.cost(metrics)
+        self.chunks += 1
+
+    def projected(self, remaining_chunks: int) -> Optional[Tuple[float, float]]:
+        """Tokens and cost once the remaining chunks are answered at the average so far, None until enough chunks were answered."""
+        if self.chunks < MIN_SAMPLES:
+            return None
+        return (
+            self.tokens + self.tokens / self.chunks * remaining_chunks,
+            self.cost + self.cost / self.chunks * remaining_chunks
+        )
+
+class BudgetGovernor:
+    """
+    Shape a processing run by its token and cost budget.
+
+    Spend is counted from the usage of every answered chunk. Once a few
+    chunks were answered, the spend of the tasks claimed so far is projected
+    from the average per chunk; when the projection exceeds the budget the
+    run slows down to one request at a time, pauses, or switches to the
+    fallback model, depending on the action. A run whose spend reaches the
+    budget always stops.
+    """
+
+    def __init__(self, budget: Budget, action: str = "slow", fallback_model: Optional[str] = None, pricing: Optional[Pricing] = None):
+        if action not in BUDGET_ACTIONS:
+            raise ValueError(f"Unknown budget action: {action}")
+        if action == "fallback" and not fallback_model:
+            raise ValueError("The fallback action needs a fallback model")
+        self.budget = budget
+        self.action = action
+        self.fallback_model = fallback_model
+        self.pricing = pricing or Pricing.from_env()
+        # The fallback model has its own prices, by default the same as the main model
+        self.fallback_pricing = Pricing(
+            float(os.getenv("FALLBACK_INPUT_PRICE", self.pricing.input_per_million)),
+            float(os.getenv("FALLBACK_OUTPUT_PRICE", self.pricing.output_per_million))
+        )
+        self.spend = Spend()
+        self.remaining_chunks = 0
+        self.over = False  # Set once the projection exceeded the budget and the action was taken
+        self._lock = threading.Lock()
+
+    def pricing_for(self, model: Optional[str]) -> Pricing:
+        return self.fallback_pricing if model is not None and model == self.fallback_model else self.pricing
+
+    def add_chunks(self, count: int):
+        """Count the chunks of a newly claimed task towards the projection."""
+        with self._lock:
+            self.remaining_chunks += count
+
+    def record(self, metrics: Optional[ChunkMetrics]):
+        """Count a committed chunk."""
+        with self._lock:
+            self.remaining_chunks = max(0, self.remaining_chunks - 1)
+            if metrics is not None:
+                self.spend.add(metrics, self.pricing_for(metrics.model))
+
+    def exhausted(self) -> Optional[str]:
+        """Describe the spend if it reached the budget."""
+        return self.budget.exceeded(self.spend.tokens, self.spend.cost)
+
+    def over_projection(self) -> Optional[str]:
+        """Describe the projected spend if it exceeds the budget."""
+        with self._lock:
+            projected = self.spend.projected(self.remaining_chunks)
+        if projected is None:
+            return None
+        return self.budget.exceeded(*projected)
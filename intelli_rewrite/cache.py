@@ -0,0 +1,119 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+class ResponseCache:
+    """
+    Persistent, content-addressed cache of API responses shared by all tasks.
+
+    Entries are keyed by a hash of everything that determines a response
+    (model, system prompt, memory context, chunk content and max_tokens),
+    so re-adding the same or a lightly edited document only pays for the
+    chunks that changed. The cache is bounded in bytes and evicts the least
+    recently used entries first.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS responses (
+            key TEXT PRIMARY KEY,
+            response TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            last_used REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_responses_last_used ON responses (last_used);
+        CREATE TABLE IF NOT EXISTS counters (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        );
+    """
+
+    def __init__(self, cache_file: Optional[str] = None, max_bytes: Optional[int] = None):
+        """
+        Open or create the cache database.
+
+        Args:
+            cache_file: Path of the cache database (env CACHE_FILE, default response_cache.db)
+            max_bytes: Size limit of the stored responses (env CACHE_MAX_MB, default 512 MB)
+        """
+        self.cache_file = Path(cache_file or os.getenv("CACHE_FILE", "response_cache.db"))
+        self.max_bytes = max_bytes if max_bytes is not None else int(os.getenv("CACHE_MAX_MB", "512")) * 1024 * 1024
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(str(self.cache_file), timeout=30, isolation_level=None, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(self.SCHEMA)
+
+    @staticmethod
+    def make_key(model: str, system_prompt: str, memory_context: Optional[List[Dict[str, str]]], prompt: str, max_tokens: int) -> str:
+        """Hash the inputs of a request into a cache key."""
+        payload = json.dumps(
+            [model, system_prompt, memory_context or [], prompt, max_tokens],
+            ensure_ascii=False,
+            separators=(",", ":")
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """Look up a response and mark it as recently used."""
+        with self._lock:
+            row = self.conn.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                self._bump("misses")
+                return None
+            self.hits += 1
+            self._bump("hits")
+            self.conn.execute("UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key))
+        return json.loads(row[0])
+
+    def put(self, key: str, response: Dict[str, Any]):
+        """Store a response and evict old entries if the cache is over its size limit."""
+        data = json.dumps(response, ensure_ascii=False)
+        size = len(data.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO responses (key, response, size, last_used) VALUES (?, ?, ?, ?)",
+                (key, data, size, time.time())
+            )
+            self._evict()
+
+    def _evict(self):
+        total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        evicted = 0
+        for key, size in self.conn.execute("SELECT key, size FROM responses ORDER BY last_used").fetchall():
+            if total <= self.max_bytes:
+                break
+            self.conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+            total -= size
+            evicted += 1
+        self._bump("evictions", evicted)
+
+    def _bump(self, name: str, amount: int = 1):
+        self.conn.execute(
+            "INSERT INTO counters (name, value) VALUES (?, ?) ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+            (name, amount)
+        )
+
+    def stats(self) -> Dict[str, int]:
+        """Get the lifetime counters and the current size of the cache."""
+        with self._lock:
+            counters = dict(self.conn.execute("SELECT name, value FROM counters").fetchall())
+            entries, size = self.conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+        return {
+            "hits": counters.get("hits", 0),
+            "misses": counters.get("misses", 0),
+            "evictions": counters.get("evictions", 0),
+            "entries": entries,
+            "bytes": size
+        }
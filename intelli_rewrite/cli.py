@@ -1,27 +1,193 @@
+from __future__ import annotations
+
 import typer
 from pathlib import Path
+from dotenv import load_dotenv
 from rich.console import Console
 from rich.table import Table
-from rich.progress import Progress, SpinnerColumn, TextColumn, BarColumn, TaskProgressColumn
-from .queue_manager import QueueManager
-from .models import TaskStatus, QAPair
-from .text_processor import TextProcessor
-from .api_client import DeepSeekAPI
+from .queue_manager import QueueManager, TaskCancelledError
+from .enums import TaskStatus, MemoryMode, BatchStatus
+from .text_processor import TextProcessor, content_hash
+from .storage import current_worker_id, worker_is_alive
+import glob
 import json
 import os
+import shutil
+import threading
+import time
+import uuid
+from datetime import datetime
+from typing import TYPE_CHECKING, Callable, List, Optional, Tuple
+
+# The API client, pydantic models, scheduler and batch support are imported by the
+# commands that use them, so list-tasks and show-task start without them
+if TYPE_CHECKING:
+    from .api_client import DeepSeekAPI
+    from .assembler import OutputAssembler
+    from .budget import BudgetGovernor
+    from .journal import TaskJournal
+    from .metrics import MetricsRegistry
+    from .mock_server import MockConfig
+    from .models import ChunkMetrics, QAPair
+    from .scheduler import TaskRun
+    from .streaming import PartialOutput
+
+# Load environment variables from .env file
+load_dotenv()
 
 app = typer.Typer()
 console = Console()
 queue_manager = QueueManager()
-text_processor = None  # Initialize as None, will be created with proper chunk size
 api_client = None  # Initialize as None, will be created when needed
 
+def _save_chunks(task_dir_id: str, chunks) -> list:
+    """
+    Stream chunks into chunks.json.
+    
+    Chunks are written as they are produced, so large inputs are never held in memory.
+    The file is then moved into the blob store and linked back, so tasks chunked the
+    same way share it.
+    
+    Returns:
+        List of the content hashes of the chunks, in order
+    """
+    chunk_hashes = []
+    chunks_file = queue_manager.file_manager.get_chunks_file(task_dir_id)
+    tmp_path = f"{chunks_file}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write("[")
+        for i, chunk in enumerate(chunks):
+            chunk_data = {
+                "index": i,
+                "content": chunk.content,
+                "start_line": chunk.start_line,
+                "end_line": chunk.end_line,
+                "char_count": chunk.char_count,
+                "token_count": chunk.token_count,
+                "hash": chunk.content_hash
+            }
+            # Same layout as json.dump(chunks_data, f, indent=2)
+            f.write(",\n  " if i else "\n  ")
+            f.write(json.dumps(chunk_data, ensure_ascii=False, indent=2).replace("\n", "\n  "))
+            chunk_hashes.append(chunk.content_hash)
+        f.write("\n]" if chunk_hashes else "]")
+    queue_manager.file_manager.blobs.store_file(tmp_path, chunks_file, move=True)
+    return chunk_hashes
+
+def _text_processor_for(task) -> TextProcessor:
+    """Create a chunker with the settings of a task."""
+    return TextProcessor(chunk_size=task.chunk_size, chunk_tokens=task.chunk_tokens, tokenizer=task.tokenizer)
+
+def _chunk_input(task_dir_id: str, input_file: str, chunk_size: int, chunk_tokens: Optional[int], tokenizer: str) -> Tuple[int, str]:
+    """
+    Chunk a task's input file into its chunks.json.
+    
+    Takes plain values, so add-tasks can run it in worker processes. Each call
+    has its own chunker, so uploads can be chunked side by side.
+    
+    Returns:
+        Tuple of the number of chunks and the tokenizer that counted them
+    """
+    processor = TextProcessor(chunk_size=chunk_size, chunk_tokens=chunk_tokens, tokenizer=tokenizer)
+    return len(_save_chunks(task_dir_id, processor.iter_file_chunks(input_file))), processor.tokenizer
+
+def _expand_inputs(sources: List[str]) -> List[Path]:
+    """
+    Find the input files of add-tasks.
+    
+    A directory is searched recursively for Markdown and text files, anything
+    else is a file or a glob pattern. Hidden files and files inside the output
+    directory, which holds the copies of queued inputs, are left out.
+    """
+    from .inbox import InboxWatcher
+    output_dir = queue_manager.file_manager.base_dir.resolve()
+    found = set()
+    for source in sources:
+        if Path(source).is_dir():
+            candidates = [path for pattern in InboxWatcher.PATTERNS for path in Path(source).rglob(pattern)]
+        else:
+            candidates = [Path(path) for path in glob.glob(source, recursive=True)]
+        for path in candidates:
+            if path.name.startswith(".") or not path.is_file() or output_dir in path.resolve().parents:
+                continue
+            found.add(path)
+    return sorted(found)
+
+def _mark_completed(task, qa_pairs: list):
+    """Mark a task completed, recording how many of its chunks failed."""
+    failed = sum(1 for qa in qa_pairs if qa.error)
+    message = f"{failed} chunk(s) failed, retry them with repair" if failed else None
+    queue_manager.update_task_status(task.id, TaskStatus.COMPLETED, message, failed_chunks=failed)
+
+def _find_task(task_id: str):
+    """Find a task by its full ID or a unique ID prefix."""
+    task = queue_manager.get_task(task_id)
+    if task:
+        return task
+    matching_tasks = queue_manager.find_tasks_by_prefix(task_id)
+    if len(matching_tasks) == 1:
+        return matching_tasks[0]
+    return None
+
+def _create_task(
+    input_file: str,
+    output_file: str,
+    chunk_size: int = 800,
+    chunk_tokens: Optional[int] = None,
+    tokenizer: str = "approx",
+    memory_size: int = 0,
+    memory_mode: MemoryMode = MemoryMode.ANSWERS,
+    content: Optional[bytes] = None,
+    priority: int = 0,
+    budget_tokens: Optional[int] = None,
+    budget_cost: Optional[float] = None,
+    memory_tokens: Optional[int] = None,
+    summary_interval: int = 8
+):
+    """
+    Copy an input file into a new task directory, chunk it and queue the task.
+    
+    With content, input_file only names the document and content is written to the task directory.
+    """
+    task = queue_manager.add_task(
+        input_file=input_file, 
+        output_file=output_file,
+        chunk_size=chunk_size,
+        memory_size=memory_size,
+        memory_mode=memory_mode,
+        chunk_tokens=chunk_tokens,
+        tokenizer=tokenizer,
+        save=False,
+        content=content,
+        priority=priority,
+        memory_tokens=memory_tokens,
+        summary_interval=summary_interval
+    )
+    
+    # Stream the file's chunks into chunks.json
+    task.total_chunks, task.tokenizer = _chunk_input(task.task_id, task.input_file, task.chunk_size, task.chunk_tokens, task.tokenizer)
+    
+    # Update task with chunk information, the task is queued only once its chunks are written
+    task.processed_chunks = 0
+    task.budget_tokens = budget_tokens
+    task.budget_cost = budget_cost
+    queue_manager.save_task(task)
+    return task
+
 @app.command()
 def add_task(
     input_file: str, 
     output_file: str = None, 
     chunk_size: int = typer.Option(800, help="Size of text chunks to process"),
-    memory_size: int = typer.Option(0, help="Number of previous Q&A pairs to include in the prompt (0 for no memory)")
+    chunk_tokens: Optional[int] = typer.Option(None, help="Token budget per chunk, overrides --chunk-size"),
+    tokenizer: str = typer.Option("approx", help="Token counter for --chunk-tokens: approx, or tiktoken when installed"),
+    memory_size: int = typer.Option(0, help="Number of previous Q&A pairs to include in the prompt (0 for no memory)"),
+    memory_mode: MemoryMode = typer.Option(MemoryMode.ANSWERS, help="Build memory from earlier answers, from the source text of earlier chunks (lets chunks run in parallel), or from a running summary plus the latest answers"),
+    memory_tokens: Optional[int] = typer.Option(None, help="Token budget of the memory, the oldest chunks are left out first (default: no limit, 2000 in summary mode)"),
+    summary_interval: int = typer.Option(8, min=1, help="Chunks between refreshes of the running summary in summary mode"),
+    priority: int = typer.Option(0, help="Higher priorities are started first, and each step doubles the task's share of the workers"),
+    budget_tokens: Optional[int] = typer.Option(None, help="Tokens the task may use, it pauses once they are spent"),
+    budget_cost: Optional[float] = typer.Option(None, help="Estimated cost the task may incur, it pauses once it is reached")
 ):
     """Add a new chapter rewriting task to the queue."""
     if not Path(input_file).exists():
@@ -34,42 +200,12 @@ def add_task(
         output_file = f"rewritten_{input_path.stem}.md"
         console.print(f"[yellow]No output file specified. Using default: {output_file}[/yellow]")
 
-    # Create the task with the specified parameters
-    task = queue_manager.add_task(
-        input_file=input_file, 
-        output_file=output_file,
-        chunk_size=chunk_size,
-        memory_size=memory_size
+    task = _create_task(
+        input_file, output_file, chunk_size, chunk_tokens, tokenizer, memory_size, memory_mode,
+        priority=priority, budget_tokens=budget_tokens, budget_cost=budget_cost,
+        memory_tokens=memory_tokens, summary_interval=summary_interval
     )
-    
-    # Initialize text processor with the specified chunk size
-    global text_processor
-    text_processor = TextProcessor(chunk_size=chunk_size)
-
-    # Process the file to get chunks
-    chunks = text_processor.process_file(input_file)
-    
-    # Update task with chunk information
-    task.total_chunks = len(chunks)
-    task.processed_chunks = 0
-    
-    # Store chunks in JSON
-    chunks_data = []
-    for i, chunk in enumerate(chunks):
-        chunks_data.append({
-            "index": i,
-            "content": chunk.content,
-            "start_line": chunk.start_line,
-            "end_line": chunk.end_line,
-            "char_count": chunk.char_count
-        })
-    
-    # Save chunks to a JSON file
     chunks_file = queue_manager.file_manager.get_chunks_file(task.task_id)
-    with open(chunks_file, 'w', encoding='utf-8') as f:
-        json.dump(chunks_data, f, ensure_ascii=False, indent=2)
-    
-    queue_manager._save_tasks()
 
     console.print(f"[green]Task added successfully![/green]")
     console.print(f"Task ID: {task.id}")
@@ -78,55 +214,540 @@ def add_task(
     console.print(f"Total chunks: {task.total_chunks}")
     console.print(f"Input file: {task.input_file}")
     console.print(f"Output file: {task.output_file}")
-    console.print(f"Chunk size: {chunk_size} characters")
-    console.print(f"Memory size: {memory_size} previous chunks")
+    if chunk_tokens:
+        console.print(f"Chunk size: {chunk_tokens} tokens ({task.tokenizer})")
+    else:
+        console.print(f"Chunk size: {chunk_size} characters")
+    console.print(f"Memory size: {memory_size} previous chunks ({memory_mode.value})")
+    if memory_mode == MemoryMode.SUMMARY:
+        console.print(f"Running summary: refreshed every {summary_interval} chunks")
+    if task.memory_tokens is not None:
+        console.print(f"Memory budget: {task.memory_tokens} tokens")
+    if priority:
+        console.print(f"Priority: {priority}")
+    if budget_tokens is not None or budget_cost is not None:
+        console.print(f"Budget: {_format_budget(budget_tokens, budget_cost)}")
     console.print(f"Chunks saved to: {chunks_file}")
 
 @app.command()
-def list_tasks():
+def add_tasks(
+    sources: List[str] = typer.Argument(..., help="Directories, searched recursively for .md and .txt files, files or quoted glob patterns such as 'export/**/*.md'"),
+    chunk_size: int = typer.Option(800, help="Size of text chunks to process"),
+    chunk_tokens: Optional[int] = typer.Option(None, help="Token budget per chunk, overrides --chunk-size"),
+    tokenizer: str = typer.Option("approx", help="Token counter for --chunk-tokens: approx, or tiktoken when installed"),
+    memory_size: int = typer.Option(0, help="Number of previous Q&A pairs to include in the prompt (0 for no memory)"),
+    memory_mode: MemoryMode = typer.Option(MemoryMode.ANSWERS, help="Build memory from earlier answers, from the source text of earlier chunks (lets chunks run in parallel), or from a running summary plus the latest answers"),
+    memory_tokens: Optional[int] = typer.Option(None, help="Token budget of the memory, the oldest chunks are left out first (default: no limit, 2000 in summary mode)"),
+    summary_interval: int = typer.Option(8, min=1, help="Chunks between refreshes of the running summary in summary mode"),
+    priority: int = typer.Option(0, help="Higher priorities are started first, and each step doubles the task's share of the workers"),
+    budget_tokens: Optional[int] = typer.Option(None, help="Tokens each task may use, it pauses once they are spent"),
+    budget_cost: Optional[float] = typer.Option(None, help="Estimated cost each task may incur, it pauses once it is reached"),
+    workers: Optional[int] = typer.Option(None, min=1, help="Processes that chunk files side by side (default: number of CPUs)"),
+    allow_duplicates: bool = typer.Option(False, help="Also add files whose content is already queued")
+):
+    """Add every file of a directory or glob pattern to the queue, chunked in parallel and queued in one transaction."""
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    from rich.progress import Progress, SpinnerColumn, TextColumn, BarColumn, TaskProgressColumn
+    from .blobs import file_digest
+    
+    started = time.perf_counter()
+    input_files = _expand_inputs(sources)
+    if not input_files:
+        console.print(f"[red]Error: No input files found in {', '.join(sources)}.[/red]")
+        raise typer.Exit(1)
+    
+    # Files are matched by content, a renamed or moved copy of a queued document is skipped too
+    queued = {} if allow_duplicates else queue_manager.find_tasks_by_input_hash()
+    new_files = []
+    skipped = 0
+    for path in input_files:
+        input_hash = file_digest(str(path))
+        if input_hash in queued:
+            skipped += 1
+            continue
+        if not allow_duplicates:
+            queued[input_hash] = str(path)
+        new_files.append(path)
+    
+    tasks = [
+        queue_manager.add_task(
+            input_file=str(path),
+            output_file=f"rewritten_{path.stem}.md",
+            chunk_size=chunk_size,
+            memory_size=memory_size,
+            memory_mode=memory_mode,
+            chunk_tokens=chunk_tokens,
+            tokenizer=tokenizer,
+            save=False,
+            priority=priority,
+            memory_tokens=memory_tokens,
+            summary_interval=summary_interval
+        )
+        for path in new_files
+    ]
+    
+    added = []
+    failed = 0
+    saved = False
+    try:
+        if tasks:
+            with Progress(
+                SpinnerColumn(),
+                TextColumn("[progress.description]{task.description}"),
+                BarColumn(),
+                TaskProgressColumn(),
+                console=console
+            ) as progress, ProcessPoolExecutor(max_workers=min(workers or os.cpu_count() or 1, len(tasks))) as pool:
+                progress_id = progress.add_task("Chunking", total=len(tasks))
+                futures = {
+                    pool.submit(_chunk_input, task.task_id, task.input_file, task.chunk_size, task.chunk_tokens, task.tokenizer): (path, task)
+                    for path, task in zip(new_files, tasks)
+                }
+                for future in as_completed(futures):
+                    path, task = futures[future]
+                    try:
+                        task.total_chunks, task.tokenizer = future.result()
+                    except Exception as e:
+                        failed += 1
+                        progress.console.print(f"[red]Error chunking {path}: {e}[/red]")
+                    else:
+                        task.budget_tokens = budget_tokens
+                        task.budget_cost = budget_cost
+                        added.append(task)
+                    progress.advance(progress_id)
+        
+        # Queued in file order, and only once every chunk file is written
+        added.sort(key=lambda task: task.created_at)
+        queue_manager.save_tasks(added)
+        saved = True
+    finally:
+        # Directories of tasks that were not queued would never be processed or deleted
+        queued_ids = {task.id for task in added} if saved else set()
+        for task in tasks:
+            if task.id not in queued_ids:
+                shutil.rmtree(queue_manager.file_manager.base_dir / task.task_id, ignore_errors=True)
+    
+    elapsed = max(time.perf_counter() - started, 1e-6)
+    total_chunks = sum(task.total_chunks for task in added)
+    size_mb = sum(Path(task.input_file).stat().st_size for task in added) / (1024 * 1024)
+    
+    console.print(f"[green]Added {len(added)} task(s) with {total_chunks} chunks.[/green]")
+    if skipped:
+        console.print(f"[yellow]Skipped {skipped} file(s) whose content is already queued.[/yellow]")
+    if failed:
+        console.print(f"[red]{failed} file(s) could not be chunked and were not added.[/red]")
+    console.print(
+        f"Scanned {len(input_files)} file(s) and ingested {len(added)} ({size_mb:.2f} MB) in {elapsed:.2f} s: "
+        f"{len(added) / elapsed:.1f} files/s, {size_mb / elapsed:.2f} MB/s, {total_chunks / elapsed:.0f} chunks/s"
+    )
+    if failed:
+        raise typer.Exit(1)
+
+@app.command()
+def update_task(task_id: str, input_file: str):
+    """Re-chunk a task from an edited input file and only reprocess the chunks that changed."""
+    from .assembler import OutputAssembler
+    from .memory import load_summaries, save_summaries
+    
+    if not Path(input_file).exists():
+        console.print(f"[red]Error: Input file '{input_file}' does not exist.[/red]")
+        raise typer.Exit(1)
+    
+    task = _find_task(task_id)
+    if not task:
+        console.print(f"[red]Task with ID {task_id} not found.[/red]")
+        raise typer.Exit(1)
+    if task.status == TaskStatus.PROCESSING and worker_is_alive(task.worker_id):
+        console.print(f"[red]Task {task.id} is being processed, stop its worker before updating it.[/red]")
+        raise typer.Exit(1)
+    
+    # Load the old chunks and their finished results
+    chunks_file = queue_manager.file_manager.get_chunks_file(task.task_id)
+    with open(chunks_file, 'r', encoding='utf-8') as f:
+        old_chunks = json.load(f)
+    journal = queue_manager.get_journal(task)
+    old_qa_pairs = {qa.chunk_index: qa for qa in journal.load_qa_pairs()}
+    
+    # Map the content hash of every finished chunk to its result
+    reusable = {}
+    for chunk_data in old_chunks:
+        qa = old_qa_pairs.get(chunk_data["index"])
+        # Failed chunks are sent again like changed ones
+        if qa and not qa.error:
+            reusable.setdefault(chunk_data.get("hash") or content_hash(chunk_data["content"]), qa)
+    
+    # Re-chunk the edited file and keep the results of chunks whose text did not change
+    chunk_hashes = _save_chunks(task.task_id, _text_processor_for(task).iter_file_chunks(input_file))
+    kept_qa_pairs = []
+    for i, chunk_hash in enumerate(chunk_hashes):
+        qa = reusable.get(chunk_hash)
+        if qa:
+            kept_qa_pairs.append(qa.model_copy(update={"chunk_index": i}))
+    
+    task.input_file, task.input_hash = queue_manager.file_manager.replace_input_file(task.task_id, input_file, task.input_file)
+    journal.compact(kept_qa_pairs)
+    
+    # Running summaries stay valid up to the first chunk that changed or moved
+    summaries_path = queue_manager.file_manager.get_memory_summaries_path(task.task_id)
+    summaries = load_summaries(summaries_path)
+    if summaries:
+        old_hashes = [chunk_data.get("hash") or content_hash(chunk_data["content"]) for chunk_data in old_chunks]
+        unchanged = next((i for i, (old, new) in enumerate(zip(old_hashes, chunk_hashes)) if old != new), min(len(old_hashes), len(chunk_hashes)))
+        save_summaries(summaries_path, {boundary: summary for boundary, summary in summaries.items() if boundary <= unchanged})
+    
+    output_path = queue_manager.file_manager.get_output_path(task.task_id, Path(task.output_file).name)
+    OutputAssembler(output_path, kept_qa_pairs).write()
+    
+    # Queue the task again for the new and changed chunks
+    task.total_chunks = len(chunk_hashes)
+    task.processed_chunks = len(kept_qa_pairs)
+    task.failed_chunks = 0
+    task.error_message = None
+    if task.processed_chunks < task.total_chunks:
+        task.status = TaskStatus.PENDING
+        task.completed_at = None
+    else:
+        task.status = TaskStatus.COMPLETED
+    queue_manager.save_task(task)
+    queue_manager.release_chunks(task)
+    
+    console.print(f"[green]Task updated successfully![/green]")
+    console.print(f"Task ID: {task.id}")
+    console.print(f"Status: {task.status}")
+    console.print(f"Total chunks: {task.total_chunks}")
+    console.print(f"Unchanged chunks kept: {len(kept_qa_pairs)}")
+    console.print(f"New or changed chunks queued: {task.total_chunks - len(kept_qa_pairs)}")
+    new_hashes = set(chunk_hashes)
+    console.print(f"Old chunks dropped: {sum(1 for chunk_hash in reusable if chunk_hash not in new_hashes)}")
+    if task.memory_size > 0 and task.memory_mode != MemoryMode.SOURCE:
+        console.print("[yellow]Kept chunks are not rewritten again even if the answers they remember changed.[/yellow]")
+
+# Above this many tasks list-tasks prints plain columns, rich lays out every cell and takes seconds for thousands of rows
+TABLE_MAX_ROWS = 100
+
+@app.command()
+def list_tasks(
+    status: Optional[TaskStatus] = typer.Option(None, help="Only list tasks with this status")
+):
     """List all tasks in the queue."""
-    table = Table(show_header=True, header_style="bold magenta")
-    table.add_column("Task ID")
-    table.add_column("Directory ID")
-    table.add_column("Input File")
-    table.add_column("Output File")
-    table.add_column("Status")
-    table.add_column("Progress")
-    table.add_column("Chunk Size")
-    table.add_column("Memory Size")
-    table.add_column("Created At")
-
-    for task in queue_manager.tasks:
-        progress = f"{task.processed_chunks}/{task.total_chunks}" if task.total_chunks > 0 else "N/A"
-        table.add_row(
-            task.id,
-            task.task_id,
-            Path(task.input_file).name,
-            Path(task.output_file).name,
-            task.status,
+    headers = ["Task ID", "Directory ID", "Input File", "Output File", "Status", "Progress", "Priority", "Chunk Size", "Memory Size", "Created At"]
+    rows = []
+    for task in queue_manager.list_task_summaries([status] if status else None):
+        progress = f"{task['processed_chunks']}/{task['total_chunks']}" if task["total_chunks"] else "N/A"
+        if task["failed_chunks"]:
+            progress += f" ({task['failed_chunks']} failed)"
+        rows.append([
+            task["id"],
+            task["task_id"],
+            os.path.basename(task["input_file"]),
+            os.path.basename(task["output_file"]),
+            task["status"].value,
             progress,
-            str(task.chunk_size),
-            str(task.memory_size),
-            task.created_at.strftime("%Y-%m-%d %H:%M:%S")
-        )
+            str(task["priority"]),
+            str(task["chunk_size"]),
+            str(task["memory_size"]),
+            task["created_at"].strftime("%Y-%m-%d %H:%M:%S")
+        ])
+    
+    if len(rows) > TABLE_MAX_ROWS:
+        widths = [max(len(row[i]) for row in rows + [headers]) for i in range(len(headers))]
+        lines = ["  ".join(value.ljust(width) for value, width in zip(row, widths)).rstrip() for row in [headers] + rows]
+        typer.echo("\n".join(lines))
+        return
+    
+    table = Table(show_header=True, header_style="bold magenta")
+    for header in headers:
+        table.add_column(header)
+    for row in rows:
+        table.add_row(*row)
 
     console.print(table)
 
-@app.command()
-def process_tasks():
-    """Process all pending tasks in the queue."""
-    # Initialize API client if not already done
+def _prepare_task_run(task, worker_id: str) -> Optional[TaskRun]:
+    """
+    Load the chunks and previous results of a claimed task and prepare its output file.
+    
+    Returns None if another live worker still holds chunks of the task.
+    """
+    from .assembler import OutputAssembler
+    from .memory import load_summaries
+    from .scheduler import TaskRun
+    
+    # Get the chunks file path
+    chunks_file = queue_manager.file_manager.get_chunks_file(task.task_id)
+    qa_json_path = queue_manager.file_manager.get_qa_json_path(task.task_id)
+    
+    # Load chunks
+    with open(chunks_file, 'r', encoding='utf-8') as f:
+        chunks_data = json.load(f)
+        
+    # Update total chunks count
+    task.total_chunks = len(chunks_data)
+    
+    # Load existing Q&A pairs if any, the journal is the source of truth for progress
+    journal = queue_manager.get_journal(task)
+    task.qa_pairs = journal.load_qa_pairs()
+    task.processed_chunks = len(task.qa_pairs)
+    task.memory_summaries = load_summaries(queue_manager.file_manager.get_memory_summaries_path(task.task_id))
+    
+    # Get the output file path
+    output_path = queue_manager.file_manager.get_output_path(task.task_id, Path(task.output_file).name)
+    
+    # Check if we're resuming a task
+    is_resuming = task.processed_chunks > 0
+    
+    # Write the output file from the journal, an append lost or repeated when an earlier run stopped is not carried over
+    assembler = OutputAssembler(output_path, task.qa_pairs)
+    assembler.write()
+    
+    # Display task information
+    console.print(f"[bold cyan]Processing Task:[/bold cyan]")
+    console.print(f"Task ID: {task.id}")
+    console.print(f"Directory ID: {task.task_id}")
+    console.print(f"Input File: {Path(task.input_file).name}")
+    console.print(f"Output File: {Path(task.output_file).name}")
+    console.print(f"Total Chunks: {task.total_chunks}")
+    console.print(f"Processed Chunks: {task.processed_chunks}")
+    console.print(f"Memory Size: {task.memory_size} ({task.memory_mode.value})")
+    console.print(f"Output Path: {output_path}")
+    console.print(f"Q&A Path: {journal.compacted_path}")
+    if is_resuming:
+        console.print(f"[yellow]Resuming task from chunk {task.processed_chunks + 1}[/yellow]")
+    console.print("")
+    
+    # Skip chunks that were already processed
+    pending_chunks = [chunk_data for chunk_data in chunks_data if chunk_data["index"] not in assembler]
+    
+    # Reserve the remaining chunks so no other worker sends them at the same time
+    if not queue_manager.claim_chunks(task, [chunk_data["index"] for chunk_data in pending_chunks], worker_id):
+        console.print(f"[yellow]Task {task.id} is being processed by another worker, skipping[/yellow]")
+        queue_manager.update_task_status(task.id, TaskStatus.PENDING)
+        return None
+    
+    return TaskRun(
+        task=task,
+        chunks_data=chunks_data,
+        pending_chunks=pending_chunks,
+        journal=journal,
+        qa_json_path=qa_json_path,
+        output_path=output_path,
+        assembler=assembler
+    )
+
+def _make_qa_pair(
+    chunk_data: dict,
+    answer: str,
+    reasoning: Optional[str],
+    metrics: Optional[ChunkMetrics] = None,
+    prompt_hash: Optional[str] = None
+) -> QAPair:
+    """Create the Q&A pair of a rewritten chunk, with the chunk text that was sent as question."""
+    from .models import QAPair
+    return QAPair(
+        question=chunk_data["content"],
+        question_hash=chunk_data.get("hash") or content_hash(chunk_data["content"]),
+        answer=answer,
+        reasoning_content=reasoning,
+        chunk_index=chunk_data["index"],
+        char_count=chunk_data["char_count"],
+        metrics=metrics,
+        prompt_hash=prompt_hash
+    )
+
+def _chunk_metrics(response: dict, queue_wait: float, started_at: float) -> ChunkMetrics:
+    """Build the metrics of a chunk from the response of generate_response."""
+    from .models import ChunkMetrics
+    usage = response.get("usage") or {}
+    source = response.get("endpoint") if response.get("endpoint") in ("cache", "partial") else "api"
+    return ChunkMetrics(
+        source=source,
+        endpoint=response.get("endpoint") if source == "api" else None,
+        model=response.get("model"),
+        started_at=started_at,
+        queue_wait=queue_wait,
+        throttle_wait=response.get("throttle_wait") or 0.0,
+        elapsed=response.get("elapsed") or 0.0,
+        latency=response.get("latency"),
+        ttft=response.get("ttft"),
+        prompt_tokens=usage.get("prompt_tokens", 0),
+        completion_tokens=usage.get("completion_tokens", 0),
+        reasoning_tokens=usage.get("reasoning_tokens", 0),
+        cached_prompt_tokens=usage.get("cached_tokens", 0),
+        prompt_tokens_saved=response.get("prompt_tokens_saved", 0),
+        retries=response.get("retries", 0),
+        hedged=response.get("hedged", False)
+    )
+
+def _partial_output(task, chunk_data: dict) -> PartialOutput:
+    """Get the files a streamed response for a chunk is written to."""
+    from .streaming import PartialOutput
+    chunk_key = f"{chunk_data['index']:05d}_{chunk_data.get('hash', '')[:12]}".rstrip('_')
+    answer_path, reasoning_path = queue_manager.file_manager.get_partial_paths(task.task_id, chunk_key)
+    return PartialOutput(answer_path, reasoning_path)
+
+def _rewrite_chunk(
+    task,
+    chunk_data: dict,
+    memory_context: list,
+    queue_wait: float = 0.0,
+    on_tokens: Optional[Callable[[int], None]] = None,
+    model: Optional[str] = None
+):
+    """
+    Send one chunk to the API and record its timing and token usage.
+    
+    Args:
+        model: Model to ask instead of the configured one, e.g. the fallback of a budget
+    
+    Returns:
+        The Q&A pair of the chunk; a chunk whose request failed gets a Q&A pair with its error
+    """
+    from .api_client import FatalAPIError
+    from .models import ChunkMetrics, QAPair
+    
+    content = chunk_data["content"]
+    chunk_index = chunk_data["index"]
+    char_count = chunk_data["char_count"]
+    started_at = time.time()
+    started = time.monotonic()
+    try:
+        # Generate response, streamed responses are written to a partial file as they arrive
+        partial = _partial_output(task, chunk_data) if api_client.stream else None
+        response = api_client.generate_response(content, memory_context, partial=partial, on_tokens=on_tokens, model=model)
+        
+        # Get the content and reasoning from the response
+        answer = response.get("content", "")
+        reasoning = response.get("reasoning_content")
+        metrics = _chunk_metrics(response, queue_wait, started_at)
+        return _make_qa_pair(chunk_data, answer, reasoning, metrics, response.get("prompt_hash"))
+    except FatalAPIError:
+        # Every other chunk would fail the same way, stop the run instead
+        raise
+    except Exception as e:
+        console.print(f"[red]Error processing chunk {chunk_index + 1}: {str(e)}[/red]")
+        # Record the chunk as failed, repair sends it again
+        return QAPair(
+            question=content,
+            question_hash=chunk_data.get("hash") or content_hash(content),
+            answer="",
+            chunk_index=chunk_index,
+            char_count=char_count,
+            metrics=ChunkMetrics(source="error", started_at=started_at, queue_wait=queue_wait, elapsed=time.monotonic() - started),
+            error=str(e)
+        )
+
+def _refresh_summaries(client: DeepSeekAPI, task, chunk_index: int) -> bool:
+    """
+    Write the running summary a summary mode chunk needs, the answers since the last one are folded in.
+    
+    Returns:
+        True if a summary was added, the chunk's memory must then be built again
+    """
+    from .api_client import FatalAPIError
+    from .memory import save_summaries, summary_due, update_summaries
+    from .prompts import summary_request
+    
+    if summary_due(task, chunk_index) is None:
+        return False
+    
+    def summarize(previous_summary: str, answers: list, max_tokens: int) -> str:
+        system_prompt, content = summary_request(previous_summary, answers, max_tokens)
+        # SUMMARY_MODEL can name a cheaper model for summaries
+        response = client.generate_response(content, system_prompt=system_prompt, model=os.getenv("SUMMARY_MODEL") or None)
+        return (response.get("content") or "").strip()
+    
+    known = len(task.memory_summaries)
+    try:
+        update_summaries(task, chunk_index, summarize)
+    except FatalAPIError:
+        raise
+    except Exception as e:
+        # The chunk goes ahead with the previous summary, the next chunk tries again
+        console.print(f"[yellow]Could not update the running summary of task {task.id}: {str(e)}[/yellow]")
+    if len(task.memory_summaries) == known:
+        return False
+    save_summaries(queue_manager.file_manager.get_memory_summaries_path(task.task_id), task.memory_summaries)
+    return True
+
+def _commit_chunk(task, qa_pair: QAPair, journal: TaskJournal, assembler: OutputAssembler):
+    """Record a finished chunk in the task, its journal and the output file."""
+    # Add the Q&A pair to the task, by chunk index
+    if task.add_qa_pair(qa_pair):
+        task.processed_chunks += 1
+    
+    # Append the Q&A pair and progress to the journal, the queue only records the new count
+    journal.append(qa_pair, task.processed_chunks)
+    queue_manager.record_progress(task)
+    
+    # The journal comes first, so the output is only ever behind it; the chunk is written
+    # once it continues the output file's run of finished chunks
+    assembler.add(qa_pair)
+
+def _check_schedule(schedule: str):
+    from .scheduler import SCHEDULING_POLICIES
+    if schedule not in SCHEDULING_POLICIES:
+        console.print(f"[red]Unknown scheduling policy '{schedule}', use one of: {', '.join(SCHEDULING_POLICIES)}[/red]")
+        raise typer.Exit(1)
+
+def _format_budget(tokens: Optional[int], cost: Optional[float]) -> str:
+    limits = []
+    if tokens is not None:
+        limits.append(f"{tokens:,} tokens")
+    if cost is not None:
+        limits.append(f"${cost:.2f}")
+    return ", ".join(limits) or "unlimited"
+
+def _init_budget(budget_tokens: Optional[int], budget_cost: Optional[float], on_budget: str, fallback_model: Optional[str]) -> BudgetGovernor:
+    from .budget import Budget, BudgetGovernor
+    try:
+        return BudgetGovernor(Budget(budget_tokens, budget_cost), on_budget, fallback_model)
+    except ValueError as e:
+        console.print(f"[red]{str(e)}[/red]")
+        raise typer.Exit(1)
+
+def _init_api_client(no_cache: bool = False, stream: bool = False) -> bool:
+    """Create the API client once per process, so every run shares its connection pool."""
+    from .api_client import DeepSeekAPI
+    from .cache import ResponseCache
+    
     global api_client
     if api_client is None:
         try:
-            api_client = DeepSeekAPI()
+            api_client = DeepSeekAPI(cache=None if no_cache else ResponseCache(), stream=stream)
             console.print("[green]Successfully connected to DeepSeek API[/green]")
-            console.print(f"[green]Using model: {api_client.model}[/green]")
+            if len(api_client.pool.endpoints) > 1:
+                endpoint_names = ", ".join(f"{endpoint.name} ({endpoint.model})" for endpoint in api_client.pool.endpoints)
+                console.print(f"[green]Using {len(api_client.pool.endpoints)} endpoints: {endpoint_names}[/green]")
+            else:
+                console.print(f"[green]Using model: {api_client.model}[/green]")
         except Exception as e:
             console.print(f"[red]Error initializing DeepSeek API: {str(e)}[/red]")
             console.print("[yellow]Using mock responses instead[/yellow]")
             api_client = None
-            return
+            return False
+    return True
+
+@app.command()
+def process_tasks(
+    concurrency: int = typer.Option(1, help="Number of chunk requests to keep in flight across all pending tasks"),
+    schedule: str = typer.Option("fair", help="How workers are shared between tasks: fair (weighted by priority), srf (shortest remaining first) or fifo"),
+    no_cache: bool = typer.Option(False, "--no-cache", help="Always call the API instead of reusing cached responses"),
+    stream: bool = typer.Option(False, "--stream", help="Stream responses into per-chunk partial files as they arrive"),
+    metrics_file: Optional[str] = typer.Option(None, envvar="METRICS_FILE", help="Keep chunk, token and latency metrics in this file, in the Prometheus text format"),
+    budget_tokens: Optional[int] = typer.Option(None, help="Tokens the run may use, it stops once they are spent"),
+    budget_cost: Optional[float] = typer.Option(None, help="Estimated cost the run may incur, it stops once it is reached"),
+    on_budget: str = typer.Option("slow", help="Once the projected spend exceeds the budget: slow (one request at a time), pause, or fallback"),
+    fallback_model: Optional[str] = typer.Option(None, envvar="FALLBACK_MODEL", help="Cheaper model for chunks of runs and tasks projected to exceed their budget")
+):
+    """Process all pending tasks in the queue."""
+    from .api_client import FatalAPIError
+    from .metrics import MetricsRegistry
+    
+    _check_schedule(schedule)
+    budget = _init_budget(budget_tokens, budget_cost, on_budget, fallback_model)
+    # Initialize API client if not already done
+    if not _init_api_client(no_cache, stream):
+        return
     
     # Get pending tasks
     pending_tasks = queue_manager.get_pending_tasks()
@@ -134,178 +755,866 @@ def process_tasks():
         console.print("[yellow]No pending tasks to process.[/yellow]")
         return
     
-    # Check for interrupted tasks
-    interrupted_tasks = [task for task in pending_tasks if task.processed_chunks > 0]
+    # Check for interrupted tasks, tasks held by another live worker are left alone
+    interrupted_tasks = [
+        task for task in pending_tasks
+        if task.processed_chunks > 0 and (task.status == TaskStatus.PENDING or not worker_is_alive(task.worker_id))
+    ]
     if interrupted_tasks:
         console.print(f"[yellow]Found {len(interrupted_tasks)} interrupted task(s). Resuming...[/yellow]")
         for task in interrupted_tasks:
             console.print(f"  - Task {task.id}: {Path(task.input_file).name} ({task.processed_chunks}/{task.total_chunks} chunks processed)")
     
-    for task in pending_tasks:
+    try:
+        _process_queue(concurrency, stream, MetricsRegistry() if metrics_file else None, metrics_file, schedule=schedule, budget=budget)
+    except FatalAPIError as e:
+        console.print(f"[red]Stopping: the API rejected the request: {str(e)}[/red]")
+        console.print("[yellow]Claimed tasks keep their progress and will resume on the next run.[/yellow]")
+    _print_run_summary(budget)
+
+def _process_queue(
+    concurrency: int,
+    stream: bool,
+    metrics: Optional[MetricsRegistry] = None,
+    metrics_file: Optional[str] = None,
+    poll: Optional[Callable[[], None]] = None,
+    poll_interval: float = 2.0,
+    stop: Optional[threading.Event] = None,
+    shutdown_timeout: Optional[float] = None,
+    schedule: str = "fair",
+    budget: Optional[BudgetGovernor] = None,
+    task_ids: Optional[set] = None
+) -> int:
+    """
+    Claim and process tasks until none are left.
+    
+    Tasks queued while others are running are claimed as well, and share the
+    workers with them according to the scheduling policy.
+    
+    Args:
+        concurrency: Number of chunk requests to keep in flight
+        stream: Show the token rate of streamed responses
+        metrics: Registry the finished chunks are counted in
+        metrics_file: File the metrics are written to
+        poll: Called before tasks are claimed, to queue new work
+        poll_interval: Once the queue came up empty, seconds before it is looked at again
+        stop: Once set, no more tasks are claimed or chunks sent, claimed tasks go back to the queue
+        shutdown_timeout: Seconds to wait for the chunks in flight once stop is set
+        schedule: Scheduling policy, see ChunkScheduler
+        budget: Token and cost budget of the run, tasks are held to their own budgets either way
+        task_ids: Only claim these tasks, e.g. the ones being repaired
+    
+    Returns:
+        Number of requests still in flight when the run gave up waiting for them
+    
+    Raises:
+        FatalAPIError: The API rejected a request in a way every other request would fail too
+    """
+    from rich.progress import Progress, SpinnerColumn, TextColumn, BarColumn, TaskProgressColumn
+    from .api_client import FatalAPIError
+    from .budget import Budget, BudgetExceededError, BudgetGovernor, Spend
+    from .memory import build_memory_context
+    from .scheduler import ChunkScheduler
+    
+    worker_id = current_worker_id()
+    metrics_written = [0.0]
+    queue_empty_at = [None]
+    budget = budget or BudgetGovernor(Budget())
+    # The budget stops the run through the same event as a signal
+    stop = stop or threading.Event()
+    # Spend of each claimed task, including earlier runs, and the tasks moved to the fallback model
+    task_spends = {}
+    fallback_task_ids = set()
+    
+    def write_metrics(force: bool = False):
+        # Rewritten at most every few seconds, the file is meant to be scraped
+        if metrics is None or (not force and time.monotonic() - metrics_written[0] < 5):
+            return
+        metrics_written[0] = time.monotonic()
+        metrics.observe_endpoints(api_client.pool)
         try:
-            # Update task status to processing
-            queue_manager.update_task_status(task.id, TaskStatus.PROCESSING)
-            
-            # Get the chunks file path
-            chunks_file = queue_manager.file_manager.get_chunks_file(task.task_id)
-            qa_json_path = queue_manager.file_manager.get_qa_json_path(task.task_id)
-            
-            # Load chunks
-            with open(chunks_file, 'r', encoding='utf-8') as f:
-                chunks_data = json.load(f)
-                
-            # Update total chunks count
-            task.total_chunks = len(chunks_data)
-            
-            # Load existing Q&A pairs if any
-            if Path(qa_json_path).exists():
-                with open(qa_json_path, 'r', encoding='utf-8') as f:
-                    existing_qa_pairs = json.load(f)
-                    # Convert to QAPair objects
-                    task.qa_pairs = [QAPair(**qa) for qa in existing_qa_pairs]
-            
-            # Get the output file path
-            output_path = queue_manager.file_manager.get_output_path(task.task_id, Path(task.output_file).name)
-            
-            # Check if we're resuming a task
-            is_resuming = task.processed_chunks > 0
+            metrics.write(metrics_file)
+        except OSError as e:
+            console.print(f"[yellow]Could not write metrics to {metrics_file}: {str(e)}[/yellow]")
+    
+    with Progress(
+        SpinnerColumn(),
+        TextColumn("[progress.description]{task.description}"),
+        BarColumn(),
+        TaskProgressColumn(),
+        TextColumn("{task.fields[speed]}"),
+        console=console
+    ) as progress:
+        skipped_task_ids = set()
+        runs_by_task_id = {}
+        speed_lock = threading.Lock()
+        # Streamed tokens of each task: [count, time of the first token, time of the last display update]
+        token_meters = {}
+        
+        def tokens_counter(task) -> Callable[[int], None]:
+            def on_tokens(count: int):
+                now = time.monotonic()
+                with speed_lock:
+                    meter = token_meters.setdefault(task.id, [0, now, 0.0])
+                    meter[0] += count
+                    if now - meter[2] < 0.5 or now == meter[1]:
+                        return
+                    meter[2] = now
+                    speed = meter[0] / (now - meter[1])
+                progress.update(runs_by_task_id[task.id].progress_id, speed=f"{speed:.1f} tok/s")
+            return on_tokens
+        
+        def claim_next() -> Optional[TaskRun]:
+            # The scheduler asks whenever a task slot is free, look at an empty queue only now and then
+            if queue_empty_at[0] is not None and time.monotonic() - queue_empty_at[0] < poll_interval:
+                return None
+            if poll is not None:
+                poll()
+            # Tasks are claimed atomically, so several process-tasks workers can share the queue
+            while True:
+                task = queue_manager.claim_task(worker_id, task_ids)
+                if task is None:
+                    queue_empty_at[0] = time.monotonic()
+                    return None
+                if task.id in skipped_task_ids:
+                    # Only tasks whose chunks are held elsewhere are left, try again on the next run
+                    queue_manager.update_task_status(task.id, TaskStatus.PENDING)
+                    queue_empty_at[0] = time.monotonic()
+                    return None
+                try:
+                    run = _prepare_task_run(task, worker_id)
+                except Exception as e:
+                    queue_manager.update_task_status(task.id, TaskStatus.FAILED, str(e))
+                    console.print(f"[red]Task {task.id} failed: {str(e)}[/red]")
+                    continue
+                if run is None:
+                    skipped_task_ids.add(task.id)
+                    continue
+                run.progress_id = progress.add_task(
+                    f"Processing {Path(task.input_file).name} ({task.processed_chunks}/{task.total_chunks})", 
+                    total=task.total_chunks,
+                    completed=task.processed_chunks,
+                    speed=""
+                )
+                runs_by_task_id[task.id] = run
+                task_spends[task.id] = Spend()
+                for qa_pair in task.qa_pairs:
+                    if qa_pair.metrics is not None:
+                        task_spends[task.id].add(qa_pair.metrics, budget.pricing_for(qa_pair.metrics.model))
+                budget.add_chunks(task.total_chunks - task.processed_chunks)
+                return run
+        
+        def commit(run: TaskRun, qa_pair: QAPair):
+            # Cancelled through the HTTP API or cancel-task, possibly by another process
+            task = queue_manager.get_task(run.task.id)
+            if task is None or task.status == TaskStatus.CANCELLED:
+                raise TaskCancelledError(f"Task {run.task.id} was cancelled")
+            _commit_chunk(run.task, qa_pair, run.journal, run.assembler)
+            budget.record(qa_pair.metrics)
+            if qa_pair.metrics is not None:
+                task_spends[run.task.id].add(qa_pair.metrics, budget.pricing_for(qa_pair.metrics.model))
+            if metrics is not None and qa_pair.metrics is not None:
+                metrics.observe(qa_pair.metrics)
+                write_metrics()
+            if api_client.stream:
+                _partial_output(run.task, run.chunks_data[qa_pair.chunk_index]).discard()
+            progress.update(
+                run.progress_id,
+                advance=1,
+                description=f"Task {run.task.id} - Chunk {qa_pair.chunk_index + 1}/{run.task.total_chunks} ({qa_pair.char_count} chars)"
+            )
+            check_budgets(run)
+        
+        def check_budgets(run: TaskRun):
+            reached = budget.exhausted()
+            if reached and not stop.is_set():
+                progress.console.print(f"[yellow]Budget spent ({reached}), stopping the run[/yellow]")
+                stop.set()
+            elif not budget.over:
+                projected = budget.over_projection()
+                if projected:
+                    budget.over = True
+                    if budget.action == "slow":
+                        scheduler.concurrency = 1
+                        progress.console.print(f"[yellow]Projected to spend {projected}, slowing down to one request at a time[/yellow]")
+                    elif budget.action == "pause":
+                        progress.console.print(f"[yellow]Projected to spend {projected}, pausing the run[/yellow]")
+                        stop.set()
+                    else:
+                        progress.console.print(f"[yellow]Projected to spend {projected}, switching to {budget.fallback_model}[/yellow]")
             
-            # If resuming, don't clear the output file
-            if not is_resuming:
-                # Create or clear the output file
-                with open(output_path, 'w', encoding='utf-8') as f:
-                    f.write("")  # Clear the file
+            task_budget = Budget(run.task.budget_tokens, run.task.budget_cost)
+            if not task_budget or run.task.processed_chunks >= run.task.total_chunks:
+                return
+            spend = task_spends[run.task.id]
+            reached = task_budget.exceeded(spend.tokens, spend.cost)
+            if reached:
+                # The chunk is committed, the task picks up after it once its budget is raised
+                raise BudgetExceededError(f"Budget spent ({reached}), raise it with set-budget to resume")
+            if budget.fallback_model and run.task.id not in fallback_task_ids:
+                projected = spend.projected(run.task.total_chunks - run.task.processed_chunks)
+                if projected and task_budget.exceeded(*projected):
+                    fallback_task_ids.add(run.task.id)
+                    progress.console.print(
+                        f"[yellow]Task {run.task.id} is projected to spend {task_budget.exceeded(*projected)}, "
+                        f"switching it to {budget.fallback_model}[/yellow]"
+                    )
+        
+        def model_for(task) -> Optional[str]:
+            if budget.fallback_model and ((budget.over and budget.action == "fallback") or task.id in fallback_task_ids):
+                return budget.fallback_model
+            return None
+        
+        def on_task_done(run: TaskRun):
+            # Fold the journal into qa_pairs.json before the task is marked completed
+            run.journal.compact(run.task.qa_pairs)
+            # Write the final output in chunk order through a temporary file
+            run.assembler.write(complete=True)
+            _mark_completed(run.task, run.task.qa_pairs)
+            queue_manager.release_chunks(run.task)
+            shutil.rmtree(Path(run.output_path).parent / "partial", ignore_errors=True)
+            failed = sum(1 for qa in run.task.qa_pairs if qa.error)
+            if failed:
+                progress.console.print(f"[yellow]Task {run.task.id} completed with {failed} failed chunk(s), retry them with repair[/yellow]")
             else:
-                # For resumed tasks, ensure the output file exists
-                if not Path(output_path).exists():
-                    with open(output_path, 'w', encoding='utf-8') as f:
-                        f.write("")  # Create the file if it doesn't exist
+                progress.console.print(f"[green]Task {run.task.id} completed successfully![/green]")
+            progress.console.print(f"Output saved to: {run.output_path}")
+            progress.console.print(f"Q&A pairs saved to: {run.journal.compacted_path}")
+        
+        def on_task_failed(run: TaskRun, e: Exception):
+            queue_manager.release_chunks(run.task)
+            if isinstance(e, TaskCancelledError):
+                progress.console.print(f"[yellow]Task {run.task.id} cancelled at {run.task.processed_chunks}/{run.task.total_chunks} chunks[/yellow]")
+                return
+            if isinstance(e, BudgetExceededError):
+                queue_manager.update_task_status(run.task.id, TaskStatus.PAUSED, str(e))
+                progress.console.print(
+                    f"[yellow]Task {run.task.id} paused at {run.task.processed_chunks}/{run.task.total_chunks} chunks: {str(e)}[/yellow]"
+                )
+                return
+            queue_manager.update_task_status(run.task.id, TaskStatus.FAILED, str(e))
+            progress.console.print(f"[red]Task {run.task.id} failed: {str(e)}[/red]")
+        
+        def rewrite(task, chunk_data: dict, memory_context: list, queue_wait: float):
+            if _refresh_summaries(api_client, task, chunk_data["index"]):
+                memory_context = build_memory_context(task, chunk_data["index"], runs_by_task_id[task.id].chunks_data)
+            return _rewrite_chunk(
+                task, chunk_data, memory_context, queue_wait,
+                on_tokens=tokens_counter(task) if stream else None,
+                model=model_for(task)
+            )
+        
+        scheduler = ChunkScheduler(
+            rewrite=rewrite,
+            commit=commit,
+            on_task_done=on_task_done,
+            on_task_failed=on_task_failed,
+            concurrency=concurrency,
+            abort_on=(FatalAPIError,),
+            policy=schedule
+        )
+        try:
+            unfinished = scheduler.run(
+                [],
+                claim_next=claim_next,
+                keep_claiming=True,
+                stop=stop,
+                drain_timeout=shutdown_timeout
+            )
+            for run in unfinished:
+                # Committed chunks are in the journal, and streamed answers in their partial files
+                queue_manager.release_chunks(run.task)
+                task = queue_manager.get_task(run.task.id)
+                if task is None or task.status == TaskStatus.CANCELLED:
+                    continue
+                queue_manager.update_task_status(run.task.id, TaskStatus.PENDING)
+                progress.console.print(
+                    f"[yellow]Task {run.task.id} stopped at {run.task.processed_chunks}/{run.task.total_chunks} chunks, "
+                    f"it resumes on the next run[/yellow]"
+                )
+        finally:
+            write_metrics(force=True)
+    return scheduler.abandoned
+
+def _print_run_summary(budget: Optional[BudgetGovernor] = None):
+    """Print the spend of the run and the cache, hedging and endpoint counters of the API client."""
+    if budget is not None and budget.spend.chunks:
+        console.print(
+            f"Spent {budget.spend.tokens:,} tokens (~${budget.spend.cost:.2f}) of {_format_budget(budget.budget.tokens, budget.budget.cost)} "
+            f"on {budget.spend.chunks} chunk(s)"
+        )
+    if api_client.cache is not None and (api_client.cache.hits or api_client.cache.misses):
+        console.print(f"Response cache: {api_client.cache.hits} hits, {api_client.cache.misses} misses")
+    if api_client.hedging is not None and api_client.hedging.requests:
+        hedge_stats = api_client.hedging.stats()
+        console.print(
+            f"Hedged {hedge_stats['hedges']} of {hedge_stats['requests']} request(s) ({hedge_stats['hedge_rate']:.1%}), "
+            f"the hedge finished first {hedge_stats['hedge_wins']} time(s)"
+        )
+    for endpoint in api_client.pool.endpoints:
+        prefix = f"{endpoint.name}: " if len(api_client.pool.endpoints) > 1 else ""
+        if len(api_client.pool.endpoints) > 1 and endpoint.requests:
+            console.print(f"{prefix}{endpoint.requests} request(s), {endpoint.failures} failure(s), circuit {endpoint.breaker.state}")
+        if endpoint.breaker.disabled_reason:
+            console.print(f"[yellow]{prefix}disabled: {endpoint.breaker.disabled_reason}[/yellow]")
+        if endpoint.rate_limiter.rate_limited_count:
+            limits = endpoint.rate_limiter.limits()
+            rpm = f"{limits['rpm']:.0f}" if limits['rpm'] else "unlimited"
+            tpm = f"{limits['tpm']:.0f}" if limits['tpm'] else "unlimited"
+            console.print(f"{prefix}Rate limited {limits['rate_limited']} time(s), adjusted limits: {rpm} requests/min, {tpm} tokens/min")
+
+@app.command()
+def repair(
+    task_id_prefix: Optional[str] = typer.Argument(None, help="Task ID or prefix, all completed tasks with failed chunks by default"),
+    concurrency: int = typer.Option(4, help="Number of failed chunks to send at the same time"),
+    no_cache: bool = typer.Option(False, "--no-cache", help="Always call the API instead of reusing cached responses"),
+    stream: bool = typer.Option(False, "--stream", help="Stream responses into per-chunk partial files as they arrive")
+):
+    """Send only the failed chunks of completed tasks again and rewrite their output files in place."""
+    from .api_client import FatalAPIError
+    
+    if task_id_prefix:
+        tasks = queue_manager.find_tasks_by_prefix(task_id_prefix)
+        if not tasks:
+            console.print(f"[red]No tasks found with ID prefix '{task_id_prefix}'[/red]")
+            raise typer.Exit(1)
+        if len(tasks) > 1:
+            console.print(f"[red]ID prefix '{task_id_prefix}' matches {len(tasks)} tasks, use a longer prefix[/red]")
+            raise typer.Exit(1)
+        if tasks[0].status != TaskStatus.COMPLETED:
+            console.print(f"[red]Task {tasks[0].id} is {tasks[0].status.value}, only completed tasks are repaired[/red]")
+            raise typer.Exit(1)
+    else:
+        tasks = [task for task in queue_manager.list_tasks([TaskStatus.COMPLETED]) if task.failed_chunks]
+    if not any(task.failed_chunks for task in tasks):
+        console.print("[yellow]No failed chunks to repair.[/yellow]")
+        return
+    
+    if not _init_api_client(no_cache, stream):
+        return
+    
+    # Drop the failed chunks from each task's results, so the task is queued for exactly those chunks
+    repaired_ids = set()
+    for task in tasks:
+        journal = queue_manager.get_journal(task)
+        qa_pairs = journal.load_qa_pairs()
+        kept_qa_pairs = [qa for qa in qa_pairs if not qa.error]
+        if len(kept_qa_pairs) == len(qa_pairs):
+            continue
+        journal.compact(kept_qa_pairs)
+        task.processed_chunks = len(kept_qa_pairs)
+        task.failed_chunks = 0
+        task.error_message = None
+        task.completed_at = None
+        task.status = TaskStatus.PENDING
+        queue_manager.save_task(task)
+        repaired_ids.add(task.id)
+        console.print(f"Task {task.id}: {len(qa_pairs) - len(kept_qa_pairs)} failed chunk(s) queued again")
+    if not repaired_ids:
+        return
+    
+    # The output is rebuilt in chunk order once each task's chunks are done
+    try:
+        _process_queue(concurrency, stream, task_ids=repaired_ids)
+    except FatalAPIError as e:
+        console.print(f"[red]Stopping: the API rejected the request: {str(e)}[/red]")
+        console.print("[yellow]Claimed tasks keep their progress and will resume with process-tasks.[/yellow]")
+    _print_run_summary()
+
+@app.command()
+def serve(
+    inbox: str = typer.Option("inbox", envvar="INBOX_DIR", help="Directory to watch for new .md and .txt files"),
+    poll_interval: float = typer.Option(2.0, help="Seconds between scans of the inbox and the queue"),
+    chunk_size: int = typer.Option(800, help="Size of text chunks of new files"),
+    chunk_tokens: Optional[int] = typer.Option(None, help="Token budget per chunk of new files, overrides --chunk-size"),
+    tokenizer: str = typer.Option("approx", help="Token counter for --chunk-tokens: approx, or tiktoken when installed"),
+    memory_size: int = typer.Option(0, help="Number of previous Q&A pairs to include in the prompt of new files"),
+    memory_mode: MemoryMode = typer.Option(MemoryMode.ANSWERS, help="Build memory from earlier answers, from the source text of earlier chunks, or from a running summary plus the latest answers"),
+    memory_tokens: Optional[int] = typer.Option(None, help="Token budget of the memory of new files (default: no limit, 2000 in summary mode)"),
+    summary_interval: int = typer.Option(8, min=1, help="Chunks between refreshes of the running summary in summary mode"),
+    priority: int = typer.Option(0, help="Priority of new files"),
+    concurrency: int = typer.Option(4, help="Number of chunk requests to keep in flight across all tasks"),
+    schedule: str = typer.Option("fair", help="How workers are shared between tasks: fair (weighted by priority), srf (shortest remaining first) or fifo"),
+    no_cache: bool = typer.Option(False, "--no-cache", help="Always call the API instead of reusing cached responses"),
+    stream: bool = typer.Option(False, "--stream", help="Stream responses into per-chunk partial files as they arrive"),
+    metrics_file: Optional[str] = typer.Option(None, envvar="METRICS_FILE", help="Keep chunk, token and latency metrics in this file, in the Prometheus text format"),
+    shutdown_timeout: float = typer.Option(30.0, help="Seconds to let chunks in flight finish after SIGTERM or Ctrl+C"),
+    budget_tokens: Optional[int] = typer.Option(None, help="Tokens the session may use, it shuts down once they are spent"),
+    budget_cost: Optional[float] = typer.Option(None, help="Estimated cost the session may incur, it shuts down once it is reached"),
+    on_budget: str = typer.Option("slow", help="Once the projected spend exceeds the budget: slow (one request at a time), pause, or fallback"),
+    fallback_model: Optional[str] = typer.Option(None, envvar="FALLBACK_MODEL", help="Cheaper model for chunks of runs and tasks projected to exceed their budget"),
+    http_port: Optional[int] = typer.Option(None, envvar="HTTP_PORT", help="Serve the HTTP/JSON API of the queue on this port"),
+    http_host: str = typer.Option("127.0.0.1", help="Address of the HTTP API, keep it local unless the network is trusted")
+):
+    """Stay resident, queue files dropped into the inbox and process tasks as they arrive."""
+    import signal
+    import sys
+    from .api_client import FatalAPIError
+    from .inbox import InboxWatcher
+    from .metrics import MetricsRegistry
+    
+    _check_schedule(schedule)
+    # One budget for the whole session, a session that spent it shuts down
+    budget = _init_budget(budget_tokens, budget_cost, on_budget, fallback_model)
+    # One client for the whole session, its connections stay open between tasks
+    if not _init_api_client(no_cache, stream):
+        raise typer.Exit(1)
+    
+    watcher = InboxWatcher(inbox)
+    metrics = MetricsRegistry() if metrics_file else None
+    stop = threading.Event()
+    
+    def request_stop(signum, frame):
+        if stop.is_set():
+            console.print("[red]Exiting without waiting for the chunks in flight[/red]")
+            os._exit(1)
+        stop.set()
+        console.print(f"[yellow]Shutting down, waiting up to {shutdown_timeout:.0f}s for the chunks in flight (signal again to exit now)...[/yellow]")
+    
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, request_stop)
+    
+    def poll():
+        for path in watcher.scan():
+            try:
+                task = _create_task(
+                    str(path), f"rewritten_{path.stem}.md", chunk_size, chunk_tokens, tokenizer, memory_size, memory_mode,
+                    priority=priority, memory_tokens=memory_tokens, summary_interval=summary_interval
+                )
+            except Exception as e:
+                watcher.mark_failed(path, str(e))
+                console.print(f"[red]Could not add {path.name}: {str(e)}[/red]")
+                continue
+            watcher.mark_added(path)
+            console.print(f"[green]Added {path.name} as task {task.id} ({task.total_chunks} chunks)[/green]")
+    
+    server = None
+    if http_port is not None:
+        from .http_api import create_api_server
+        
+        def submit(filename: str, content: bytes, options: dict):
+            # Runs on a request thread, the processing loop claims the task on its next poll
+            settings = {
+                "output_file": f"rewritten_{Path(filename).stem}.md",
+                "chunk_size": chunk_size,
+                "chunk_tokens": chunk_tokens,
+                "tokenizer": tokenizer,
+                "memory_size": memory_size,
+                "memory_mode": memory_mode,
+                "memory_tokens": memory_tokens,
+                "summary_interval": summary_interval,
+                "priority": priority,
+                **options
+            }
+            task = _create_task(filename, content=content, **settings)
+            console.print(f"[green]Received {Path(filename).name} as task {task.id} ({task.total_chunks} chunks)[/green]")
+            return task
+        
+        server = create_api_server(queue_manager, submit, http_host, http_port)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        console.print(f"HTTP API listening on http://{http_host}:{server.server_address[1]}")
+    
+    console.print(f"Watching {watcher.inbox_dir} for new files, press Ctrl+C to stop")
+    abandoned = 0
+    try:
+        while not stop.is_set():
+            poll()
+            # Tasks added with add-task by other processes are picked up as well
+            if queue_manager.get_pending_tasks():
+                abandoned = _process_queue(
+                    concurrency,
+                    stream,
+                    metrics,
+                    metrics_file,
+                    poll=poll,
+                    poll_interval=poll_interval,
+                    stop=stop,
+                    shutdown_timeout=shutdown_timeout,
+                    schedule=schedule,
+                    budget=budget
+                )
+            stop.wait(poll_interval)
+    except FatalAPIError as e:
+        console.print(f"[red]Stopping: the API rejected the request: {str(e)}[/red]")
+        console.print("[yellow]Claimed tasks keep their progress and will resume on the next run.[/yellow]")
+        raise typer.Exit(1)
+    finally:
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+        _print_run_summary(budget)
+    
+    if abandoned:
+        # Worker threads still waiting for a response would keep the process alive
+        console.print(f"[yellow]Gave up on {abandoned} chunk(s) in flight, they are sent again on the next run[/yellow]")
+        sys.stdout.flush()
+        os._exit(0)
+    console.print("[green]Stopped[/green]")
+
+def _load_batch_task(task):
+    """Load the chunks and finished Q&A pairs of a task for batch submission or collection."""
+    from .memory import load_summaries
+    with open(queue_manager.file_manager.get_chunks_file(task.task_id), 'r', encoding='utf-8') as f:
+        chunks_data = json.load(f)
+    task.total_chunks = len(chunks_data)
+    journal = queue_manager.get_journal(task)
+    task.qa_pairs = journal.load_qa_pairs()
+    task.processed_chunks = len(task.qa_pairs)
+    task.memory_summaries = load_summaries(queue_manager.file_manager.get_memory_summaries_path(task.task_id))
+    return chunks_data, journal
+
+@app.command()
+def submit_batch():
+    """Send the pending chunks of all pending tasks to the provider's batch API."""
+    from .api_client import DeepSeekAPI
+    from .batch import BatchStore, BatchClient, make_request_line, chunk_custom_id
+    from .memory import chunk_dependencies, build_memory_context
+    from .models import BatchJob
+    from .prompts import build_messages
+    
+    api = DeepSeekAPI()
+    endpoint = api.pool.endpoints[0]
+    batch_store = BatchStore()
+    job = BatchJob(id=str(uuid.uuid4()), remote_id="", endpoint=endpoint.name, requests_file="")
+    job.requests_file = batch_store.requests_path(job.id)
+    
+    claimed_tasks = []
+    waiting_tasks = 0
+    with open(job.requests_file, 'w', encoding='utf-8') as f:
+        # The batch claims its tasks and chunks like a worker, so process-tasks leaves them alone
+        while True:
+            task = queue_manager.claim_task(job.worker_id)
+            if task is None:
+                break
+            chunks_data, _ = _load_batch_task(task)
+            done = {qa.chunk_index for qa in task.qa_pairs}
             
-            # Display task information
-            console.print(f"[bold cyan]Processing Task:[/bold cyan]")
-            console.print(f"Task ID: {task.id}")
-            console.print(f"Directory ID: {task.task_id}")
-            console.print(f"Input File: {Path(task.input_file).name}")
-            console.print(f"Output File: {Path(task.output_file).name}")
-            console.print(f"Total Chunks: {task.total_chunks}")
-            console.print(f"Processed Chunks: {task.processed_chunks}")
-            console.print(f"Memory Size: {task.memory_size}")
-            console.print(f"Output Path: {output_path}")
-            console.print(f"Q&A Path: {qa_json_path}")
-            if is_resuming:
-                console.print(f"[yellow]Resuming task from chunk {task.processed_chunks + 1}[/yellow]")
-            console.print("")
+            # Chunks that replay earlier answers go in a later wave, once those answers are collected
+            wave = [
+                chunk_data for chunk_data in chunks_data
+                if chunk_data["index"] not in done and all(dep in done for dep in chunk_dependencies(task, chunk_data["index"]))
+            ]
+            if not wave or not queue_manager.claim_chunks(task, [chunk_data["index"] for chunk_data in wave], job.worker_id):
+                queue_manager.update_task_status(task.id, TaskStatus.PENDING)
+                continue
+            if len(wave) + len(done) < len(chunks_data):
+                waiting_tasks += 1
             
-            with Progress(
-                SpinnerColumn(),
-                TextColumn("[progress.description]{task.description}"),
-                BarColumn(),
-                TaskProgressColumn(),
-                console=console
-            ) as progress:
-                task_progress = progress.add_task(
-                    f"Processing {Path(task.input_file).name} ({task.processed_chunks}/{task.total_chunks})", 
-                    total=task.total_chunks,
-                    completed=task.processed_chunks
+            for chunk_data in wave:
+                _refresh_summaries(api, task, chunk_data["index"])
+                memory_context = build_memory_context(task, chunk_data["index"], chunks_data)
+                messages = build_messages(chunk_data["content"], memory_context)
+                f.write(make_request_line(chunk_custom_id(task.id, chunk_data["index"]), endpoint.model, messages, api.max_tokens))
+                f.write("\n")
+            claimed_tasks.append(task)
+            job.task_ids.append(task.id)
+            job.request_count += len(wave)
+    
+    if not claimed_tasks:
+        Path(job.requests_file).unlink()
+        console.print("[yellow]No pending chunks to submit.[/yellow]")
+        return
+    
+    try:
+        job.remote_id = BatchClient(endpoint).submit(job.requests_file)
+    except Exception as e:
+        # Hand the tasks back so they can be submitted again or processed live
+        for task in claimed_tasks:
+            queue_manager.release_chunks(task, job.worker_id)
+            queue_manager.update_task_status(task.id, TaskStatus.PENDING)
+        console.print(f"[red]Error submitting batch: {str(e)}[/red]")
+        raise typer.Exit(1)
+    batch_store.save(job)
+    
+    console.print(f"[green]Submitted batch {job.id} ({job.request_count} chunk requests from {len(claimed_tasks)} task(s))[/green]")
+    console.print(f"Provider batch ID: {job.remote_id}")
+    if waiting_tasks:
+        console.print(f"[yellow]{waiting_tasks} task(s) have chunks that depend on answers in this batch, run submit-batch again after collect-batch for the next wave[/yellow]")
+
+@app.command()
+def collect_batch(
+    batch_id: Optional[str] = typer.Argument(None, help="Batch ID or prefix, all submitted batches by default"),
+    wait: bool = typer.Option(False, "--wait", help="Wait until the batches are finished"),
+    poll_interval: float = typer.Option(30.0, help="Seconds between status checks with --wait")
+):
+    """Write the results of finished batches back into their tasks."""
+    from .api_client import DeepSeekAPI
+    from .assembler import OutputAssembler
+    from .batch import BatchStore, BatchClient, FINAL_STATES, chunk_custom_id, parse_custom_id, iter_requests, iter_results
+    from .models import ChunkMetrics
+    from .prompts import prompt_hash, prompt_tokens_saved
+    
+    api = DeepSeekAPI()
+    batch_store = BatchStore()
+    jobs = batch_store.find_jobs_by_prefix(batch_id) if batch_id else batch_store.list_jobs(BatchStatus.SUBMITTED)
+    jobs = [job for job in jobs if job.status == BatchStatus.SUBMITTED]
+    if not jobs:
+        console.print("[yellow]No submitted batches to collect.[/yellow]")
+        return
+    
+    endpoints = {endpoint.name: endpoint for endpoint in api.pool.endpoints}
+    more_waves = False
+    for job in jobs:
+        client = BatchClient(endpoints.get(job.endpoint, api.pool.endpoints[0]))
+        remote = client.retrieve(job.remote_id)
+        while remote.status not in FINAL_STATES and wait:
+            time.sleep(poll_interval)
+            remote = client.retrieve(job.remote_id)
+        if remote.status not in FINAL_STATES:
+            console.print(f"[yellow]Batch {job.id} is still {remote.status}[/yellow]")
+            continue
+        
+        # Expired or cancelled batches can still carry results for part of their requests
+        job.results_file = batch_store.results_path(job.id)
+        Path(job.results_file).write_bytes(b"")
+        if remote.output_file_id:
+            client.download(remote.output_file_id, job.results_file)
+        if remote.error_file_id:
+            client.download(remote.error_file_id, job.results_file, append=True)
+        
+        results = {}
+        failed = 0
+        for custom_id, message, usage, error in iter_results(job.results_file):
+            if message is None:
+                failed += 1
+                console.print(f"[red]Request {custom_id} failed: {error}[/red]")
+                continue
+            results[parse_custom_id(custom_id)] = (message, usage or {})
+        
+        # The messages that were sent, for the prompt hash and the prompt tokens saved
+        sent_messages = dict(iter_requests(job.requests_file)) if Path(job.requests_file).exists() else {}
+        
+        for task_id in job.task_ids:
+            task = queue_manager.get_task(task_id)
+            if task is None:
+                continue
+            chunks_data, journal = _load_batch_task(task)
+            output_path = queue_manager.file_manager.get_output_path(task.task_id, Path(task.output_file).name)
+            # Results arrive in any order, the assembler writes them out in chunk order
+            assembler = OutputAssembler(output_path, task.qa_pairs)
+            assembler.write()
+            for chunk_data in chunks_data:
+                result = results.get((task.id, chunk_data["index"]))
+                if result is None or chunk_data["index"] in assembler:
+                    continue
+                message, usage = result
+                answer = message.get("content") or ""
+                details = usage.get("completion_tokens_details") or {}
+                messages = sent_messages.get(chunk_custom_id(task.id, chunk_data["index"]))
+                metrics = ChunkMetrics(
+                    source="batch",
+                    endpoint=job.endpoint,
+                    prompt_tokens=usage.get("prompt_tokens") or 0,
+                    completion_tokens=usage.get("completion_tokens") or 0,
+                    reasoning_tokens=details.get("reasoning_tokens") or 0,
+                    cached_prompt_tokens=usage.get("prompt_cache_hit_tokens") or (usage.get("prompt_tokens_details") or {}).get("cached_tokens") or 0,
+                    prompt_tokens_saved=prompt_tokens_saved(messages[1:-1]) if messages else 0
                 )
-                
-                # Process each chunk
-                for i, chunk_data in enumerate(chunks_data):
-                    content = chunk_data["content"]
-                    chunk_index = chunk_data["index"]
-                    char_count = chunk_data["char_count"]
-                    
-                    # Update progress description with current chunk information
-                    progress.update(
-                        task_progress, 
-                        description=f"Task {task.id} - Chunk {i+1}/{task.total_chunks} ({char_count} chars)"
-                    )
-                    
-                    # Skip if this chunk was already processed
-                    if any(qa.chunk_index == chunk_index for qa in task.qa_pairs):
-                        progress.update(task_progress, advance=1)
-                        continue
-                    
-                    # Get memory context if needed
-                    memory_context = []
-                    if task.memory_size > 0:
-                        # Get previous Q&A pairs for context
-                        start_idx = max(0, i - task.memory_size)
-                        memory_pairs = task.qa_pairs[start_idx:i]
-                        if memory_pairs:
-                            # Convert Q&A pairs to message format
-                            for qa in memory_pairs:
-                                memory_context.append({"role": "user", "content": qa.question})
-                                memory_context.append({"role": "assistant", "content": qa.answer})
-                    
-                    try:
-                        # Generate response
-                        response = api_client.generate_response(content, memory_context)
-                        
-                        # Get the content and reasoning from the response
-                        answer = response.get("content", "")
-                        reasoning = response.get("reasoning_content")
-                        
-                        # Create Q&A pair with the formatted prompt as question
-                        formatted_prompt = f"Act as a professional technical editor working on a mathematics/physics textbook manuscript. Following is a draft, rewrite it into more understsabdable and fluent format, do not ignore any math formulas, clarify missing logics if needed.\n\n{content}"
-                        qa_pair = QAPair(
-                            question=formatted_prompt,
-                            answer=answer,
-                            reasoning_content=reasoning,
-                            chunk_index=chunk_index,
-                            char_count=char_count
-                        )
-                        
-                        # Add the Q&A pair to the task
-                        task.qa_pairs.append(qa_pair)
-                        task.processed_chunks += 1
-                        
-                        # Save Q&A pairs after each chunk is processed
-                        with open(qa_json_path, 'w', encoding='utf-8') as f:
-                            json.dump([qa.model_dump() for qa in task.qa_pairs], f, ensure_ascii=False, indent=2)
-                        
-                        # Append the rewritten content to the output file in real-time
-                        with open(output_path, 'a', encoding='utf-8') as f:
-                            f.write(answer)
-                            f.write("\n\n")
-                    except Exception as e:
-                        console.print(f"[red]Error processing chunk {i+1}: {str(e)}[/red]")
-                        # Create a placeholder Q&A pair for this chunk
-                        qa_pair = QAPair(
-                            question=content,
-                            answer=f"[Error: {str(e)}]",
-                            reasoning_content=f"Error processing chunk: {str(e)}",
-                            chunk_index=chunk_index,
-                            char_count=char_count
-                        )
-                        task.qa_pairs.append(qa_pair)
-                        task.processed_chunks += 1
-                        
-                        # Save Q&A pairs after each chunk is processed
-                        with open(qa_json_path, 'w', encoding='utf-8') as f:
-                            json.dump([qa.model_dump() for qa in task.qa_pairs], f, ensure_ascii=False, indent=2)
-                        
-                        # Append the error message to the output file
-                        with open(output_path, 'a', encoding='utf-8') as f:
-                            f.write(f"[Error processing chunk: {str(e)}]")
-                            f.write("\n\n")
-                    
-                    progress.update(task_progress, advance=1)
-                    
-                    # Save task status
-                    queue_manager._save_tasks()
-
-            queue_manager.update_task_status(task.id, TaskStatus.COMPLETED)
-            console.print(f"[green]Task {task.id} completed successfully![/green]")
-            console.print(f"Output saved to: {output_path}")
-            console.print(f"Q&A pairs saved to: {qa_json_path}")
+                qa_pair = _make_qa_pair(
+                    chunk_data, answer, message.get("reasoning_content"), metrics, prompt_hash(messages) if messages else None
+                )
+                _commit_chunk(task, qa_pair, journal, assembler)
             
-        except Exception as e:
-            queue_manager.update_task_status(task.id, TaskStatus.FAILED, str(e))
-            console.print(f"[red]Task {task.id} failed: {str(e)}[/red]")
+            queue_manager.release_chunks(task, job.worker_id)
+            if task.processed_chunks >= task.total_chunks:
+                journal.compact(task.qa_pairs)
+                assembler.write(complete=True)
+                _mark_completed(task, task.qa_pairs)
+                console.print(f"[green]Task {task.id} completed successfully![/green]")
+                console.print(f"Output saved to: {output_path}")
+            else:
+                queue_manager.update_task_status(task.id, TaskStatus.PENDING)
+                console.print(f"Task {task.id}: {task.processed_chunks}/{task.total_chunks} chunks")
+                more_waves = True
+        
+        job.status = BatchStatus.COLLECTED
+        job.collected_at = datetime.now()
+        batch_store.save(job)
+        console.print(f"[green]Collected batch {job.id} ({remote.status}): {len(results)} result(s), {failed} failed[/green]")
+    
+    if more_waves:
+        console.print("[yellow]Some tasks have chunks left, run submit-batch for the next wave or process-tasks to finish them live[/yellow]")
+
+def _mock_config(latency_ms: float, latency_dist: str, error_rate: float, rate_limit_rate: float, batch_delay: float = 0.0) -> MockConfig:
+    from .mock_server import LATENCY_DISTRIBUTIONS, MockConfig
+    if latency_dist not in LATENCY_DISTRIBUTIONS:
+        console.print(f"[red]Unknown latency distribution '{latency_dist}', use one of: {', '.join(LATENCY_DISTRIBUTIONS)}[/red]")
+        raise typer.Exit(1)
+    return MockConfig(
+        latency_ms=latency_ms,
+        latency_dist=latency_dist,
+        error_rate=error_rate,
+        rate_limit_rate=rate_limit_rate,
+        batch_delay=batch_delay
+    )
+
+@app.command()
+def mock_server(
+    port: int = typer.Option(8765, help="Port to listen on"),
+    latency_ms: float = typer.Option(0.0, help="Median latency of a chat completion in milliseconds"),
+    latency_dist: str = typer.Option("fixed", help="Latency distribution: fixed, uniform, exponential or lognormal"),
+    error_rate: float = typer.Option(0.0, help="Share of requests answered with a 500"),
+    rate_limit_rate: float = typer.Option(0.0, help="Share of requests answered with a 429"),
+    batch_delay: float = typer.Option(0.0, help="Seconds before a batch completes")
+):
+    """Run a local OpenAI-compatible mock server for offline runs (set BASE_URL to http://127.0.0.1:PORT/v1)."""
+    from .mock_server import create_server
+    server = create_server(port=port, config=_mock_config(latency_ms, latency_dist, error_rate, rate_limit_rate, batch_delay))
+    console.print(f"[green]Mock server listening on http://127.0.0.1:{port}/v1[/green]")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+@app.command()
+def benchmark(
+    chunks: str = typer.Option("10,100,1000", help="Comma-separated document sizes in chunks, e.g. 10,100,1000,10000"),
+    concurrency: int = typer.Option(8, help="--concurrency of process-tasks"),
+    chunk_size: int = typer.Option(800, help="--chunk-size of add-task"),
+    latency_ms: float = typer.Option(50.0, help="Median latency of the mock server in milliseconds"),
+    latency_dist: str = typer.Option("lognormal", help="Latency distribution: fixed, uniform, exponential or lognormal"),
+    error_rate: float = typer.Option(0.0, help="Share of requests answered with a 500"),
+    rate_limit_rate: float = typer.Option(0.0, help="Share of requests answered with a 429"),
+    stream: bool = typer.Option(False, "--stream", help="Run process-tasks with --stream"),
+    keep: bool = typer.Option(False, "--keep", help="Keep the working directories for inspection")
+):
+    """Measure add-task and process-tasks end to end on synthetic documents against the mock server."""
+    from .benchmark import run_benchmark
+    sizes = [int(size) for size in chunks.split(",") if size.strip()]
+    config = _mock_config(latency_ms, latency_dist, error_rate, rate_limit_rate)
+    console.print(f"Benchmarking {', '.join(map(str, sizes))} chunk(s) at concurrency {concurrency}, {latency_dist} latency around {latency_ms:.0f} ms")
+    results = run_benchmark(sizes, concurrency=concurrency, chunk_size=chunk_size, stream=stream, config=config, keep=keep)
+    
+    def ms(seconds: Optional[float]) -> str:
+        return f"{seconds * 1000:.0f}" if seconds is not None else "N/A"
+    
+    table = Table(title="Benchmark")
+    table.add_column("Chunks", justify="right")
+    table.add_column("add-task s", justify="right")
+    table.add_column("process-tasks s", justify="right")
+    table.add_column("Chunks/s", justify="right", style="green")
+    table.add_column("p50 ms", justify="right")
+    table.add_column("p95 ms", justify="right")
+    table.add_column("p99 ms", justify="right")
+    table.add_column("Requests", justify="right")
+    table.add_column("Written MB", justify="right")
+    table.add_column("Peak RSS MB", justify="right")
+    for result in results:
+        table.add_row(
+            str(result["chunks"]),
+            f"{result['add_seconds']:.2f}",
+            f"{result['process_seconds']:.2f}",
+            f"{result['chunks_per_second']:.1f}",
+            ms(result["p50"]),
+            ms(result["p95"]),
+            ms(result["p99"]),
+            f"{result['requests']} ({result['errors']} 5xx, {result['rate_limited']} 429)",
+            f"{result['bytes_written'] / 1024 / 1024:.2f}",
+            f"{result['peak_rss'] / 1024 / 1024:.0f}" if result["peak_rss"] else "N/A"
+        )
+    console.print(table)
+    console.print("Latency is that of the request that answered each chunk, as recorded by process-tasks; peak RSS is that of process-tasks.")
+    if stream:
+        console.print("Time to first token p50: " + ", ".join(f"{result['chunks']} chunks {ms(result['ttft_p50'])} ms" for result in results))
+    for result in results:
+        if result["workdir"]:
+            console.print(f"Working directory for {result['chunks']} chunks: {result['workdir']}")
+
+@app.command()
+def benchmark_startup(
+    tasks: int = typer.Option(5000, help="Number of tasks in the queue"),
+    runs: int = typer.Option(5, help="Runs of each command")
+):
+    """Time the start-up of list-tasks, show-task and --help against a large queue."""
+    from .benchmark import run_startup_benchmark
+    console.print(f"Timing CLI start-up with {tasks} task(s) in the queue, {runs} run(s) per command")
+    table = Table(title="Start-up")
+    table.add_column("Command")
+    table.add_column("Median ms", justify="right", style="green")
+    table.add_column("Fastest ms", justify="right")
+    for result in run_startup_benchmark(tasks, runs):
+        table.add_row(result["command"], f"{result['median'] * 1000:.0f}", f"{result['min'] * 1000:.0f}")
+    console.print(table)
 
 @app.command()
-def show_task(task_id: str):
+def stats(
+    task_id: str,
+    top: int = typer.Option(5, help="Number of slowest chunks to list")
+):
+    """Show where the time and tokens of a task went: throughput, cost estimate and slowest chunks."""
+    from .metrics import summarize
+    task = _find_task(task_id)
+    if not task:
+        console.print(f"[red]Task with ID {task_id} not found.[/red]")
+        raise typer.Exit(1)
+    
+    summary = summarize(queue_manager.get_journal(task).load_qa_pairs(), top=top)
+    
+    def seconds(value: Optional[float]) -> str:
+        return f"{value:.2f} s" if value is not None else "N/A"
+    
+    console.print(f"[bold]Task {task.id}[/bold] ({Path(task.input_file).name}, {task.status.value})")
+    console.print(f"Chunks: {summary['chunks']}/{task.total_chunks}, {summary['measured']} with metrics")
+    if summary["sources"]:
+        console.print("Answered by: " + ", ".join(f"{source} {count}" for source, count in sorted(summary["sources"].items())))
+    console.print(
+        f"Tokens: {summary['prompt_tokens']} prompt, {summary['completion_tokens']} completion "
+        f"({summary['reasoning_tokens']} reasoning)"
+    )
+    if summary["prompt_tokens_saved"] or summary["cached_prompt_tokens"]:
+        # Savings are estimated against the earlier layout that repeated the instructions in every message
+        sent_and_saved = summary["prompt_tokens"] + summary["prompt_tokens_saved"]
+        console.print(
+            f"Prompt tokens saved by sending the instructions once: ~{summary['prompt_tokens_saved']} "
+            f"({summary['prompt_tokens_saved'] / sent_and_saved:.0%}), served from the provider's prompt cache: {summary['cached_prompt_tokens']}"
+        )
+    console.print(f"Estimated cost: {summary['cost']:.4f} (INPUT_PRICE / OUTPUT_PRICE per million tokens)")
+    console.print(f"Retries: {summary['retries']}, hedged chunks: {summary['hedged']}")
+    console.print(
+        f"Request latency: p50 {seconds(summary['latency_p50'])}, p95 {seconds(summary['latency_p95'])}, "
+        f"max {seconds(summary['latency_max'])}"
+    )
+    if summary["ttft_p50"] is not None:
+        console.print(f"Time to first token: p50 {seconds(summary['ttft_p50'])}, p95 {seconds(summary['ttft_p95'])}")
+    console.print(
+        f"Queue wait: p50 {seconds(summary['queue_wait_p50'])}, p95 {seconds(summary['queue_wait_p95'])}, "
+        f"rate limiter wait: {summary['throttle_wait']:.2f} s in total"
+    )
+    if summary["wall_seconds"]:
+        console.print(
+            f"Throughput: {summary['chunks_per_minute']:.1f} chunks/min, {summary['tokens_per_second']:.1f} completion tokens/s "
+            f"over {summary['wall_seconds']:.1f} s"
+        )
+    
+    if summary["slowest"]:
+        table = Table(title="Slowest chunks", show_header=True, header_style="bold magenta")
+        table.add_column("Chunk", justify="right")
+        table.add_column("Elapsed", justify="right")
+        table.add_column("Latency", justify="right")
+        table.add_column("Queue wait", justify="right")
+        table.add_column("Retries", justify="right")
+        table.add_column("Tokens", justify="right")
+        table.add_column("Source")
+        for qa in summary["slowest"]:
+            m = qa.metrics
+            table.add_row(
+                str(qa.chunk_index + 1),
+                seconds(m.elapsed),
+                seconds(m.latency),
+                seconds(m.queue_wait),
+                str(m.retries),
+                f"{m.prompt_tokens}+{m.completion_tokens}",
+                m.endpoint or m.source
+            )
+        console.print(table)
+
+@app.command()
+def show_task(
+    task_id: str,
+    qa: bool = typer.Option(False, "--qa", help="Also load the Q&A pairs and preview them")
+):
     """Show detailed information about a specific task."""
     task = queue_manager.get_task(task_id)
     if not task:
@@ -322,25 +1631,44 @@ def show_task(task_id: str):
     console.print(f"Input File: {task.input_file}")
     console.print(f"Output File: {task.output_file}")
     console.print(f"Progress: {task.processed_chunks}/{task.total_chunks} chunks")
+    if task.failed_chunks:
+        console.print(f"Failed Chunks: {task.failed_chunks}")
     console.print(f"Chunk Size: {task.chunk_size}")
     console.print(f"Memory Size: {task.memory_size}")
+    if task.budget_tokens is not None or task.budget_cost is not None:
+        console.print(f"Budget: {_format_budget(task.budget_tokens, task.budget_cost)}")
     
     if task.error_message:
         console.print(f"[red]Error: {task.error_message}[/red]")
     
-    # Show Q&A pairs
+    # Q&A pairs are only loaded on request, they can be large
+    if not qa and task.processed_chunks:
+        console.print(f"\n{task.processed_chunks} Q&A pair(s), pass --qa to preview them")
+    journal = queue_manager.get_journal(task)
+    task.qa_pairs = journal.load_qa_pairs() if qa else []
     if task.qa_pairs:
+        # Questions refer to the chunk text in chunks.json
+        chunks_data = journal.load_chunks()
         console.print(f"\n[bold]Q&A Pairs:[/bold]")
         for i, qa in enumerate(task.qa_pairs):
             console.print(f"\n[bold]Chunk {i+1}:[/bold]")
             console.print(f"Character Count: {qa.char_count}")
+            if qa.error:
+                console.print(f"[red]Failed: {qa.error}[/red]")
             
             # Show a preview of the content
-            question_preview = qa.question[:100] + "..." if len(qa.question) > 100 else qa.question
+            question = journal.load_question(qa, chunks_data)
+            question_preview = question[:100] + "..." if len(question) > 100 else question
             console.print(f"Question Preview: {question_preview}")
+            
+            # Reasoning is kept compressed in the blob store, only read now that it is shown
+            reasoning = qa.reasoning_content or journal.load_reasoning(qa.reasoning_blob)
+            if reasoning:
+                reasoning_preview = reasoning[:100] + "..." if len(reasoning) > 100 else reasoning
+                console.print(f"Reasoning Preview: {reasoning_preview}")
     
     # Show directory structure
-    task_dir = queue_manager.get_task_directory(task_id)
+    task_dir = queue_manager.file_manager.get_task_directory(task.task_id)
     if task_dir:
         console.print(f"\n[bold]Directory Structure:[/bold]")
         console.print(f"Base Directory: {task_dir}")
@@ -351,11 +1679,69 @@ def show_task(task_id: str):
         for file in files:
             console.print(f"  - {file.name}")
 
+@app.command()
+def cancel_task(task_id_prefix: str):
+    """Cancel a task using the first digits of its ID, a worker processing it stops after the chunks in flight."""
+    matching_tasks = queue_manager.find_tasks_by_prefix(task_id_prefix)
+    if not matching_tasks:
+        console.print(f"[red]No tasks found with ID prefix '{task_id_prefix}'[/red]")
+        raise typer.Exit(1)
+    if len(matching_tasks) > 1:
+        console.print(f"[red]ID prefix '{task_id_prefix}' matches {len(matching_tasks)} tasks, use a longer prefix[/red]")
+        raise typer.Exit(1)
+    
+    task = queue_manager.cancel_task(matching_tasks[0].id)
+    if task.status != TaskStatus.CANCELLED:
+        console.print(f"[yellow]Task {task.id} is already {task.status.value}[/yellow]")
+        return
+    console.print(f"[green]Task {task.id} cancelled at {task.processed_chunks}/{task.total_chunks} chunks[/green]")
+
+@app.command()
+def set_budget(
+    task_id_prefix: str,
+    tokens: Optional[int] = typer.Option(None, help="Tokens the task may use in total, unlimited if left out"),
+    cost: Optional[float] = typer.Option(None, help="Estimated cost the task may incur in total, unlimited if left out")
+):
+    """Change the budget of a task, a task paused by its budget is queued again."""
+    matching_tasks = queue_manager.find_tasks_by_prefix(task_id_prefix)
+    if not matching_tasks:
+        console.print(f"[red]No tasks found with ID prefix '{task_id_prefix}'[/red]")
+        raise typer.Exit(1)
+    if len(matching_tasks) > 1:
+        console.print(f"[red]ID prefix '{task_id_prefix}' matches {len(matching_tasks)} tasks, use a longer prefix[/red]")
+        raise typer.Exit(1)
+    
+    resumed = matching_tasks[0].status == TaskStatus.PAUSED
+    task = queue_manager.set_task_budget(matching_tasks[0].id, tokens, cost)
+    console.print(f"[green]Budget of task {task.id}: {_format_budget(tokens, cost)}[/green]")
+    if resumed:
+        console.print(f"[green]Task queued again at {task.processed_chunks}/{task.total_chunks} chunks[/green]")
+
+@app.command()
+def gc(
+    min_age: float = typer.Option(3600.0, help="Seconds a blob is kept after it was written, so tasks being added keep theirs"),
+    dry_run: bool = typer.Option(False, "--dry-run", help="Only report what would be removed")
+):
+    """Remove stored inputs, chunks and reasoning that no task refers to any more, e.g. after delete-task."""
+    from .journal import TaskJournal
+    
+    file_manager = queue_manager.file_manager
+    # Reasoning blobs are referenced from the Q&A pairs of every task directory, raw blobs by their links
+    referenced = set()
+    for task_dir_id in file_manager.list_tasks():
+        for qa in TaskJournal(file_manager, task_dir_id).load_qa_pairs():
+            if qa.reasoning_blob:
+                referenced.add(qa.reasoning_blob)
+    
+    removed, size = file_manager.blobs.gc(referenced, min_age=min_age, dry_run=dry_run)
+    verb = "Would remove" if dry_run else "Removed"
+    console.print(f"[green]{verb} {removed} blob(s), {size / 1024 / 1024:.2f} MB[/green]")
+
 @app.command()
 def delete_task(task_id_prefix: str):
     """Delete a task using the first 6 digits of its ID."""
     # Find tasks that match the prefix
-    matching_tasks = [task for task in queue_manager.tasks if task.id.startswith(task_id_prefix)]
+    matching_tasks = queue_manager.find_tasks_by_prefix(task_id_prefix)
     
     if not matching_tasks:
         console.print(f"[red]No tasks found with ID prefix '{task_id_prefix}'[/red]")
@@ -385,16 +1771,13 @@ def delete_task(task_id_prefix: str):
             # Delete the task directory
             task_dir = Path(queue_manager.file_manager.base_dir) / task.task_id
             if task_dir.exists():
-                import shutil
                 shutil.rmtree(task_dir)
                 console.print(f"[green]Deleted task directory: {task_dir}[/green]")
             
             # Remove the task from the queue
-            queue_manager.tasks.remove(task)
+            queue_manager.delete_task(task)
             console.print(f"[green]Removed task {task.id} from queue[/green]")
         
-        # Save the updated queue
-        queue_manager._save_tasks()
         console.print(f"[green]Successfully deleted {len(matching_tasks)} task(s)[/green]")
     else:
         console.print("[yellow]Deletion cancelled[/yellow]")
@@ -0,0 +1,241 @@
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from typing import List, Optional
+from openai import OpenAI
+from pydantic import BaseModel
+from .rate_limiter import AdaptiveRateLimiter
+
+LEAST_OUTSTANDING = "least_outstanding"
+WEIGHTED_ROUND_ROBIN = "weighted_round_robin"
+
+class EndpointConfig(BaseModel):
+    name: str
+    base_url: str = "https://api.deepseek.com/v1"
+    api_key: Optional[str] = None
+    api_key_env: Optional[str] = None  # Read the key from this environment variable instead
+    model: str
+    weight: float = 1.0
+    rpm_limit: Optional[float] = None
+    tpm_limit: Optional[float] = None
+    timeout: float = 300.0  # Seconds per request, also bounds how long a fatal error waits for calls in flight
+
+class PoolConfig(BaseModel):
+    strategy: str = LEAST_OUTSTANDING
+    endpoints: List[EndpointConfig]
+
+class CircuitBreaker:
+    """
+    Take an endpoint out of rotation after repeated failures.
+
+    After FAILURE_THRESHOLD consecutive failures the breaker opens for
+    OPEN_SECONDS, doubling on every failed trial up to MAX_OPEN_SECONDS.
+    Once the time is up a single trial request is let through (half-open),
+    and its success closes the breaker again. Errors that no request can
+    recover from, such as a rejected key, disable the endpoint for the run.
+    """
+
+    FAILURE_THRESHOLD = 5
+    OPEN_SECONDS = 30.0
+    MAX_OPEN_SECONDS = 600.0
+
+    def __init__(self):
+        self.failures = 0
+        self.open_seconds = self.OPEN_SECONDS
+        self.open_until = 0.0
+        self.trial_in_flight = False
+        self.disabled_reason: Optional[str] = None
+
+    @property
+    def state(self) -> str:
+        if self.disabled_reason:
+            return "disabled"
+        if self.failures >= self.FAILURE_THRESHOLD:
+            return "half-open" if time.monotonic() >= self.open_until else "open"
+        return "closed"
+
+    def available(self) -> bool:
+        state = self.state
+        return state == "closed" or (state == "half-open" and not self.trial_in_flight)
+
+    def on_selected(self):
+        if self.state == "half-open":
+            self.trial_in_flight = True
+
+    def record_success(self):
+        self.failures = 0
+        self.open_seconds = self.OPEN_SECONDS
+        self.trial_in_flight = False
+
+    def record_failure(self):
+        if self.trial_in_flight:
+            # The trial failed, stay open for longer
+            self.trial_in_flight = False
+            self.open_seconds = min(self.MAX_OPEN_SECONDS, self.open_seconds * 2)
+            self.open_until = time.monotonic() + self.open_seconds
+            return
+        self.failures += 1
+        if self.failures == self.FAILURE_THRESHOLD:
+            self.open_until = time.monotonic() + self.open_seconds
+
+    def record_neutral(self):
+        """The request failed for a reason unrelated to the endpoint's health."""
+        self.trial_in_flight = False
+
+    def disable(self, reason: str):
+        self.disabled_reason = reason
+        self.trial_in_flight = False
+
+class Endpoint:
+    """One OpenAI-compatible endpoint and key, with its own limiter and breaker."""
+
+    def __init__(self, config: EndpointConfig):
+        api_key = config.api_key or (os.getenv(config.api_key_env) if config.api_key_env else None)
+        if not api_key:
+            raise ValueError(f"No API key for endpoint {config.name}")
+        self.name = config.name
+        self.model = config.model
+        self.weight = config.weight
+        # Retries are handled by the caller, so that they go through the rate limiter
+        self.client = OpenAI(api_key=api_key, base_url=config.base_url, max_retries=0, timeout=config.timeout)
+        self.rate_limiter = AdaptiveRateLimiter(rpm=config.rpm_limit, tpm=config.tpm_limit)
+        self.breaker = CircuitBreaker()
+        self.outstanding = 0
+        self.requests = 0
+        self.failures = 0
+        self.current_weight = 0.0  # For smooth weighted round-robin
+
+class EndpointPool:
+    """
+    Spread requests over several endpoints and keys.
+
+    The least_outstanding strategy picks the endpoint with the fewest
+    requests in flight relative to its weight; requests waiting in an
+    endpoint's rate limiter count as in flight, so a throttled key is
+    naturally passed over. weighted_round_robin picks endpoints in
+    proportion to their weights. Endpoints whose circuit breaker is open
+    are skipped until their trial time comes.
+    """
+
+    def __init__(self, endpoints: List[Endpoint], strategy: str = LEAST_OUTSTANDING):
+        if not endpoints:
+            raise ValueError("At least one endpoint is required")
+        if strategy not in (LEAST_OUTSTANDING, WEIGHTED_ROUND_ROBIN):
+            raise ValueError(f"Unknown load balancing strategy: {strategy}")
+        self.endpoints = endpoints
+        self.strategy = strategy
+        self._condition = threading.Condition()
+
+    @classmethod
+    def from_env(cls) -> "EndpointPool":
+        """
+        Build the pool from ENDPOINTS_FILE (default endpoints.json) if it exists,
+        otherwise from a single endpoint in API_KEY, BASE_URL and MODEL_NAME.
+        """
+        endpoints_file = os.getenv("ENDPOINTS_FILE", "endpoints.json")
+        if Path(endpoints_file).exists():
+            return cls.from_file(endpoints_file)
+
+        api_key = os.getenv("API_KEY")
+        if not api_key:
+            raise ValueError("API_KEY environment variable is not set")
+        model = os.getenv("MODEL_NAME")
+        if not model:
+            raise ValueError("MODEL_NAME environment variable is not set")
+        rpm = os.getenv("RPM_LIMIT")
+        tpm = os.getenv("TPM_LIMIT")
+        timeout = os.getenv("REQUEST_TIMEOUT")
+        config = EndpointConfig(
+            name="default",
+            base_url=os.getenv("BASE_URL", "https://api.deepseek.com/v1"),
+            api_key=api_key,
+            model=model,
+            rpm_limit=float(rpm) if rpm else None,
+            tpm_limit=float(tpm) if tpm else None,
+            timeout=float(timeout) if timeout else EndpointConfig.model_fields["timeout"].default
+        )
+        return cls([Endpoint(config)])
+
+    @classmethod
+    def from_file(cls, path: str) -> "EndpointPool":
+        """Build the pool from a JSON config file."""
+        with open(path, 'r', encoding='utf-8') as f:
+            config = PoolConfig(**json.load(f))
+        return cls([Endpoint(endpoint) for endpoint in config.endpoints], config.strategy)
+
+    def acquire(self, avoid: Optional[Endpoint] = None) -> Optional[Endpoint]:
+        """
+        Pick an endpoint for a request and count it as in flight.
+
+        Waits while every endpoint's breaker is open. `avoid` is passed over
+        if any other endpoint is available, so that a retry goes elsewhere.
+
+        Returns:
+            The endpoint, or None if every endpoint is disabled
+        """
+        with self._condition:
+            while True:
+                candidates = [endpoint for endpoint in self.endpoints if endpoint.breaker.available()]
+                if len(candidates) > 1 and avoid in candidates:
+                    candidates.remove(avoid)
+                if candidates:
+                    endpoint = self._pick(candidates)
+                    endpoint.breaker.on_selected()
+                    endpoint.outstanding += 1
+                    endpoint.requests += 1
+                    return endpoint
+                if self.all_disabled():
+                    return None
+                # Sleep until the next breaker allows a trial, or a request finishes
+                reopen = min(
+                    (endpoint.breaker.open_until for endpoint in self.endpoints if endpoint.breaker.state == "open"),
+                    default=time.monotonic() + 1.0
+                )
+                self._condition.wait(timeout=max(0.05, reopen - time.monotonic()))
+
+    def _pick(self, candidates: List[Endpoint]) -> Endpoint:
+        if self.strategy == WEIGHTED_ROUND_ROBIN:
+            # Smooth weighted round-robin, spreads picks evenly instead of in bursts
+            total = sum(endpoint.weight for endpoint in candidates)
+            for endpoint in candidates:
+                endpoint.current_weight += endpoint.weight
+            chosen = max(candidates, key=lambda endpoint: endpoint.current_weight)
+            chosen.current_weight -= total
+            return chosen
+        return min(candidates, key=lambda endpoint: (endpoint.outstanding + 1) / endpoint.weight)
+
+    def release(self, endpoint: Endpoint, outcome: str, reason: Optional[str] = None):
+        """
+        Return an endpoint after a request.
+
+        Args:
+            endpoint: The endpoint that served the request
+            outcome: "success", "failure" (counts towards the breaker),
+                "neutral" (rate limited, or the request itself was bad) or
+                "disabled" (the endpoint rejected the key or model)
+            reason: Why the endpoint was disabled
+        """
+        with self._condition:
+            endpoint.outstanding -= 1
+            if outcome == "success":
+                endpoint.breaker.record_success()
+            elif outcome == "failure":
+                endpoint.failures += 1
+                endpoint.breaker.record_failure()
+            elif outcome == "disabled":
+                endpoint.failures += 1
+                endpoint.breaker.disable(reason or "rejected")
+            else:
+                endpoint.breaker.record_neutral()
+            self._condition.notify_all()
+
+    def has_alternative(self, endpoint: Endpoint) -> bool:
+        """Whether another endpoint could take a retry right away."""
+        with self._condition:
+            return any(other is not endpoint and other.breaker.available() for other in self.endpoints)
+
+    def all_disabled(self) -> bool:
+        """Whether every endpoint has rejected its key or model."""
+        return all(endpoint.breaker.state == "disabled" for endpoint in self.endpoints)
@@ -0,0 +1,20 @@
+from enum import Enum
+
+# Kept apart from the pydantic models, so commands that only read the queue start without importing pydantic
+
+class TaskStatus(str, Enum):
+    PENDING = "pending"
+    PROCESSING = "processing"
+    COMPLETED = "completed"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+    PAUSED = "paused"  # Reached its budget, resumes once the budget is raised
+
+class MemoryMode(str, Enum):
+    ANSWERS = "answers"  # Replay earlier questions and answers
+    SOURCE = "source"    # Use the original text of earlier chunks
+    SUMMARY = "summary"  # A running summary of earlier answers plus the latest answers
+
+class BatchStatus(str, Enum):
+    SUBMITTED = "submitted"  # Waiting for the provider to finish
+    COLLECTED = "collected"  # Results written back to the tasks
@@ -1,18 +1,23 @@
 import os
-import shutil
 from pathlib import Path
 from typing import Tuple, Optional
 import uuid
+from .blobs import BlobStore
+
+# Directory of the blob store inside the base directory, next to the task directories
+BLOBS_DIR = "blobs"
 
 class FileManager:
     def __init__(self, base_dir: str = None):
         """Initialize the file manager with a base directory for all data."""
         self.base_dir = Path(base_dir or os.getenv("OUTPUT_DIR", "output"))
         self.base_dir.mkdir(exist_ok=True)
+        # Inputs and chunks are linked from here, so identical ones are stored once
+        self.blobs = BlobStore(self.base_dir / BLOBS_DIR)
         
-    def create_task_directory(self, input_file_path: str) -> Tuple[str, str, str]:
+    def create_task_directory(self, input_file_path: str) -> Tuple[str, str, str, str]:
         """
-        Create a directory for a task and copy the input file.
+        Create a directory for a task and link the input file into it from the blob store.
         
         Args:
             input_file_path: Path to the input file
@@ -20,8 +25,9 @@ class FileManager:
         Returns:
             Tuple containing:
             - task_id: Unique identifier for the task
-            - input_file_path: Path to the copied input file
-            - input_file_name: Name of the copied input file
+            - input_file_path: Path to the task's copy of the input file
+            - input_file_name: Name of the input file
+            - input_hash: SHA-256 of the input file
         """
         # Generate a unique task ID
         task_id = str(uuid.uuid4())
@@ -30,12 +36,54 @@ class FileManager:
         task_dir = self.base_dir / task_id
         task_dir.mkdir(exist_ok=True)
         
-        # Copy the input file to the task directory
+        # Store the input file once and link it into the task directory
         input_path = Path(input_file_path)
         input_file_name = input_path.name
-        shutil.copy2(input_path, task_dir / input_file_name)
+        input_hash = self.blobs.store_file(str(input_path), str(task_dir / input_file_name))
+        
+        return task_id, str(task_dir / input_file_name), input_file_name, input_hash
+    
+    def create_task_directory_from_content(self, input_file_name: str, content: bytes) -> Tuple[str, str, str, str]:
+        """
+        Create a directory for a task and write an uploaded input file into it.
+        
+        Returns:
+            Same as create_task_directory
+        """
+        task_id = str(uuid.uuid4())
+        task_dir = self.base_dir / task_id
+        task_dir.mkdir(exist_ok=True)
+        
+        # Only the name is kept, an uploaded name cannot point outside the task directory
+        input_file_name = Path(input_file_name).name
+        if input_file_name in ("", ".", ".."):
+            input_file_name = "input.md"
+        tmp_path = task_dir / f".{input_file_name}.upload"
+        with open(tmp_path, 'wb') as f:
+            f.write(content)
+        input_hash = self.blobs.store_file(str(tmp_path), str(task_dir / input_file_name), move=True)
         
-        return task_id, str(task_dir / input_file_name), input_file_name
+        return task_id, str(task_dir / input_file_name), input_file_name, input_hash
+    
+    def replace_input_file(self, task_id: str, new_input_path: str, old_input_path: Optional[str] = None) -> Tuple[str, str]:
+        """
+        Link an edited input file into the task directory in place of the old one.
+        
+        The old file is replaced, not written over, since other tasks may link to the same blob.
+        
+        Returns:
+            Tuple of the path to the task's copy of the input file and its SHA-256
+        """
+        task_dir = self.base_dir / task_id
+        new_path = Path(new_input_path)
+        target = task_dir / new_path.name
+        input_hash = self.blobs.store_file(str(new_path), str(target))
+        
+        # Remove the previous copy if the edited file has a different name
+        if old_input_path and Path(old_input_path).exists() and Path(old_input_path).resolve() != target.resolve():
+            Path(old_input_path).unlink()
+        
+        return str(target), input_hash
     
     def get_output_path(self, task_id: str, output_file_name: str) -> str:
         """Get the path for an output file."""
@@ -43,7 +91,7 @@ class FileManager:
         return str(task_dir / output_file_name)
     
     def get_chunks_file(self, task_id: str) -> str:
-        """Get the path for the chunks JSON file."""
+        """Get the path for the chunks JSON file, a link to a blob that is replaced and never written in place."""
         task_dir = self.base_dir / task_id
         return str(task_dir / "chunks.json")
     
@@ -52,6 +100,27 @@ class FileManager:
         task_dir = self.base_dir / task_id
         return str(task_dir / "qa_pairs.json")
     
+    def get_qa_journal_path(self, task_id: str) -> str:
+        """Get the path for the append-only Q&A journal of a running task."""
+        task_dir = self.base_dir / task_id
+        return str(task_dir / "qa_pairs.jsonl")
+    
+    def get_progress_journal_path(self, task_id: str) -> str:
+        """Get the path for the append-only progress journal of a running task."""
+        task_dir = self.base_dir / task_id
+        return str(task_dir / "progress.jsonl")
+    
+    def get_memory_summaries_path(self, task_id: str) -> str:
+        """Get the path for the running summaries of a task in summary memory mode."""
+        task_dir = self.base_dir / task_id
+        return str(task_dir / "memory_summaries.json")
+    
+    def get_partial_paths(self, task_id: str, chunk_key: str) -> Tuple[str, str]:
+        """Get the answer and reasoning files a streamed chunk response is written to."""
+        partial_dir = self.base_dir / task_id / "partial"
+        partial_dir.mkdir(exist_ok=True)
+        return str(partial_dir / f"{chunk_key}.md"), str(partial_dir / f"{chunk_key}.reasoning.md")
+    
     def get_task_json_path(self, task_id: str) -> str:
         """Get the path for the task configuration JSON file."""
         task_dir = self.base_dir / task_id
@@ -66,7 +135,7 @@ class FileManager:
     
     def list_tasks(self) -> list:
         """List all task directories."""
-        return [d.name for d in self.base_dir.iterdir() if d.is_dir()]
+        return [d.name for d in self.base_dir.iterdir() if d.is_dir() and d.name != BLOBS_DIR]
     
     def get_task_info(self, task_id: str) -> dict:
         """Get information about a task."""
@@ -78,8 +147,8 @@ class FileManager:
         
         return {
             "task_id": task_id,
-            "input_files": [f.name for f in input_files if f.name != "chunks.json" and f.name != "qa_pairs.json" and f.name != "task.json"],
+            "input_files": [f.name for f in input_files if not f.name.startswith(("chunks.json", "qa_pairs.json", "qa_pairs.jsonl", "progress.jsonl", "task.json"))],
             "has_chunks": (task_dir / "chunks.json").exists(),
-            "has_qa_pairs": (task_dir / "qa_pairs.json").exists(),
+            "has_qa_pairs": any(task_dir.glob("qa_pairs.json*")),
             "has_task_json": (task_dir / "task.json").exists()
         } 
\ No newline at end of file
@@ -0,0 +1,78 @@
+import os
+import threading
+from collections import deque
+from typing import Dict, Optional
+
+class HedgePolicy:
+    """
+    Decide when a slow request gets a duplicate.
+
+    A request that is still running after the given percentile of recent
+    latencies is hedged: a second request is started, preferably on another
+    endpoint, and the first one to finish wins. Hedges are capped at
+    max_ratio of all requests so a slow API cannot double the spend.
+    """
+
+    MIN_SAMPLES = 20     # Latencies needed before the percentile is trusted
+    WINDOW = 200         # Recent latencies kept
+    MIN_DELAY = 1.0      # Seconds, never hedge sooner than this
+
+    def __init__(self, percentile: float, max_ratio: float = 0.1):
+        """
+        Args:
+            percentile: Latency percentile (0-100) after which a request is hedged
+            max_ratio: Largest share of requests that may be hedged
+        """
+        self.percentile = percentile
+        self.max_ratio = max_ratio
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=self.WINDOW)
+        self.requests = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    @classmethod
+    def from_env(cls) -> Optional["HedgePolicy"]:
+        """Build the policy from HEDGE_PERCENTILE and HEDGE_MAX_RATIO, None if hedging is off."""
+        percentile = float(os.getenv("HEDGE_PERCENTILE", "0"))
+        if percentile <= 0:
+            return None
+        return cls(percentile, float(os.getenv("HEDGE_MAX_RATIO", "0.1")))
+
+    def record_request(self):
+        with self._lock:
+            self.requests += 1
+
+    def record_latency(self, seconds: float):
+        with self._lock:
+            self._latencies.append(seconds)
+
+    def delay(self) -> Optional[float]:
+        """Seconds to wait before hedging a request, None while there are too few samples."""
+        with self._lock:
+            if len(self._latencies) < self.MIN_SAMPLES:
+                return None
+            latencies = sorted(self._latencies)
+        index = min(len(latencies) - 1, int(len(latencies) * self.percentile / 100))
+        return max(self.MIN_DELAY, latencies[index])
+
+    def try_hedge(self) -> bool:
+        """Take a hedge from the budget, False if it is used up."""
+        with self._lock:
+            if self.hedges + 1 > self.requests * self.max_ratio:
+                return False
+            self.hedges += 1
+            return True
+
+    def record_hedge_win(self):
+        with self._lock:
+            self.hedge_wins += 1
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "hedges": self.hedges,
+                "hedge_wins": self.hedge_wins,
+                "hedge_rate": self.hedges / self.requests if self.requests else 0.0
+            }
@@ -0,0 +1,201 @@
+import json
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict
+from urllib.parse import parse_qs, urlsplit
+from .enums import TaskStatus, MemoryMode
+from .queue_manager import QueueManager
+from .storage import DateTimeEncoder
+
+# Tasks in these states get no more chunks
+FINAL_STATES = (TaskStatus.COMPLETED, TaskStatus.FAILED, TaskStatus.CANCELLED)
+
+MAX_UPLOAD_BYTES = 64 * 1024 * 1024
+FOLLOW_INTERVAL = 0.5  # Seconds between journal reads while following a task
+
+# Query parameters of POST /tasks and how to read them
+SUBMIT_OPTIONS: Dict[str, Callable[[str], Any]] = {
+    "output_file": str,
+    "chunk_size": int,
+    "chunk_tokens": int,
+    "tokenizer": str,
+    "memory_size": int,
+    "memory_mode": MemoryMode,
+    "memory_tokens": int,
+    "summary_interval": int,
+    "priority": int,
+    "budget_tokens": int,
+    "budget_cost": float
+}
+
+class APIError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+def task_view(task) -> Dict[str, Any]:
+    """Status and progress of a task as returned by the API."""
+    return {
+        "id": task.id,
+        "task_id": task.task_id,
+        "status": task.status.value,
+        "input_file": task.input_file,
+        "output_file": task.output_file,
+        "total_chunks": task.total_chunks,
+        "processed_chunks": task.processed_chunks,
+        "failed_chunks": task.failed_chunks,
+        "progress": task.processed_chunks / task.total_chunks if task.total_chunks else 0.0,
+        "created_at": task.created_at,
+        "completed_at": task.completed_at,
+        "error_message": task.error_message
+    }
+
+def make_handler(queue_manager: QueueManager, submit: Callable[[str, bytes, Dict[str, Any]], Any]):
+    class APIHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def _send_json(self, payload: Any, status: int = 200):
+            data = json.dumps(payload, ensure_ascii=False, cls=DateTimeEncoder).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _route(self):
+            url = urlsplit(self.path)
+            parts = [part for part in url.path.split("/") if part]
+            query = {name: values[-1] for name, values in parse_qs(url.query).items()}
+            return parts, query
+
+        def _find_task(self, task_ref: str):
+            task = queue_manager.get_task(task_ref)
+            if task is not None:
+                return task
+            matches = queue_manager.find_tasks_by_prefix(task_ref)
+            if not matches:
+                raise APIError(404, f"No task with ID '{task_ref}'")
+            if len(matches) > 1:
+                raise APIError(400, f"ID prefix '{task_ref}' matches {len(matches)} tasks")
+            return matches[0]
+
+        def _handle(self, method: str):
+            try:
+                parts, query = self._route()
+                if method == "GET" and parts == ["health"]:
+                    self._send_json({"status": "ok"})
+                elif method == "GET" and parts == ["tasks"]:
+                    statuses = [TaskStatus(query["status"])] if "status" in query else None
+                    self._send_json(queue_manager.list_task_summaries(statuses))
+                elif method == "POST" and parts == ["tasks"]:
+                    self._submit(query)
+                elif method == "GET" and len(parts) == 2 and parts[0] == "tasks":
+                    self._send_json(task_view(self._find_task(parts[1])))
+                elif method == "GET" and len(parts) == 3 and parts[0] == "tasks" and parts[2] == "chunks":
+                    self._stream_chunks(self._find_task(parts[1]), int(query.get("after", -1)), query.get("follow", "1") != "0")
+                elif method == "POST" and len(parts) == 3 and parts[0] == "tasks" and parts[2] == "cancel":
+                    task = queue_manager.cancel_task(self._find_task(parts[1]).id)
+                    self._send_json(task_view(task))
+                else:
+                    raise APIError(404, f"Unknown path {self.path}")
+            except APIError as e:
+                self._send_json({"error": str(e)}, e.status)
+            except ValueError as e:
+                self._send_json({"error": str(e)}, 400)
+            except (BrokenPipeError, ConnectionResetError):
+                # The client went away, e.g. while following a task
+                self.close_connection = True
+            except Exception as e:
+                self._send_json({"error": str(e)}, 500)
+
+        def _submit(self, query: Dict[str, str]):
+            length = int(self.headers.get("Content-Length", 0))
+            if length > MAX_UPLOAD_BYTES:
+                self.close_connection = True
+                raise APIError(413, f"Documents are limited to {MAX_UPLOAD_BYTES // (1024 * 1024)} MB")
+            content = self.rfile.read(length)
+            if not content.strip():
+                raise APIError(400, "The request body must contain the document")
+            try:
+                content.decode("utf-8")
+            except UnicodeDecodeError:
+                raise APIError(400, "The document must be UTF-8 text")
+            options = {name: SUBMIT_OPTIONS[name](value) for name, value in query.items() if name in SUBMIT_OPTIONS}
+            task = submit(query.get("filename", "input.md"), content, options)
+            self._send_json(task_view(task), 201)
+
+        def _stream_chunks(self, task, after: int, follow: bool):
+            """Send finished chunks as JSON lines, and with follow keep sending them until the task ends."""
+            journal = queue_manager.get_journal(task)
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-ndjson")
+            self.send_header("Connection", "close")
+            self.end_headers()
+            self.close_connection = True
+            sent = set()
+
+            def send(records):
+                for record in sorted(records, key=lambda record: record["chunk_index"]):
+                    if record["chunk_index"] <= after or record["chunk_index"] in sent:
+                        continue
+                    sent.add(record["chunk_index"])
+                    line = {name: record.get(name) for name in ("chunk_index", "char_count", "answer")}
+                    line["reasoning_content"] = record.get("reasoning_content") or journal.load_reasoning(record.get("reasoning_blob"))
+                    self.wfile.write(json.dumps(line, ensure_ascii=False).encode("utf-8") + b"\n")
+                self.wfile.flush()
+
+            send([qa.model_dump() for qa in journal.load_qa_pairs()])
+            offset = 0
+            while follow:
+                task = queue_manager.get_task(task.id)
+                if task is None or task.status in FINAL_STATES:
+                    # A completed task's journal is folded into qa_pairs.json, pick up what was not read yet
+                    send([qa.model_dump() for qa in journal.load_qa_pairs()])
+                    break
+                records, offset = journal.read_since(offset)
+                send(records)
+                time.sleep(FOLLOW_INTERVAL)
+
+        def do_GET(self):
+            self._handle("GET")
+
+        def do_POST(self):
+            self._handle("POST")
+
+    return APIHandler
+
+def create_api_server(
+    queue_manager: QueueManager,
+    submit: Callable[[str, bytes, Dict[str, Any]], Any],
+    host: str = "127.0.0.1",
+    port: int = 8700
+) -> ThreadingHTTPServer:
+    """
+    Create the local HTTP/JSON API of the task queue.
+
+    Every request is handled on its own thread, so documents can be submitted
+    and followed while the worker keeps processing. Endpoints:
+
+        POST /tasks?filename=...        Queue the document in the request body, options as query
+                                        parameters (chunk_size, chunk_tokens, tokenizer, memory_size,
+                                        memory_mode, memory_tokens, summary_interval, priority,
+                                        budget_tokens, budget_cost, output_file)
+        GET  /tasks?status=...          List tasks
+        GET  /tasks/<id>                Status and progress of a task, <id> may be a prefix
+        GET  /tasks/<id>/chunks         Finished chunks as JSON lines, following the task until it
+                                        ends (after=<index> skips earlier chunks, follow=0 returns at once)
+        POST /tasks/<id>/cancel         Cancel a task
+        GET  /health
+
+    Args:
+        queue_manager: Queue the API reads and changes
+        submit: Creates a task from (filename, content, options), called on a request thread
+        host: Address to listen on, keep it local unless the network is trusted
+        port: Port to listen on, 0 picks a free port
+    """
+    server = ThreadingHTTPServer((host, port), make_handler(queue_manager, submit))
+    server.daemon_threads = True
+    return server
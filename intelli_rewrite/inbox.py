@@ -0,0 +1,61 @@
+import shutil
+import time
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+class InboxWatcher:
+    """
+    New input files dropped into a directory.
+
+    The directory is polled, which works the same on every platform and on
+    network drives. A file is only picked up once its size and modification
+    time stayed the same between two scans, so files that are still being
+    copied in are left alone. Files that were added to the queue are moved to
+    added/, files that could not be added to failed/ next to an .error file.
+    """
+
+    PATTERNS = ("*.md", "*.markdown", "*.txt")
+
+    def __init__(self, inbox_dir: str):
+        self.inbox_dir = Path(inbox_dir)
+        self.added_dir = self.inbox_dir / "added"
+        self.failed_dir = self.inbox_dir / "failed"
+        for path in (self.inbox_dir, self.added_dir, self.failed_dir):
+            path.mkdir(parents=True, exist_ok=True)
+        self._seen: Dict[Path, Tuple[int, int]] = {}
+
+    def scan(self) -> List[Path]:
+        """Return the files that did not change since the previous scan, oldest first."""
+        current = {}
+        for pattern in self.PATTERNS:
+            for path in self.inbox_dir.glob(pattern):
+                # Hidden and temporary files are usually partial downloads or editor swap files
+                if path.name.startswith(".") or path.name.endswith("~") or not path.is_file():
+                    continue
+                try:
+                    stat = path.stat()
+                except FileNotFoundError:
+                    continue
+                current[path] = (stat.st_size, stat.st_mtime_ns)
+
+        ready = [path for path, signature in current.items() if self._seen.get(path) == signature]
+        self._seen = {path: signature for path, signature in current.items() if path not in ready}
+        return sorted(ready, key=lambda path: current[path][1])
+
+    def mark_added(self, path: Path) -> Path:
+        """Move a file that was added to the queue out of the inbox."""
+        return self._move(path, self.added_dir)
+
+    def mark_failed(self, path: Path, error: str) -> Path:
+        """Move a file that could not be added out of the inbox, with the error next to it."""
+        target = self._move(path, self.failed_dir)
+        target.with_name(target.name + ".error").write_text(error + "\n", encoding='utf-8')
+        return target
+
+    def _move(self, path: Path, directory: Path) -> Path:
+        target = directory / path.name
+        if target.exists():
+            # Keep earlier files of the same name
+            target = directory / f"{path.stem}_{time.strftime('%Y%m%d_%H%M%S')}{path.suffix}"
+        shutil.move(str(path), str(target))
+        return target
@@ -0,0 +1,192 @@
+import json
+import os
+from datetime import datetime
+from pathlib import Path
+from typing import List, Optional, Tuple
+from .blobs import CODECS, compress, decompress
+from .models import QAPair
+from .file_manager import FileManager
+from .text_processor import content_hash
+
+class TaskJournal:
+    """
+    Append-only record of the chunks a task has finished.
+    
+    Each finished chunk appends one line to qa_pairs.jsonl and one line to
+    progress.jsonl, so saving progress costs the same for the first and the
+    last chunk. When the task completes, the journal is compacted into a
+    compressed qa_pairs.json (.zst or .gz) and removed. Reasoning, often the
+    largest part of an answer, goes to a compressed blob as soon as the chunk
+    is journaled and is only read back when it is shown. The chunk text of a
+    pair is not stored again either, the pair keeps its content hash and the
+    text is looked up in chunks.json.
+    """
+
+    def __init__(self, file_manager: FileManager, task_id: str):
+        self.qa_json_path = Path(file_manager.get_qa_json_path(task_id))
+        self.qa_journal_path = Path(file_manager.get_qa_journal_path(task_id))
+        self.progress_path = Path(file_manager.get_progress_journal_path(task_id))
+        self.chunks_path = Path(file_manager.get_chunks_file(task_id))
+        self.blobs = file_manager.blobs
+
+    @property
+    def compacted_path(self) -> Path:
+        """Path of the compacted Q&A pairs: the existing file, or where the next compaction writes it."""
+        for path in self._compacted_paths():
+            if path.exists():
+                return path
+        return self.qa_json_path.with_name(self.qa_json_path.name + CODECS[self.blobs.codec])
+
+    def _compacted_paths(self) -> List[Path]:
+        # Uncompressed qa_pairs.json is read for tasks compacted before compression
+        return [self.qa_json_path.with_name(self.qa_json_path.name + suffix) for suffix in CODECS.values()] + [self.qa_json_path]
+
+    def _offload_reasoning(self, qa_pair: QAPair):
+        if qa_pair.reasoning_content:
+            qa_pair.reasoning_blob = self.blobs.put(qa_pair.reasoning_content.encode('utf-8'), compressed=True)
+            qa_pair.reasoning_content = None
+
+    @staticmethod
+    def _drop_question(qa_pair: QAPair):
+        # Pairs written before question hashes were recorded keep their text
+        if qa_pair.question_hash:
+            qa_pair.question = ""
+
+    def load_chunks(self) -> List[dict]:
+        """Load the task's chunks.json, an empty list if it is missing."""
+        if not self.chunks_path.exists():
+            return []
+        with open(self.chunks_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def load_question(self, qa_pair: QAPair, chunks_data: Optional[List[dict]] = None) -> str:
+        """
+        Get the chunk text a Q&A pair answers.
+
+        Args:
+            qa_pair: Pair whose question is looked up by its content hash
+            chunks_data: The task's chunks as from load_chunks, read if not given
+
+        Returns:
+            The chunk text, empty if no chunk has the hash any more
+        """
+        if qa_pair.question or not qa_pair.question_hash:
+            return qa_pair.question
+        if chunks_data is None:
+            chunks_data = self.load_chunks()
+        # The chunk at the pair's index is the usual match, update-task keeps them aligned
+        if qa_pair.chunk_index < len(chunks_data):
+            candidates = [chunks_data[qa_pair.chunk_index]] + chunks_data
+        else:
+            candidates = chunks_data
+        for chunk_data in candidates:
+            if (chunk_data.get("hash") or content_hash(chunk_data["content"])) == qa_pair.question_hash:
+                return chunk_data["content"]
+        return ""
+
+    def load_reasoning(self, reasoning_blob: Optional[str]) -> Optional[str]:
+        """Read the reasoning of a chunk from the blob store, None if there is none or it was removed."""
+        if not reasoning_blob:
+            return None
+        try:
+            return self.blobs.get_text(reasoning_blob)
+        except FileNotFoundError:
+            return None
+
+    def append(self, qa_pair: QAPair, processed_chunks: int):
+        """Record a finished chunk and the task's new progress, its reasoning is moved to the blob store."""
+        self._offload_reasoning(qa_pair)
+        self._drop_question(qa_pair)
+        with open(self.qa_journal_path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(qa_pair.model_dump(), ensure_ascii=False) + "\n")
+        with open(self.progress_path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps({
+                "chunk_index": qa_pair.chunk_index,
+                "processed_chunks": processed_chunks,
+                "updated_at": datetime.now().isoformat()
+            }) + "\n")
+
+    def load_qa_pairs(self) -> List[QAPair]:
+        """Load the compacted Q&A pairs followed by the ones still in the journal."""
+        qa_by_index = {}
+        path = self.compacted_path
+        if path.exists():
+            for qa in json.loads(decompress(path.read_bytes(), path.suffix)):
+                qa_by_index[qa["chunk_index"]] = QAPair(**qa)
+        for record in self._read_lines(self.qa_journal_path):
+            qa_by_index[record["chunk_index"]] = QAPair(**record)
+        return list(qa_by_index.values())
+
+    def read_since(self, offset: int) -> Tuple[List[dict], int]:
+        """
+        Read the Q&A records appended to the journal after a byte offset.
+        
+        Only complete lines are returned, so a record being written is picked up by the next call.
+        
+        Returns:
+            Tuple of the new records and the offset to continue from; the offset starts
+            over at 0 when the journal was compacted or restarted
+        """
+        if not self.qa_journal_path.exists():
+            return [], 0
+        with open(self.qa_journal_path, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            if f.tell() < offset:
+                offset = 0
+            f.seek(offset)
+            data = f.read()
+        end = data.rfind(b"\n") + 1
+        records = []
+        for line in data[:end].decode('utf-8').splitlines():
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                continue
+        return records, offset + end
+
+    def read_progress(self) -> Optional[int]:
+        """
+        Get the processed chunk count from the last progress record.
+        
+        Only the tail of the file is read, so this stays cheap for long tasks.
+        """
+        if not self.progress_path.exists():
+            return None
+        with open(self.progress_path, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            f.seek(max(0, f.tell() - 512))
+            tail = f.read().decode('utf-8', errors='ignore')
+        for line in reversed(tail.splitlines()):
+            try:
+                return json.loads(line)["processed_chunks"]
+            except (ValueError, KeyError):
+                continue
+        return None
+
+    def compact(self, qa_pairs: List[QAPair]):
+        """Write all Q&A pairs in chunk order to the compressed qa_pairs.json and drop the journal files."""
+        for qa in qa_pairs:
+            self._offload_reasoning(qa)
+            self._drop_question(qa)
+        data = json.dumps([qa.model_dump() for qa in sorted(qa_pairs, key=lambda qa: qa.chunk_index)], ensure_ascii=False)
+        path = self.qa_json_path.with_name(self.qa_json_path.name + CODECS[self.blobs.codec])
+        tmp_path = path.with_name(path.name + '.tmp')
+        tmp_path.write_bytes(compress(data.encode('utf-8'), self.blobs.codec))
+        os.replace(tmp_path, path)
+        for other in self._compacted_paths():
+            if other != path:
+                other.unlink(missing_ok=True)
+        self.qa_journal_path.unlink(missing_ok=True)
+        self.progress_path.unlink(missing_ok=True)
+
+    @staticmethod
+    def _read_lines(path: Path):
+        if not path.exists():
+            return
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    # A torn last line from an interrupted write
+                    continue
@@ -0,0 +1,171 @@
+import json
+import os
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+from .models import RewriteTask, MemoryMode
+from .prompts import SOURCE_MEMORY_HEADER, SUMMARY_MEMORY_HEADER
+from .text_processor import approximate_tokens
+
+# Memory token budget of summary mode tasks that do not set one
+DEFAULT_SUMMARY_MEMORY_TOKENS = 2000
+
+def chunk_dependencies(task: RewriteTask, chunk_index: int) -> List[int]:
+    """
+    Get the chunk indexes whose answers must be known before a chunk can be sent.
+
+    Only tasks that replay earlier answers have dependencies; source memory is
+    built from chunks.json, which is available up front. In summary mode the
+    summary only covers chunks before the latest answers, which are
+    dependencies already.
+    """
+    if task.memory_size <= 0 or task.memory_mode == MemoryMode.SOURCE:
+        return []
+    return list(range(max(0, chunk_index - task.memory_size), chunk_index))
+
+def memory_budget(task: RewriteTask) -> Optional[int]:
+    """Token budget of a task's memory context, None for no limit."""
+    if task.memory_tokens is not None:
+        return task.memory_tokens
+    return DEFAULT_SUMMARY_MEMORY_TOKENS if task.memory_mode == MemoryMode.SUMMARY else None
+
+def build_memory_context(task: RewriteTask, chunk_index: int, chunks_data: List[dict]) -> List[Dict[str, str]]:
+    """
+    Build the memory messages for a chunk.
+
+    Earlier chunks are looked up by chunk index, so a resumed or partly
+    requeued task remembers the right ones. When the memory is over the task's
+    token budget the oldest chunks are left out first, and the text of the
+    remaining ones is shortened to its end.
+
+    Args:
+        task: The task the chunk belongs to
+        chunk_index: Index of the chunk being rewritten
+        chunks_data: All chunks of the task as stored in chunks.json
+
+    Returns:
+        List of chat messages to place before the chunk prompt
+    """
+    if task.memory_size <= 0:
+        return []
+
+    start_idx = max(0, chunk_index - task.memory_size)
+    budget = memory_budget(task)
+
+    if task.memory_mode == MemoryMode.SOURCE:
+        # Use the original text of the preceding chunks, no earlier answers needed
+        previous_texts = [chunk["content"] for chunk in chunks_data[start_idx:chunk_index]]
+        count, share = _fit([approximate_tokens(text) for text in previous_texts], budget)
+        if not count:
+            return []
+        previous_texts = previous_texts[len(previous_texts) - count:]
+        previous_texts[0] = _tail(previous_texts[0], share)
+        return [{"role": "system", "content": SOURCE_MEMORY_HEADER + "\n\n".join(previous_texts)}]
+
+    memory_context = []
+    if task.memory_mode == MemoryMode.SUMMARY:
+        summary = latest_summary(task, chunk_index)
+        if summary:
+            memory_context.append({"role": "system", "content": SUMMARY_MEMORY_HEADER + summary})
+            if budget is not None:
+                budget = max(0, budget - approximate_tokens(memory_context[0]["content"]))
+
+    # Get previous Q&A pairs for context, looked up by chunk index; the question is
+    # replayed as it was sent, the chunk text without the instructions. Failed
+    # chunks have no answer to remember.
+    exchanges = []
+    for index in range(start_idx, chunk_index):
+        qa = task.get_qa_pair(index)
+        if qa and not qa.error:
+            exchanges.append((chunks_data[index]["content"], qa.answer))
+
+    # The question and answer of a chunk are left out or shortened together
+    count, share = _fit([approximate_tokens(question) + approximate_tokens(answer) for question, answer in exchanges], budget)
+    for position, (question, answer) in enumerate(exchanges[len(exchanges) - count:]):
+        if position == 0:
+            question, answer = _tail(question, share), _tail(answer, share)
+        memory_context.append({"role": "user", "content": question})
+        memory_context.append({"role": "assistant", "content": answer})
+    return memory_context
+
+def _fit(sizes: List[int], budget: Optional[int]) -> Tuple[int, float]:
+    """
+    Count how many of the last items fit a token budget.
+
+    Returns:
+        Tuple of the number of items to keep and the share of the first kept
+        item that fits; only the latest item is ever shortened, when it does
+        not fit on its own
+    """
+    if budget is None:
+        return len(sizes), 1.0
+    used = 0
+    for count, tokens in enumerate(reversed(sizes)):
+        if used + tokens > budget:
+            if count == 0 and budget > 0:
+                return 1, budget / tokens
+            return count, 1.0
+        used += tokens
+    return len(sizes), 1.0
+
+def _tail(text: str, share: float) -> str:
+    """Keep the end of a text, the part nearest to the chunk being rewritten."""
+    if share >= 1.0:
+        return text
+    return text[len(text) - max(1, int(len(text) * share)):]
+
+def latest_summary(task: RewriteTask, chunk_index: int) -> Optional[str]:
+    """Get the newest running summary a chunk can use, the one written up to the closest boundary before it."""
+    boundaries = [boundary for boundary in task.memory_summaries if boundary <= chunk_index]
+    return task.memory_summaries[max(boundaries)] if boundaries else None
+
+def summary_due(task: RewriteTask, chunk_index: int) -> Optional[int]:
+    """Get the boundary whose summary a chunk needs but that was not written yet, None if it is up to date."""
+    if task.memory_mode != MemoryMode.SUMMARY or task.memory_size <= 0:
+        return None
+    boundary = chunk_index // task.summary_interval * task.summary_interval
+    if boundary == 0 or boundary in task.memory_summaries:
+        return None
+    return boundary
+
+def update_summaries(task: RewriteTask, chunk_index: int, summarize: Callable[[str, List[str], int], str]) -> bool:
+    """
+    Bring the running summary of a task up to the boundary a chunk needs.
+
+    Summaries are keyed by the chunk index they lead up to: the summary at
+    boundary b covers the answers of chunks 0 to b - 1 and is built from the
+    one at b - summary_interval and the answers since. Missing boundaries are
+    filled in order, so a resumed task catches up.
+
+    Args:
+        task: Task whose Q&A pairs up to the chunk are loaded
+        chunk_index: Index of the chunk about to be sent
+        summarize: Called with the previous summary, the new answers and the
+            summary's token budget, returns the new summary
+
+    Returns:
+        True if a summary was added
+    """
+    boundary = summary_due(task, chunk_index)
+    if boundary is None:
+        return False
+    interval = task.summary_interval
+    # Half the budget goes to the summary, the rest to the latest answers
+    summary_tokens = max(100, (memory_budget(task) or DEFAULT_SUMMARY_MEMORY_TOKENS) // 2)
+    start = max([b for b in task.memory_summaries if b < boundary], default=0)
+    for target in range(start + interval, boundary + 1, interval):
+        qa_pairs = [task.get_qa_pair(index) for index in range(target - interval, target)]
+        answers = [qa.answer for qa in qa_pairs if qa and not qa.error]
+        task.memory_summaries[target] = summarize(task.memory_summaries.get(target - interval, ""), answers, summary_tokens)
+    return True
+
+def load_summaries(path: str) -> Dict[int, str]:
+    if not Path(path).exists():
+        return {}
+    with open(path, 'r', encoding='utf-8') as f:
+        return {int(boundary): summary for boundary, summary in json.load(f).items()}
+
+def save_summaries(path: str, summaries: Dict[int, str]):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({str(boundary): summary for boundary, summary in sorted(summaries.items())}, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
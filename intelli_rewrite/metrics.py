@@ -0,0 +1,213 @@
+import os
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional
+from .models import ChunkMetrics, QAPair
+
+def percentile(values: List[float], pct: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+@dataclass
+class Pricing:
+    """Price of a million prompt and completion tokens, used for cost estimates."""
+    input_per_million: float = 0.55
+    output_per_million: float = 2.19
+
+    @classmethod
+    def from_env(cls) -> "Pricing":
+        """Read INPUT_PRICE and OUTPUT_PRICE, default: the list price of deepseek-reasoner in USD."""
+        return cls(float(os.getenv("INPUT_PRICE", "0.55")), float(os.getenv("OUTPUT_PRICE", "2.19")))
+
+    def cost(self, metrics: ChunkMetrics) -> float:
+        # Reasoning tokens are part of the completion tokens and billed as output
+        return (metrics.prompt_tokens * self.input_per_million + metrics.completion_tokens * self.output_per_million) / 1_000_000
+
+def summarize(qa_pairs: List[QAPair], pricing: Optional[Pricing] = None, top: int = 5) -> Dict[str, Any]:
+    """
+    Aggregate the chunk metrics of a task.
+
+    Args:
+        qa_pairs: Q&A pairs of the task, chunks finished before metrics were recorded are counted but not measured
+        pricing: Token prices for the cost estimate, read from the environment by default
+        top: Number of slowest chunks to return
+
+    Returns:
+        Dictionary of totals, latency percentiles, throughput and the slowest chunks
+    """
+    pricing = pricing or Pricing.from_env()
+    measured = [qa for qa in qa_pairs if qa.metrics is not None]
+    metrics = [qa.metrics for qa in measured]
+    requested = [m for m in metrics if m.source in ("api", "batch")]
+    latencies = [m.latency for m in requested if m.latency is not None]
+    ttfts = [m.ttft for m in requested if m.ttft is not None]
+    queue_waits = [m.queue_wait for m in metrics if m.source != "batch"]
+
+    sources: Dict[str, int] = {}
+    for m in metrics:
+        sources[m.source] = sources.get(m.source, 0) + 1
+
+    # Wall time from the first request to the last answer of this and earlier runs
+    timed = [m for m in metrics if m.started_at is not None and m.source != "batch"]
+    wall_seconds = None
+    if timed:
+        wall_seconds = max(m.started_at + m.elapsed for m in timed) - min(m.started_at for m in timed)
+    completion_tokens = sum(m.completion_tokens for m in metrics)
+
+    slowest = sorted(measured, key=lambda qa: qa.metrics.elapsed, reverse=True)[:top]
+    return {
+        "chunks": len(qa_pairs),
+        "measured": len(measured),
+        "sources": sources,
+        "prompt_tokens": sum(m.prompt_tokens for m in metrics),
+        "completion_tokens": completion_tokens,
+        "reasoning_tokens": sum(m.reasoning_tokens for m in metrics),
+        "cached_prompt_tokens": sum(m.cached_prompt_tokens for m in metrics),
+        "prompt_tokens_saved": sum(m.prompt_tokens_saved for m in requested),
+        "cost": sum(pricing.cost(m) for m in metrics),
+        "retries": sum(m.retries for m in metrics),
+        "hedged": sum(1 for m in metrics if m.hedged),
+        "latency_p50": percentile(latencies, 50),
+        "latency_p95": percentile(latencies, 95),
+        "latency_max": max(latencies) if latencies else None,
+        "ttft_p50": percentile(ttfts, 50),
+        "ttft_p95": percentile(ttfts, 95),
+        "queue_wait_p50": percentile(queue_waits, 50),
+        "queue_wait_p95": percentile(queue_waits, 95),
+        "throttle_wait": sum(m.throttle_wait for m in metrics),
+        "wall_seconds": wall_seconds,
+        "chunks_per_minute": len(timed) * 60 / wall_seconds if wall_seconds else None,
+        "tokens_per_second": sum(m.completion_tokens for m in timed) / wall_seconds if wall_seconds else None,
+        "slowest": slowest
+    }
+
+def _labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    pairs = []
+    for name, value in labels.items():
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+class MetricsRegistry:
+    """
+    Counters and histograms of a processing run in the Prometheus text format.
+
+    The file is rewritten atomically, so it can be picked up by the node_exporter
+    textfile collector or read by any scraper while a long-running worker is busy.
+    """
+
+    PREFIX = "intelli_rewrite"
+    BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+    HISTOGRAMS = {
+        "request_latency_seconds": "Latency of the request that answered a chunk",
+        "ttft_seconds": "Time to the first streamed token",
+        "queue_wait_seconds": "Time a ready chunk waited for a worker"
+    }
+
+    def __init__(self, pricing: Optional[Pricing] = None):
+        self.pricing = pricing or Pricing.from_env()
+        self._lock = threading.Lock()
+        self.chunks: Dict[tuple, int] = {}
+        self.tokens = {"prompt": 0, "completion": 0, "reasoning": 0, "cached_prompt": 0}
+        self.prompt_tokens_saved = 0
+        self.retries = 0
+        self.hedged = 0
+        self.cost = 0.0
+        self.throttle_wait = 0.0
+        self.histograms = {name: ([0] * len(self.BUCKETS), [0.0, 0]) for name in self.HISTOGRAMS}
+        self.endpoints: List[Dict[str, Any]] = []
+
+    def observe(self, metrics: ChunkMetrics):
+        """Count one finished chunk."""
+        status = "error" if metrics.source == "error" else "ok"
+        with self._lock:
+            key = (metrics.source, status)
+            self.chunks[key] = self.chunks.get(key, 0) + 1
+            self.tokens["prompt"] += metrics.prompt_tokens
+            self.tokens["completion"] += metrics.completion_tokens
+            self.tokens["reasoning"] += metrics.reasoning_tokens
+            self.tokens["cached_prompt"] += metrics.cached_prompt_tokens
+            self.prompt_tokens_saved += metrics.prompt_tokens_saved
+            self.retries += metrics.retries
+            self.hedged += int(metrics.hedged)
+            self.cost += self.pricing.cost(metrics)
+            self.throttle_wait += metrics.throttle_wait
+            for name, value in (
+                ("request_latency_seconds", metrics.latency),
+                ("ttft_seconds", metrics.ttft),
+                ("queue_wait_seconds", metrics.queue_wait)
+            ):
+                if value is not None:
+                    self._observe_histogram(name, value)
+
+    def observe_endpoints(self, pool):
+        """Take a snapshot of the request, failure and rate limit counts of every endpoint."""
+        snapshot = [{
+            "endpoint": endpoint.name,
+            "requests": endpoint.requests,
+            "failures": endpoint.failures,
+            "rate_limited": endpoint.rate_limiter.rate_limited_count,
+            "outstanding": endpoint.outstanding,
+            "available": int(endpoint.breaker.state in ("closed", "half-open"))
+        } for endpoint in pool.endpoints]
+        with self._lock:
+            self.endpoints = snapshot
+
+    def _observe_histogram(self, name: str, value: float):
+        buckets, totals = self.histograms[name]
+        for i, bound in enumerate(self.BUCKETS):
+            if value <= bound:
+                buckets[i] += 1
+        totals[0] += value
+        totals[1] += 1
+
+    def render(self) -> str:
+        lines = []
+
+        def metric(name: str, kind: str, help_text: str, samples: List[tuple]):
+            full_name = f"{self.PREFIX}_{name}"
+            lines.append(f"# HELP {full_name} {help_text}")
+            lines.append(f"# TYPE {full_name} {kind}")
+            for suffix, labels, value in samples:
+                lines.append(f"{full_name}{suffix}{_labels(labels)} {value}")
+
+        with self._lock:
+            metric("chunks_total", "counter", "Chunks finished, by where the answer came from",
+                   [("", {"source": source, "status": status}, count) for (source, status), count in sorted(self.chunks.items())])
+            metric("tokens_total", "counter", "Tokens reported by the API",
+                   [("", {"kind": kind}, count) for kind, count in self.tokens.items()])
+            metric("prompt_tokens_saved_total", "counter", "Estimated prompt tokens saved by sending the instructions once",
+                   [("", {}, self.prompt_tokens_saved)])
+            metric("retries_total", "counter", "Retried requests of finished chunks", [("", {}, self.retries)])
+            metric("hedged_chunks_total", "counter", "Chunks answered with a hedged request", [("", {}, self.hedged)])
+            metric("cost_estimate_total", "counter", "Estimated cost of the tokens used", [("", {}, f"{self.cost:.6f}")])
+            metric("throttle_wait_seconds_total", "counter", "Time spent waiting for the client-side rate limiter",
+                   [("", {}, f"{self.throttle_wait:.3f}")])
+            for name, help_text in self.HISTOGRAMS.items():
+                buckets, (total, count) = self.histograms[name]
+                samples = [("_bucket", {"le": str(bound)}, buckets[i]) for i, bound in enumerate(self.BUCKETS)]
+                samples += [("_bucket", {"le": "+Inf"}, count), ("_sum", {}, f"{total:.6f}"), ("_count", {}, count)]
+                metric(name, "histogram", help_text, samples)
+            for key, kind, help_text in (
+                ("requests", "counter", "Requests sent to the endpoint"),
+                ("failures", "counter", "Failed requests of the endpoint"),
+                ("rate_limited", "counter", "429 responses of the endpoint"),
+                ("outstanding", "gauge", "Requests in flight on the endpoint"),
+                ("available", "gauge", "1 while the endpoint's circuit lets requests through")
+            ):
+                name = f"endpoint_{key}_total" if kind == "counter" else f"endpoint_{key}"
+                metric(name, kind, help_text, [("", {"endpoint": e["endpoint"]}, e[key]) for e in self.endpoints])
+        metric("last_update_timestamp_seconds", "gauge", "Unix time the file was written", [("", {}, f"{time.time():.3f}")])
+        return "\n".join(lines) + "\n"
+
+    def write(self, path: str):
+        """Write the metrics file atomically."""
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(self.render())
+        os.replace(tmp_path, path)
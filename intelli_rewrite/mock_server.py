@@ -0,0 +1,297 @@
+import json
+import math
+import random
+import threading
+import time
+import uuid
+from dataclasses import dataclass
+from email.parser import BytesParser
+from email.policy import default as default_policy
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List
+from .models import RewriteTask
+
+LATENCY_DISTRIBUTIONS = ("fixed", "uniform", "exponential", "lognormal")
+
+@dataclass
+class MockConfig:
+    """Behaviour of the mock server."""
+    latency_ms: float = 0.0  # Median latency of a chat completion
+    latency_dist: str = "fixed"  # One of LATENCY_DISTRIBUTIONS
+    latency_sigma: float = 0.5  # Spread of the lognormal distribution
+    error_rate: float = 0.0  # Share of requests answered with a 500
+    rate_limit_rate: float = 0.0  # Share of requests answered with a 429
+    retry_after: float = 1.0  # Retry-After of the 429 responses, in seconds
+    batch_delay: float = 0.0  # Seconds before a batch completes
+    reasoning: bool = True  # Include reasoning_content in the responses
+
+    def sample_latency(self) -> float:
+        """Draw the latency of one request, in seconds."""
+        median = self.latency_ms / 1000
+        if median <= 0 or self.latency_dist == "fixed":
+            return max(0.0, median)
+        if self.latency_dist == "uniform":
+            return random.uniform(0, 2 * median)
+        if self.latency_dist == "exponential":
+            return random.expovariate(math.log(2) / median)
+        return random.lognormvariate(math.log(median), self.latency_sigma)
+
+class MockState:
+    """Configuration, files, batches and request counters of the mock server, in memory."""
+
+    def __init__(self, config: MockConfig):
+        self.config = config
+        self.lock = threading.Lock()
+        self.files: Dict[str, dict] = {}
+        self.file_contents: Dict[str, bytes] = {}
+        self.batches: Dict[str, dict] = {}
+        self.requests = 0
+        self.errors = 0
+        self.rate_limited = 0
+        self.latencies: List[float] = []  # Seconds from request to the end of each successful response
+
+    def add_file(self, content: bytes, filename: str, purpose: str) -> dict:
+        file_id = f"file-{uuid.uuid4().hex[:24]}"
+        record = {
+            "id": file_id,
+            "object": "file",
+            "bytes": len(content),
+            "created_at": int(time.time()),
+            "filename": filename,
+            "purpose": purpose,
+            "status": "processed"
+        }
+        with self.lock:
+            self.files[file_id] = record
+            self.file_contents[file_id] = content
+        return record
+
+def mock_answer(messages: List[Dict[str, str]]) -> str:
+    """The canned answer of RewriteTask.mock_response, tagged with the start of the draft it answers."""
+    # The last message is the draft alone, the instructions are in the system message
+    draft = messages[-1]["content"] if messages else ""
+    first_line = draft.split("\n", 1)[0][:80]
+    return f"{RewriteTask.model_fields['mock_response'].default.strip()}\n\n> Source: {first_line}"
+
+def mock_completion(messages: List[Dict[str, str]], model: str, reasoning: bool = True) -> dict:
+    """Answer a chat completion request without a model."""
+    content = mock_answer(messages)
+    prompt_tokens = sum(len(message["content"]) for message in messages) // 4
+    completion_tokens = len(content) // 4
+    message = {"role": "assistant", "content": content}
+    if reasoning:
+        message["reasoning_content"] = "Mock reasoning."
+    return {
+        "id": f"chatcmpl-{uuid.uuid4().hex[:24]}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "finish_reason": "stop", "message": message}],
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens
+        }
+    }
+
+def _run_batch(state: MockState, batch_id: str):
+    """Answer every request of a batch and publish the output file."""
+    time.sleep(state.config.batch_delay)
+    with state.lock:
+        batch = state.batches[batch_id]
+        batch["status"] = "in_progress"
+        requests = state.file_contents[batch["input_file_id"]].decode("utf-8").splitlines()
+
+    output_lines = []
+    for line in requests:
+        if not line.strip():
+            continue
+        request = json.loads(line)
+        body = request["body"]
+        output_lines.append(json.dumps({
+            "id": f"batch_req_{uuid.uuid4().hex[:24]}",
+            "custom_id": request["custom_id"],
+            "response": {
+                "status_code": 200,
+                "request_id": uuid.uuid4().hex,
+                "body": mock_completion(body["messages"], body["model"], state.config.reasoning)
+            },
+            "error": None
+        }, ensure_ascii=False))
+
+    output = state.add_file(("\n".join(output_lines) + "\n").encode("utf-8"), f"{batch_id}_output.jsonl", "batch_output")
+    with state.lock:
+        batch["status"] = "completed"
+        batch["output_file_id"] = output["id"]
+        batch["completed_at"] = int(time.time())
+        batch["request_counts"] = {"total": len(output_lines), "completed": len(output_lines), "failed": 0}
+
+def make_handler(state: MockState):
+    class MockHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def _send_json(self, payload: dict, status: int = 200, headers: Dict[str, str] = None):
+            data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _not_found(self):
+            self._send_json({"error": {"message": f"Unknown path {self.path}", "type": "invalid_request_error"}}, 404)
+
+        def _read_body(self) -> bytes:
+            return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+        def _chat_completion(self, body: dict):
+            config = state.config
+            with state.lock:
+                state.requests += 1
+            roll = random.random()
+            if roll < config.rate_limit_rate:
+                with state.lock:
+                    state.rate_limited += 1
+                self._send_json(
+                    {"error": {"message": "Rate limit reached", "type": "rate_limit_error"}},
+                    429,
+                    {"Retry-After": str(config.retry_after)}
+                )
+                return
+            if roll < config.rate_limit_rate + config.error_rate:
+                with state.lock:
+                    state.errors += 1
+                time.sleep(config.sample_latency() / 2)
+                self._send_json({"error": {"message": "Mock server error", "type": "server_error"}}, 500)
+                return
+
+            started = time.monotonic()
+            latency = config.sample_latency()
+            completion = mock_completion(body["messages"], body["model"], config.reasoning)
+            if not body.get("stream"):
+                time.sleep(latency)
+                self._send_json(completion)
+            else:
+                self._stream(completion, latency, (body.get("stream_options") or {}).get("include_usage", False))
+            with state.lock:
+                state.latencies.append(time.monotonic() - started)
+
+        def _stream(self, completion: dict, latency: float, include_usage: bool):
+            """Send a completion as server-sent events, spread over the latency."""
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Connection", "close")
+            self.end_headers()
+            self.close_connection = True
+
+            message = completion["choices"][0]["message"]
+            pieces = [{"reasoning_content": word} for word in _words(message.get("reasoning_content") or "")]
+            pieces += [{"content": word} for word in _words(message["content"])]
+            delay = latency / max(1, len(pieces))
+
+            def send(choices: list, usage: dict = None):
+                event = {"id": completion["id"], "object": "chat.completion.chunk", "created": completion["created"],
+                         "model": completion["model"], "choices": choices}
+                if usage is not None:
+                    event["usage"] = usage
+                self.wfile.write(b"data: " + json.dumps(event, ensure_ascii=False).encode("utf-8") + b"\n\n")
+                self.wfile.flush()
+
+            for delta in pieces:
+                time.sleep(delay)
+                send([{"index": 0, "delta": delta, "finish_reason": None}])
+            send([{"index": 0, "delta": {}, "finish_reason": "stop"}])
+            if include_usage:
+                send([], completion["usage"])
+            self.wfile.write(b"data: [DONE]\n\n")
+            self.wfile.flush()
+
+        def do_POST(self):
+            path = self.path.split("?")[0]
+            if path.endswith("/chat/completions"):
+                self._chat_completion(json.loads(self._read_body()))
+            elif path.endswith("/files"):
+                # multipart/form-data with a purpose field and a file field
+                message = BytesParser(policy=default_policy).parsebytes(
+                    f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode() + self._read_body()
+                )
+                fields = {part.get_param("name", header="content-disposition"): part for part in message.iter_parts()}
+                upload = fields["file"]
+                purpose = fields["purpose"].get_content().strip() if "purpose" in fields else "batch"
+                self._send_json(state.add_file(upload.get_payload(decode=True), upload.get_filename() or "upload.jsonl", purpose))
+            elif path.endswith("/batches"):
+                body = json.loads(self._read_body())
+                batch_id = f"batch_{uuid.uuid4().hex[:24]}"
+                batch = {
+                    "id": batch_id,
+                    "object": "batch",
+                    "endpoint": body.get("endpoint", "/v1/chat/completions"),
+                    "input_file_id": body["input_file_id"],
+                    "completion_window": body.get("completion_window", "24h"),
+                    "status": "validating",
+                    "output_file_id": None,
+                    "error_file_id": None,
+                    "created_at": int(time.time()),
+                    "request_counts": {"total": 0, "completed": 0, "failed": 0}
+                }
+                with state.lock:
+                    state.batches[batch_id] = batch
+                threading.Thread(target=_run_batch, args=(state, batch_id), daemon=True).start()
+                self._send_json(batch)
+            else:
+                self._not_found()
+
+        def do_GET(self):
+            parts = self.path.split("?")[0].rstrip("/").split("/")
+            if len(parts) >= 2 and parts[-2] == "batches":
+                with state.lock:
+                    batch = state.batches.get(parts[-1])
+                    batch = dict(batch) if batch else None
+                self._send_json(batch) if batch else self._not_found()
+            elif len(parts) >= 3 and parts[-3] == "files" and parts[-1] == "content":
+                with state.lock:
+                    content = state.file_contents.get(parts[-2])
+                if content is None:
+                    self._not_found()
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", "application/octet-stream")
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+            elif len(parts) >= 2 and parts[-2] == "files":
+                with state.lock:
+                    record = state.files.get(parts[-1])
+                self._send_json(record) if record else self._not_found()
+            else:
+                self._not_found()
+
+    return MockHandler
+
+def _words(text: str) -> List[str]:
+    """Split text into stream pieces that join back to the same text."""
+    pieces = text.split(" ")
+    return [piece + " " for piece in pieces[:-1]] + [pieces[-1]] if text else []
+
+def create_server(host: str = "127.0.0.1", port: int = 8765, config: MockConfig = None) -> ThreadingHTTPServer:
+    """
+    Create an OpenAI-compatible mock server for offline runs and benchmarks.
+
+    Chat completions are answered with RewriteTask.mock_response after a
+    latency drawn from the configured distribution, streamed if requested,
+    and a configurable share of them fail with a 500 or a 429. The files
+    and batches endpoints used by submit-batch and collect-batch are
+    implemented as well. Port 0 picks a free port.
+    """
+    if config is not None and config.latency_dist not in LATENCY_DISTRIBUTIONS:
+        raise ValueError(f"Unknown latency distribution: {config.latency_dist}")
+    state = MockState(config or MockConfig())
+    server = ThreadingHTTPServer((host, port), make_handler(state))
+    server.daemon_threads = True
+    server.state = state
+    return server
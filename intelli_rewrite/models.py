@@ -1,35 +1,65 @@
-from enum import Enum
 from datetime import datetime
-from pydantic import BaseModel
-from typing import Optional, List, Dict
+from pydantic import BaseModel, Field, PrivateAttr
+from typing import Any, Optional, List, Dict
+from .enums import TaskStatus, MemoryMode, BatchStatus
 
-class TaskStatus(str, Enum):
-    PENDING = "pending"
-    PROCESSING = "processing"
-    COMPLETED = "completed"
-    FAILED = "failed"
+class ChunkMetrics(BaseModel):
+    """Where the time and tokens of one chunk went."""
+    source: str = "api"  # api, cache, partial (finished by an earlier run), batch or error
+    endpoint: Optional[str] = None
+    model: Optional[str] = None
+    started_at: Optional[float] = None  # Unix time the request was started
+    queue_wait: float = 0.0  # Seconds the chunk was ready but waited for a worker
+    throttle_wait: float = 0.0  # Seconds spent waiting for the client-side rate limiter
+    elapsed: float = 0.0  # Seconds from the first attempt to the answer, with retries and backoff
+    latency: Optional[float] = None  # Seconds of the request that answered
+    ttft: Optional[float] = None  # Seconds to the first streamed token of that request
+    prompt_tokens: int = 0
+    completion_tokens: int = 0  # Including reasoning tokens
+    reasoning_tokens: int = 0
+    cached_prompt_tokens: int = 0  # Prompt tokens served from the provider's prefix cache
+    prompt_tokens_saved: int = 0  # Estimated prompt tokens the earlier message layout would have added
+    retries: int = 0
+    hedged: bool = False
 
 class QAPair(BaseModel):
-    question: str
+    question: str = ""  # Chunk text that was sent, dropped once the pair is journaled, see TaskJournal.load_question
+    question_hash: Optional[str] = None  # Content hash of the chunk, whose text is kept once in chunks.json
     answer: str
-    reasoning_content: Optional[str] = None
+    reasoning_content: Optional[str] = None  # Moved to reasoning_blob once the chunk is journaled
+    reasoning_blob: Optional[str] = None  # Hash of the compressed reasoning in the blob store, read when it is shown
     chunk_index: int
     char_count: int
+    metrics: Optional[ChunkMetrics] = None
+    prompt_hash: Optional[str] = None  # Hash of the exact messages the answer was generated from
+    error: Optional[str] = None  # Why the chunk failed, its answer is empty until repair rewrites it
 
 class RewriteTask(BaseModel):
     id: str
     task_id: str  # Directory ID for file organization
     input_file: str
     output_file: str
+    input_hash: Optional[str] = None  # SHA-256 of the input file, add-tasks skips documents that are already queued
     status: TaskStatus = TaskStatus.PENDING
-    created_at: datetime = datetime.now()
+    created_at: datetime = Field(default_factory=datetime.now)
     completed_at: Optional[datetime] = None
     error_message: Optional[str] = None
+    worker_id: Optional[str] = None  # Worker process holding the task while it is processed
     qa_pairs: List[QAPair] = []
     total_chunks: int = 0
     processed_chunks: int = 0
+    failed_chunks: int = 0  # Processed chunks whose request failed, retried by repair
     chunk_size: int = 800  # Default chunk size
+    chunk_tokens: Optional[int] = None  # Token budget per chunk, overrides chunk_size when set
+    tokenizer: str = "approx"  # Token counter used with chunk_tokens
     memory_size: int = 0   # Default memory size (0 = no memory)
+    memory_mode: MemoryMode = MemoryMode.ANSWERS
+    memory_tokens: Optional[int] = None  # Token budget of the memory context, 2000 in summary mode by default
+    summary_interval: int = 8  # Chunks between refreshes of the running summary in summary mode
+    memory_summaries: Dict[int, str] = {}  # Running summaries by the chunk index they lead up to, kept in memory_summaries.json
+    priority: int = 0  # Higher priorities are claimed first and get a larger share of the workers
+    budget_tokens: Optional[int] = None  # Prompt and completion tokens the task may use
+    budget_cost: Optional[float] = None  # Estimated cost the task may incur
     mock_response: str = """
 # Rewritten Chapter
 
@@ -54,4 +84,51 @@ For any given equation:
 E = mc²
 ```
 This represents the relationship between energy and mass.
-""" 
\ No newline at end of file
+""" 
+    _qa_by_index: Dict[int, QAPair] = PrivateAttr(default_factory=dict)
+
+    def model_post_init(self, context: Any):
+        self._qa_by_index = {qa.chunk_index: qa for qa in self.qa_pairs}
+
+    def __setattr__(self, name: str, value: Any):
+        super().__setattr__(name, value)
+        if name == "qa_pairs":
+            # Results replaced as a whole, e.g. loaded from the journal
+            self._qa_by_index = {qa.chunk_index: qa for qa in value}
+
+    def get_qa_pair(self, chunk_index: int) -> Optional[QAPair]:
+        """Get the result of a chunk by its index, without scanning the Q&A pairs."""
+        return self._qa_by_index.get(chunk_index)
+
+    def add_qa_pair(self, qa_pair: QAPair) -> bool:
+        """
+        Record the result of a chunk, replacing an earlier result of the same chunk.
+
+        Returns:
+            True if the chunk had no result yet
+        """
+        previous = self._qa_by_index.get(qa_pair.chunk_index)
+        self._qa_by_index[qa_pair.chunk_index] = qa_pair
+        if previous is None:
+            self.qa_pairs.append(qa_pair)
+            return True
+        position = next(i for i, qa in enumerate(self.qa_pairs) if qa is previous)
+        self.qa_pairs[position] = qa_pair
+        return False
+
+class BatchJob(BaseModel):
+    id: str
+    remote_id: str  # Batch ID at the provider
+    endpoint: str  # Name of the endpoint the batch was sent to
+    requests_file: str
+    results_file: Optional[str] = None
+    task_ids: List[str] = []
+    request_count: int = 0
+    status: BatchStatus = BatchStatus.SUBMITTED
+    created_at: datetime = Field(default_factory=datetime.now)
+    collected_at: Optional[datetime] = None
+
+    @property
+    def worker_id(self) -> str:
+        """Claims held by the batch, on a host name no local liveness check can match."""
+        return f"batch:{self.id}"
@@ -0,0 +1,58 @@
+import hashlib
+import json
+from typing import Dict, List, Optional, Tuple
+from .text_processor import approximate_tokens
+
+SYSTEM_PROMPT = "Act as a college professor working on an advanced robotics&deep learning textbook. You are good at making complex ideas simple and understandable. Following is a draft of one section, rewrite it into more understsabdable and fluent format. Do not ignore any math formulas, you need to explain the math like a math teacher, inventing formulas, analyze the idea behind them, not just introduce them. Clarify missing steps and concepts for your students. Do not say trivially or hint. Draft: "
+
+# Placed before the source text of earlier chunks in source memory mode
+SOURCE_MEMORY_HEADER = "Preceding sections of the draft, for context only (do not rewrite them):\n\n"
+
+# Placed before the running summary of earlier answers in summary memory mode
+SUMMARY_MEMORY_HEADER = "Summary of the sections rewritten so far, keep the notation and terms consistent with it:\n\n"
+
+SUMMARY_PROMPT = "You keep a running summary of a textbook that is being rewritten section by section. Update the summary with the new sections: keep the notation, the defined terms and symbols, and the main results and where they were introduced, drop worked details. Reply with the updated summary only, in at most {words} words."
+
+# Instructions the earlier message layout put in front of every stored question,
+# only kept to report the prompt tokens the current layout saves
+_LEGACY_QUESTION_PREFIX = "Act as a professional technical editor working on a mathematics/physics textbook manuscript. Following is a draft, rewrite it into more understsabdable and fluent format, do not ignore any math formulas, clarify missing logics if needed.\n\n"
+
+def build_messages(
+    content: str,
+    memory_context: Optional[List[Dict[str, str]]] = None,
+    system_prompt: str = SYSTEM_PROMPT
+) -> List[Dict[str, str]]:
+    """
+    Build the chat messages of a chunk request.
+
+    The instructions are sent once, as the system message, and every request
+    starts with the same system message so the provider's prompt cache can
+    reuse it. Memory follows, then the chunk text alone as the user message.
+    """
+    messages = [{"role": "system", "content": system_prompt}]
+    if memory_context:
+        messages.extend(memory_context)
+    messages.append({"role": "user", "content": content})
+    return messages
+
+def summary_request(previous_summary: str, answers: List[str], max_tokens: int) -> Tuple[str, str]:
+    """Build the system prompt and user message that fold new answers into the running summary."""
+    # About 0.75 words per token for English text
+    system_prompt = SUMMARY_PROMPT.format(words=max(50, int(max_tokens * 0.75)))
+    content = f"Summary so far:\n{previous_summary or '(none yet)'}\n\nNew sections:\n\n" + "\n\n".join(answers)
+    return system_prompt, content
+
+def prompt_hash(messages: List[Dict[str, str]]) -> str:
+    """Hash of the exact messages of a request, recorded with its answer."""
+    payload = json.dumps(messages, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+def prompt_tokens_saved(memory_context: Optional[List[Dict[str, str]]] = None) -> int:
+    """
+    Estimate the prompt tokens the earlier message layout would have sent on top of a request.
+
+    It repeated the instructions in the user message, and replayed earlier
+    questions with their own instructions in front.
+    """
+    replayed = sum(1 for message in memory_context or [] if message["role"] == "user")
+    return approximate_tokens(SYSTEM_PROMPT + "\n\n") + replayed * approximate_tokens(_LEGACY_QUESTION_PREFIX)
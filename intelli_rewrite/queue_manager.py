@@ -1,46 +1,63 @@
+from __future__ import annotations
+
 import json
 import uuid
 from pathlib import Path
-from typing import List, Optional, Dict, Any
+from typing import TYPE_CHECKING, Any, Collection, Dict, List, Optional
 from datetime import datetime
-from .models import RewriteTask, TaskStatus
+from .enums import TaskStatus, MemoryMode
 from .file_manager import FileManager
+from .storage import DateTimeEncoder, TaskStore, JsonTaskStore, SqliteTaskStore
 import os
 
-class DateTimeEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, datetime):
-            return obj.isoformat()
-        return super().default(obj)
+if TYPE_CHECKING:
+    from .journal import TaskJournal
+    from .models import RewriteTask
+
+class TaskCancelledError(Exception):
+    """Raised by a worker that finds the task it is processing was cancelled."""
 
 class QueueManager:
-    def __init__(self, queue_file: str = "tasks.json"):
-        self.queue_file = Path(queue_file)
-        self.tasks: List[RewriteTask] = []
+    def __init__(self, queue_file: Optional[str] = None, backend: Optional[str] = None):
+        """
+        Initialize the queue on top of a storage backend.
+
+        The backend is opened on first use, so commands that never touch the
+        queue do not pay for it.
+
+        Args:
+            queue_file: Path of the queue database or JSON file (env QUEUE_FILE)
+            backend: "sqlite" (default) or "json" (env QUEUE_BACKEND)
+        """
         self.file_manager = FileManager(base_dir=os.getenv("OUTPUT_DIR"))
-        self._load_tasks()
-
-    def _load_tasks(self):
-        if self.queue_file.exists():
-            with open(self.queue_file, 'r') as f:
-                data = json.load(f)
-                # Handle transition: add task_id if missing
-                for task_data in data:
-                    if 'task_id' not in task_data:
-                        # Generate a task_id for existing tasks
-                        task_data['task_id'] = str(uuid.uuid4())
-                self.tasks = [RewriteTask(**task) for task in data]
-
-    def _save_tasks(self):
-        with open(self.queue_file, 'w') as f:
-            json.dump([task.model_dump() for task in self.tasks], f, indent=2, cls=DateTimeEncoder)
-            
+        self.backend = backend or os.getenv("QUEUE_BACKEND", "sqlite")
+        queue_file = queue_file or os.getenv("QUEUE_FILE")
+
+        if self.backend == "sqlite":
+            self.queue_file = Path(queue_file or "tasks.db")
+        elif self.backend == "json":
+            self.queue_file = Path(queue_file or "tasks.json")
+        else:
+            raise ValueError(f"Unknown queue backend: {self.backend}")
+        self._store: Optional[TaskStore] = None
+
+    @property
+    def store(self) -> TaskStore:
+        if self._store is None:
+            # Progress of running tasks is kept in their journals, tasks.json only has it as of the last save
+            read_progress = lambda task: self.get_journal(task).read_progress()
+            if self.backend == "sqlite":
+                self._store = SqliteTaskStore(str(self.queue_file), read_progress=read_progress)
+            else:
+                self._store = JsonTaskStore(str(self.queue_file), read_progress=read_progress)
+        return self._store
+
     def _save_task_config(self, task_id: str, config: Dict[str, Any]):
         """Save task-specific configuration to task.json."""
         task_json_path = self.file_manager.get_task_json_path(task_id)
         with open(task_json_path, 'w') as f:
             json.dump(config, f, indent=2, cls=DateTimeEncoder)
-            
+
     def _load_task_config(self, task_id: str) -> Dict[str, Any]:
         """Load task-specific configuration from task.json."""
         task_json_path = self.file_manager.get_task_json_path(task_id)
@@ -49,77 +66,226 @@ class QueueManager:
                 return json.load(f)
         return {}
 
-    def add_task(self, input_file: str, output_file: str, chunk_size: int = 800, memory_size: int = 0) -> RewriteTask:
-        # Create a directory structure for this task
-        task_id, input_file_path, input_file_name = self.file_manager.create_task_directory(input_file)
-        
+    def add_task(
+        self,
+        input_file: str,
+        output_file: str,
+        chunk_size: int = 800,
+        memory_size: int = 0,
+        memory_mode: MemoryMode = MemoryMode.ANSWERS,
+        chunk_tokens: Optional[int] = None,
+        tokenizer: str = "approx",
+        save: bool = True,
+        content: Optional[bytes] = None,
+        priority: int = 0,
+        memory_tokens: Optional[int] = None,
+        summary_interval: int = 8
+    ) -> RewriteTask:
+        from .models import RewriteTask
+        if summary_interval < 1:
+            raise ValueError("summary_interval must be at least 1")
+        # Create a directory structure for this task, uploaded content is written there directly
+        if content is not None:
+            task_id, input_file_path, input_file_name, input_hash = self.file_manager.create_task_directory_from_content(input_file, content)
+        else:
+            task_id, input_file_path, input_file_name, input_hash = self.file_manager.create_task_directory(input_file)
+
         # Get the output file path
         output_file_path = self.file_manager.get_output_path(task_id, Path(output_file).name)
-        
+
         task = RewriteTask(
             id=str(uuid.uuid4()),
             task_id=task_id,
             input_file=input_file_path,
             output_file=output_file_path,
+            input_hash=input_hash,
             chunk_size=chunk_size,
-            memory_size=memory_size
+            chunk_tokens=chunk_tokens,
+            tokenizer=tokenizer,
+            memory_size=memory_size,
+            memory_mode=memory_mode,
+            memory_tokens=memory_tokens,
+            summary_interval=summary_interval,
+            priority=priority
         )
-        
+
         # Save task-specific configuration
         self._save_task_config(task_id, {
             "chunk_size": chunk_size,
-            "memory_size": memory_size
+            "chunk_tokens": chunk_tokens,
+            "tokenizer": tokenizer,
+            "memory_size": memory_size,
+            "memory_mode": memory_mode.value,
+            "memory_tokens": memory_tokens,
+            "summary_interval": summary_interval,
+            "priority": priority
         })
-        
-        self.tasks.append(task)
-        self._save_tasks()
+
+        # Callers that write the chunks first save the task themselves, so no worker claims it too early
+        if save:
+            self.store.save_task(task)
         return task
 
+    def save_task(self, task: RewriteTask):
+        """Save the metadata of a task."""
+        self.store.save_task(task)
+
+    def save_tasks(self, tasks: List[RewriteTask]):
+        """Save the metadata of several tasks in one transaction, so a batch is queued as a whole."""
+        self.store.save_tasks(tasks)
+
+    def find_tasks_by_input_hash(self) -> Dict[str, str]:
+        """
+        Map the SHA-256 of every queued input file to the ID of a task it belongs to.
+
+        Tasks queued before input hashes were recorded are hashed from their
+        input file. The hash is not saved, a worker may be updating the task.
+        """
+        from .blobs import file_digest
+        tasks_by_hash = {}
+        for task_id, input_hash in self.store.list_input_hashes().items():
+            if input_hash is None:
+                task = self.get_task(task_id)
+                if task is None or not Path(task.input_file).exists():
+                    continue
+                input_hash = file_digest(task.input_file)
+            tasks_by_hash.setdefault(input_hash, task_id)
+        return tasks_by_hash
+
+    def list_tasks(self, statuses: Optional[List[TaskStatus]] = None) -> List[RewriteTask]:
+        """List tasks in creation order, optionally filtered by status."""
+        return self.store.list_tasks(statuses)
+
+    def list_task_summaries(self, statuses: Optional[List[TaskStatus]] = None) -> List[Dict[str, Any]]:
+        """List the fields shown by list-tasks, without loading whole tasks on the SQLite backend."""
+        return self.store.list_task_summaries(statuses)
+
     def get_task(self, task_id: str) -> Optional[RewriteTask]:
-        return next((task for task in self.tasks if task.id == task_id), None)
+        return self.store.get_task(task_id)
+
+    def find_tasks_by_prefix(self, task_id_prefix: str) -> List[RewriteTask]:
+        """Find tasks whose ID starts with the given prefix."""
+        return self.store.find_tasks_by_prefix(task_id_prefix)
+
+    def delete_task(self, task: RewriteTask):
+        """Remove a task from the queue, its directory is left to the caller."""
+        self.store.delete_task(task.id)
 
     def get_pending_tasks(self) -> List[RewriteTask]:
         """
         Get all tasks that need processing (pending or interrupted).
-        
+
         This method identifies tasks that are either:
         1. In PENDING status (never started)
         2. In PROCESSING status (interrupted during processing)
-        
-        For interrupted tasks, it preserves their processed_chunks count
-        so they can be resumed from where they left off.
+
+        This is a read-only view; workers take tasks with claim_task so that
+        a task being processed by another live worker is never picked up twice.
         """
         # Get tasks that are pending
-        pending_tasks = [task for task in self.tasks if task.status == TaskStatus.PENDING]
-        
+        pending_tasks = self.store.list_tasks([TaskStatus.PENDING])
+
         # Get tasks that were interrupted during processing
-        interrupted_tasks = [task for task in self.tasks if task.status == TaskStatus.PROCESSING]
-        
-        # Reset interrupted tasks to pending but preserve their progress
-        for task in interrupted_tasks:
-            # We don't reset processed_chunks here, so the task will resume from where it left off
-            task.status = TaskStatus.PENDING
-            self._save_tasks()
-        
+        interrupted_tasks = self.get_interrupted_tasks()
+
         return pending_tasks + interrupted_tasks
-    
+
     def get_interrupted_tasks(self) -> List[RewriteTask]:
         """Get tasks that were interrupted during processing."""
-        return [task for task in self.tasks if task.status == TaskStatus.PROCESSING]
+        return self.store.list_tasks([TaskStatus.PROCESSING])
 
-    def update_task_status(self, task_id: str, status: TaskStatus, error_message: Optional[str] = None):
-        task = self.get_task(task_id)
-        if task:
+    def claim_task(self, worker_id: str, task_ids: Optional[Collection[str]] = None) -> Optional[RewriteTask]:
+        """
+        Atomically take the oldest pending or interrupted task for a worker.
+
+        For interrupted tasks, processed_chunks is preserved so they can be
+        resumed from where they left off. With task_ids, only those tasks
+        are taken.
+        """
+        return self.store.claim_task(worker_id, task_ids)
+
+    def claim_chunks(self, task: RewriteTask, chunk_indexes: List[int], worker_id: str) -> bool:
+        """Atomically reserve chunks of a task for a worker, all or nothing."""
+        return self.store.claim_chunks(task.id, chunk_indexes, worker_id)
+
+    def release_chunks(self, task: RewriteTask, worker_id: Optional[str] = None):
+        """Drop the chunk claims of a task."""
+        self.store.release_chunks(task.id, worker_id)
+
+    def record_progress(self, task: RewriteTask):
+        """Record the processed chunk count of a running task, O(1) per chunk."""
+        self.store.update_progress(task.id, task.processed_chunks)
+
+    def update_task_status(
+        self,
+        task_id: str,
+        status: TaskStatus,
+        error_message: Optional[str] = None,
+        failed_chunks: Optional[int] = None
+    ):
+        """
+        Move a task to a new status, a cancelled task stays cancelled.
+
+        The task is read and saved in one transaction, so a cancel from another
+        process is never overwritten by a worker finishing or requeuing the task.
+        """
+        def change(task: RewriteTask) -> bool:
+            if task.status == TaskStatus.CANCELLED:
+                return False
             task.status = status
             if status == TaskStatus.COMPLETED:
                 task.completed_at = datetime.now()
             if error_message:
                 task.error_message = error_message
-            self._save_tasks()
-            
+            elif status not in (TaskStatus.FAILED, TaskStatus.PAUSED):
+                # The error of an earlier failure or pause no longer applies
+                task.error_message = None
+            if failed_chunks is not None:
+                task.failed_chunks = failed_chunks
+            return True
+
+        self.store.update_task(task_id, change)
+
+    def cancel_task(self, task_id: str) -> Optional[RewriteTask]:
+        """
+        Mark a task as cancelled, a worker processing it stops once its next chunk finishes.
+
+        Returns:
+            The task, or None if it does not exist; finished tasks are returned unchanged
+        """
+        def change(task: RewriteTask) -> bool:
+            if task.status in (TaskStatus.COMPLETED, TaskStatus.CANCELLED):
+                return False
+            task.status = TaskStatus.CANCELLED
+            return True
+
+        return self.store.update_task(task_id, change)
+
+    def set_task_budget(self, task_id: str, budget_tokens: Optional[int], budget_cost: Optional[float]) -> Optional[RewriteTask]:
+        """
+        Change the budget of a task, a task paused by its budget is queued again.
+
+        Returns:
+            The task, or None if it does not exist
+        """
+        def change(task: RewriteTask) -> bool:
+            task.budget_tokens = budget_tokens
+            task.budget_cost = budget_cost
+            if task.status == TaskStatus.PAUSED:
+                task.status = TaskStatus.PENDING
+                task.error_message = None
+            return True
+
+        return self.store.update_task(task_id, change)
+
+    def get_journal(self, task: RewriteTask) -> TaskJournal:
+        """Get the result journal of a task."""
+        from .journal import TaskJournal
+        return TaskJournal(self.file_manager, task.task_id)
+
     def get_task_directory(self, task_id: str) -> Optional[Path]:
         """Get the directory for a task if it exists."""
         task = self.get_task(task_id)
         if task:
             return self.file_manager.get_task_directory(task.task_id)
-        return None 
\ No newline at end of file
+        return None
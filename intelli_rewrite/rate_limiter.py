@@ -0,0 +1,188 @@
+import threading
+import time
+from collections import deque
+from typing import Mapping, Optional
+
+class TokenBucket:
+    """
+    Token bucket that hands out reservations.
+
+    A caller takes what it needs right away, possibly driving the bucket
+    negative, and sleeps for the deficit. Callers are served in the order
+    they reserve without holding a lock while they wait.
+    """
+
+    def __init__(self, rate_per_minute: float, burst_seconds: float = 10.0):
+        self.burst_seconds = burst_seconds
+        self.rate_per_minute = rate_per_minute
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    @property
+    def capacity(self) -> float:
+        return max(1.0, self.rate_per_minute / 60 * self.burst_seconds)
+
+    def set_rate(self, rate_per_minute: float):
+        self._refill()
+        self.rate_per_minute = rate_per_minute
+        self.tokens = min(self.tokens, self.capacity)
+
+    def reserve(self, amount: float) -> float:
+        """Take `amount` tokens and return how long to wait until they are covered."""
+        self._refill()
+        # A single request larger than the burst would never fit, let it drain the bucket instead
+        self.tokens -= min(amount, self.capacity)
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens / (self.rate_per_minute / 60)
+
+    def adjust(self, amount: float):
+        """Give back (positive) or take (negative) tokens after the real cost is known."""
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate_per_minute / 60)
+        self.updated = now
+
+class AdaptiveRateLimiter:
+    """
+    Client-side requests-per-minute and tokens-per-minute limiter with AIMD.
+
+    Limits start from the configured values, or unlimited. A 429 halves the
+    current limits (starting from the observed rate when no limit was set)
+    and pauses every caller for Retry-After; a burst of 429s within the
+    cooldown counts once. Each success adds a small step back, up to the
+    ceiling, which is the configured limit or the limit the server reports
+    in x-ratelimit-limit-* headers.
+    """
+
+    DECREASE_FACTOR = 0.5
+    DECREASE_COOLDOWN = 5.0  # Seconds
+    INCREASE_RATIO = 0.02  # Of the ceiling, or of the current limit if the ceiling is unknown
+    MIN_RPM = 1.0
+    MIN_TPM = 1000.0
+
+    def __init__(self, rpm: Optional[float] = None, tpm: Optional[float] = None):
+        self._lock = threading.Lock()
+        self.rpm_ceiling = rpm
+        self.tpm_ceiling = tpm
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+        self.paused_until = 0.0
+        self.rate_limited_count = 0
+        self.last_decrease = float("-inf")
+        # (time, tokens) of recent requests, to learn a starting point from the observed rate
+        self._recent = deque()
+
+    def acquire(self, estimated_tokens: int):
+        """Block until a request costing about `estimated_tokens` may be sent."""
+        with self._lock:
+            now = time.monotonic()
+            self._recent.append((now, estimated_tokens))
+            while self._recent and self._recent[0][0] < now - 60:
+                self._recent.popleft()
+            wait = max(0.0, self.paused_until - now)
+            if self.requests:
+                wait = max(wait, self.requests.reserve(1))
+            if self.tokens:
+                wait = max(wait, self.tokens.reserve(estimated_tokens))
+        if wait > 0:
+            time.sleep(wait)
+
+    def on_success(self, estimated_tokens: int, actual_tokens: Optional[int], headers: Optional[Mapping[str, str]] = None):
+        """Correct the token reservation and increase the limits additively."""
+        with self._lock:
+            self._learn_ceilings(headers)
+            if self.tokens and actual_tokens is not None:
+                self.tokens.adjust(estimated_tokens - actual_tokens)
+            if self.requests:
+                self.requests.set_rate(self._increase(self.requests.rate_per_minute, self.rpm_ceiling))
+            if self.tokens:
+                self.tokens.set_rate(self._increase(self.tokens.rate_per_minute, self.tpm_ceiling))
+
+    def on_rate_limited(self, retry_after: Optional[float], headers: Optional[Mapping[str, str]] = None):
+        """Halve the limits and pause all callers after a 429."""
+        with self._lock:
+            now = time.monotonic()
+            self.rate_limited_count += 1
+            self._learn_ceilings(headers)
+            if retry_after:
+                self.paused_until = max(self.paused_until, now + retry_after)
+
+            # Requests already in flight when the limit was hit fail together, count them as one signal
+            if now - self.last_decrease < self.DECREASE_COOLDOWN:
+                return
+            self.last_decrease = now
+
+            # Rate over the span actually observed, the window is not full right after start-up
+            span = max(1.0, now - self._recent[0][0]) if self._recent else 60.0
+            observed_rpm = max(self.MIN_RPM, len(self._recent) * 60 / span)
+            observed_tpm = max(self.MIN_TPM, sum(tokens for _, tokens in self._recent) * 60 / span)
+            current_rpm = self.requests.rate_per_minute if self.requests else observed_rpm
+            current_tpm = self.tokens.rate_per_minute if self.tokens else observed_tpm
+            new_rpm = max(self.MIN_RPM, current_rpm * self.DECREASE_FACTOR)
+            new_tpm = max(self.MIN_TPM, current_tpm * self.DECREASE_FACTOR)
+
+            if self.requests:
+                self.requests.set_rate(new_rpm)
+            else:
+                self.requests = TokenBucket(new_rpm)
+            if self.tokens:
+                self.tokens.set_rate(new_tpm)
+            else:
+                self.tokens = TokenBucket(new_tpm)
+
+    def limits(self) -> dict:
+        """Get the current limits, None means unlimited."""
+        with self._lock:
+            return {
+                "rpm": self.requests.rate_per_minute if self.requests else None,
+                "tpm": self.tokens.rate_per_minute if self.tokens else None,
+                "rate_limited": self.rate_limited_count
+            }
+
+    def _increase(self, current: float, ceiling: Optional[float]) -> float:
+        step = (ceiling or current) * self.INCREASE_RATIO
+        increased = current + step
+        return min(increased, ceiling) if ceiling else increased
+
+    def _learn_ceilings(self, headers: Optional[Mapping[str, str]]):
+        if not headers:
+            return
+        limit_requests = _header_number(headers, "x-ratelimit-limit-requests")
+        limit_tokens = _header_number(headers, "x-ratelimit-limit-tokens")
+        if limit_requests:
+            self.rpm_ceiling = limit_requests
+        if limit_tokens:
+            self.tpm_ceiling = limit_tokens
+
+def _header_number(headers: Mapping[str, str], name: str) -> Optional[float]:
+    value = headers.get(name)
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+def parse_retry_after(headers: Optional[Mapping[str, str]]) -> Optional[float]:
+    """Read Retry-After (seconds or an HTTP date) or retry-after-ms from response headers."""
+    if not headers:
+        return None
+    retry_after_ms = _header_number(headers, "retry-after-ms")
+    if retry_after_ms is not None:
+        return retry_after_ms / 1000
+    value = headers.get("retry-after")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        from email.utils import parsedate_to_datetime
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
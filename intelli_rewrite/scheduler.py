@@ -0,0 +1,270 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional
+from .models import RewriteTask
+from .assembler import OutputAssembler
+from .journal import TaskJournal
+from .memory import chunk_dependencies, build_memory_context
+
+# fair: weighted fair queuing by priority, srf: shortest remaining task first, fifo: queue order
+SCHEDULING_POLICIES = ("fair", "srf", "fifo")
+
+@dataclass
+class TaskRun:
+    """Scheduling state of one task during a processing run."""
+    task: RewriteTask
+    chunks_data: List[dict]
+    pending_chunks: List[dict]
+    journal: TaskJournal
+    qa_json_path: str
+    output_path: str
+    assembler: OutputAssembler  # Writes the output file as chunks are committed
+    progress_id: Optional[int] = None
+    next_submit: int = 0
+    next_commit: int = 0
+    in_flight: int = 0
+    failed: bool = False
+    finished: Dict[int, Any] = field(default_factory=dict)
+    activated_at: float = 0.0  # Monotonic time the run was scheduled
+    last_commit_at: Optional[float] = None  # Monotonic time of the last commit
+    virtual_time: float = 0.0  # Characters sent so far divided by the task's weight, for fair queuing
+
+    @property
+    def weight(self) -> float:
+        # Each priority step doubles the task's share of the workers
+        return 2.0 ** max(-10, min(10, self.task.priority))
+
+    @property
+    def remaining(self) -> int:
+        return len(self.pending_chunks) - self.next_submit
+
+    @property
+    def done(self) -> bool:
+        return self.failed or self.next_commit >= len(self.pending_chunks)
+
+    def has_ready_chunk(self) -> bool:
+        """Check whether the next chunk can be sent without waiting for other chunks."""
+        if self.failed or self.next_submit >= len(self.pending_chunks):
+            return False
+        chunk_index = self.pending_chunks[self.next_submit]["index"]
+        if not chunk_dependencies(self.task, chunk_index):
+            return True
+        # Results are committed in order, so every dependency is available once
+        # all chunks submitted so far have been committed
+        return self.next_commit == self.next_submit
+
+class ChunkScheduler:
+    """
+    Run the chunks of several tasks on a bounded worker pool.
+    
+    Chunks without memory dependencies are sent as soon as a worker is free.
+    Chunks that replay earlier answers wait until those answers are committed,
+    and the pool is shared across tasks so that such tasks still run side by side.
+    
+    More tasks than workers are kept active, so a short task claimed while a
+    long one runs gets its share at once. With the fair policy every free
+    worker goes to the task that received the fewest characters relative to
+    its weight, with srf to the highest priority task with the fewest chunks
+    left, and with fifo every task with a ready chunk gets a slot before the
+    remaining slots are filled in queue order.
+    """
+
+    STOP_CHECK_INTERVAL = 1.0
+
+    def __init__(
+        self,
+        rewrite: Callable[[RewriteTask, dict, list, float], Any],
+        commit: Callable[[TaskRun, Any], None],
+        on_task_done: Callable[[TaskRun], None],
+        on_task_failed: Callable[[TaskRun, Exception], None],
+        concurrency: int = 1,
+        abort_on: tuple = (),
+        policy: str = "fair",
+        max_active: Optional[int] = None
+    ):
+        """
+        Args:
+            rewrite: Sends one chunk, called on a worker thread with the task, the chunk, its memory
+                context and the seconds the chunk waited for a worker since it became ready
+            commit: Records a result, called in chunk order for each task
+            on_task_done: Called once all chunks of a task are committed
+            on_task_failed: Called when rewrite or commit raises for a task
+            concurrency: Number of chunk requests to keep in flight
+            abort_on: Exception types that stop the whole run instead of failing one task
+            policy: How free workers are shared between tasks, one of SCHEDULING_POLICIES
+            max_active: Number of tasks to keep active, default: twice the concurrency and at least 8
+        """
+        if policy not in SCHEDULING_POLICIES:
+            raise ValueError(f"Unknown scheduling policy: {policy}")
+        self.rewrite = rewrite
+        self.commit = commit
+        self.on_task_done = on_task_done
+        self.on_task_failed = on_task_failed
+        self.concurrency = max(1, concurrency)
+        self.abort_on = abort_on
+        self.policy = policy
+        self.max_active = max_active or max(8, 2 * self.concurrency)
+        self.abandoned = 0  # Requests still in flight when a stopped run gave up waiting
+
+    def run(
+        self,
+        runs: List[TaskRun],
+        claim_next: Optional[Callable[[], Optional[TaskRun]]] = None,
+        keep_claiming: bool = False,
+        stop: Optional[threading.Event] = None,
+        drain_timeout: Optional[float] = None
+    ) -> List[TaskRun]:
+        """
+        Process all runs until every task is done or failed, or until stopped.
+        
+        Args:
+            runs: Task runs to start with
+            claim_next: Optional callback that claims one more task from the queue,
+                called while fewer than `concurrency` tasks are active
+            keep_claiming: Keep calling claim_next after it found nothing, so that tasks
+                added while others are running are picked up
+            stop: Once set, no more tasks are claimed and no more chunks are sent; the chunks
+                in flight are waited for and committed
+            drain_timeout: Seconds to wait for the chunks in flight once stop is set
+        
+        Returns:
+            Runs left unfinished because the run was stopped
+        """
+        executor = ThreadPoolExecutor(max_workers=self.concurrency)
+        futures = {}
+        active = []
+        self.abandoned = 0
+        deadline = None
+        try:
+            for run in runs:
+                self._activate(run, active)
+            
+            while True:
+                stopping = stop is not None and stop.is_set()
+                if stopping and deadline is None and drain_timeout is not None:
+                    deadline = time.monotonic() + drain_timeout
+                
+                # Claim tasks one at a time, so that other workers draining the same queue get their share
+                while claim_next and not stopping and len(active) < self.max_active:
+                    run = claim_next()
+                    if run is None:
+                        if not keep_claiming:
+                            claim_next = None
+                        break
+                    self._activate(run, active)
+                
+                if not active:
+                    break
+                
+                if not stopping:
+                    self._fill(active, executor, futures)
+                if not futures:
+                    break
+                
+                # Wake up now and then to notice a stop request
+                timeout = None
+                if deadline is not None:
+                    timeout = max(0.0, deadline - time.monotonic())
+                elif stop is not None and not stopping:
+                    timeout = self.STOP_CHECK_INTERVAL
+                done, _ = wait(futures, timeout=timeout, return_when=FIRST_COMPLETED)
+                if not done and deadline is not None and time.monotonic() >= deadline:
+                    self.abandoned = len(futures)
+                    break
+                for future in done:
+                    run, position = futures.pop(future)
+                    run.in_flight -= 1
+                    if run.failed:
+                        continue
+                    try:
+                        run.finished[position] = future.result()
+                        # Commit every result that continues the contiguous prefix
+                        while run.next_commit in run.finished:
+                            self.commit(run, run.finished.pop(run.next_commit))
+                            run.next_commit += 1
+                            run.last_commit_at = time.monotonic()
+                    except Exception as e:
+                        self._fail(run, active, e)
+                        continue
+                    if run.done:
+                        active.remove(run)
+                        self.on_task_done(run)
+            
+            if stopping:
+                # Keep the answers that finished behind a chunk still in flight, a resumed run skips them
+                for run in list(active):
+                    if run.failed:
+                        continue
+                    try:
+                        for position in sorted(run.finished):
+                            self.commit(run, run.finished.pop(position))
+                    except Exception as e:
+                        # E.g. the task was cancelled or ran out of budget meanwhile
+                        self._fail(run, active, e)
+            return active
+        finally:
+            # Drop queued requests on interruption; finished results are already committed.
+            # Requests in flight cannot be aborted, the endpoint timeout bounds how long exit waits for them
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def _fail(self, run: TaskRun, active: List[TaskRun], error: Exception):
+        """Drop a task whose commit failed, errors in abort_on stop the whole run instead."""
+        if isinstance(error, self.abort_on):
+            raise error
+        run.failed = True
+        run.finished.clear()
+        active.remove(run)
+        self.on_task_failed(run, error)
+
+    def _activate(self, run: TaskRun, active: List[TaskRun]):
+        run.activated_at = time.monotonic()
+        if run.done:
+            self.on_task_done(run)
+            return
+        # Start from the slowest active task, so a new task neither waits for its
+        # turn nor takes over the workers to catch up with the others
+        run.virtual_time = max(run.virtual_time, min((other.virtual_time for other in active), default=0.0))
+        active.append(run)
+
+    def _fill(self, runs: List[TaskRun], executor: ThreadPoolExecutor, futures: dict):
+        if self.policy == "fifo":
+            # First pass: one slot for every task with nothing in flight
+            for run in runs:
+                if len(futures) >= self.concurrency:
+                    return
+                if run.in_flight == 0 and run.has_ready_chunk():
+                    self._submit(run, executor, futures)
+            
+            # Second pass: fill the remaining slots in queue order
+            for run in runs:
+                while len(futures) < self.concurrency and run.has_ready_chunk():
+                    self._submit(run, executor, futures)
+            return
+        
+        while len(futures) < self.concurrency:
+            ready = [run for run in runs if run.has_ready_chunk()]
+            if not ready:
+                return
+            if self.policy == "srf":
+                run = min(ready, key=lambda run: (-run.task.priority, run.remaining))
+            else:
+                run = min(ready, key=lambda run: (run.virtual_time, -run.task.priority))
+            self._submit(run, executor, futures)
+
+    def _submit(self, run: TaskRun, executor: ThreadPoolExecutor, futures: dict):
+        chunk_data = run.pending_chunks[run.next_submit]
+        memory_context = build_memory_context(run.task, chunk_data["index"], run.chunks_data)
+        # A chunk that replays earlier answers became ready with the last commit
+        ready_at = run.activated_at
+        if chunk_dependencies(run.task, chunk_data["index"]) and run.last_commit_at is not None:
+            ready_at = max(ready_at, run.last_commit_at)
+        future = executor.submit(self._rewrite, run.task, chunk_data, memory_context, ready_at)
+        futures[future] = (run, run.next_submit)
+        run.next_submit += 1
+        run.in_flight += 1
+        run.virtual_time += max(1, chunk_data.get("char_count", 1)) / run.weight
+
+    def _rewrite(self, task: RewriteTask, chunk_data: dict, memory_context: list, ready_at: float):
+        return self.rewrite(task, chunk_data, memory_context, time.monotonic() - ready_at)
@@ -0,0 +1,504 @@
+from __future__ import annotations
+
+import json
+import os
+import socket
+import sqlite3
+import threading
+import uuid
+from abc import ABC, abstractmethod
+from datetime import datetime
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Callable, Collection, Dict, List, Optional, Tuple
+from .enums import TaskStatus
+
+if TYPE_CHECKING:
+    from .models import RewriteTask
+
+# Fields shown by list-tasks
+SUMMARY_FIELDS = (
+    "id", "task_id", "input_file", "output_file", "status", "processed_chunks",
+    "failed_chunks", "total_chunks", "chunk_size", "memory_size", "priority", "created_at"
+)
+
+class DateTimeEncoder(json.JSONEncoder):
+    def default(self, obj):
+        if isinstance(obj, datetime):
+            return obj.isoformat()
+        return super().default(obj)
+
+def current_worker_id() -> str:
+    """Identify this process as a queue worker."""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+def worker_is_alive(worker_id: Optional[str]) -> bool:
+    """
+    Check whether the worker holding a claim is still running.
+
+    Workers on other hosts cannot be checked and are assumed to be alive.
+    """
+    if not worker_id:
+        return False
+    host, _, pid = worker_id.rpartition(":")
+    if host != socket.gethostname():
+        return True
+    try:
+        os.kill(int(pid), 0)
+    except (ValueError, ProcessLookupError):
+        return False
+    except PermissionError:
+        return True
+    return True
+
+class TaskStore(ABC):
+    """
+    Storage backend behind QueueManager.
+
+    Backends hold task metadata only; Q&A pairs live in each task's journal.
+    """
+
+    @abstractmethod
+    def list_tasks(self, statuses: Optional[List[TaskStatus]] = None) -> List[RewriteTask]:
+        """List tasks in creation order, optionally filtered by status."""
+
+    def list_task_summaries(self, statuses: Optional[List[TaskStatus]] = None) -> List[Dict[str, Any]]:
+        """List the SUMMARY_FIELDS of tasks in creation order, without building full tasks where the backend can."""
+        return [{name: getattr(task, name) for name in SUMMARY_FIELDS} for task in self.list_tasks(statuses)]
+
+    @abstractmethod
+    def get_task(self, task_id: str) -> Optional[RewriteTask]:
+        ...
+
+    @abstractmethod
+    def find_tasks_by_prefix(self, prefix: str) -> List[RewriteTask]:
+        ...
+
+    @abstractmethod
+    def save_task(self, task: RewriteTask):
+        """Insert or replace the metadata of a task."""
+
+    def save_tasks(self, tasks: List[RewriteTask]):
+        """Insert or replace the metadata of several tasks at once, all or none where the backend can."""
+        for task in tasks:
+            self.save_task(task)
+
+    def list_input_hashes(self) -> Dict[str, Optional[str]]:
+        """Map the ID of every task to the SHA-256 of its input file, None for tasks queued before it was recorded."""
+        return {task.id: task.input_hash for task in self.list_tasks()}
+
+    @abstractmethod
+    def update_task(self, task_id: str, change: Callable[[RewriteTask], bool]) -> Optional[RewriteTask]:
+        """
+        Change a task atomically, without losing changes other processes make meanwhile.
+
+        change is called with the task as currently stored and returns whether
+        it changed it; it must return False before changing anything. The
+        task is saved only if it was changed.
+
+        Returns:
+            The task as stored afterwards, None if it does not exist
+        """
+
+    @abstractmethod
+    def delete_task(self, task_id: str):
+        ...
+
+    @abstractmethod
+    def update_progress(self, task_id: str, processed_chunks: int):
+        """Record the processed chunk count of a running task."""
+
+    @abstractmethod
+    def claim_task(self, worker_id: str, task_ids: Optional[Collection[str]] = None) -> Optional[RewriteTask]:
+        """
+        Atomically move the claimable task with the highest priority, and among
+        those the oldest, to PROCESSING for a worker.
+
+        A task is claimable if it is PENDING, or PROCESSING under a worker
+        that is no longer running (an interrupted run). With task_ids, only
+        those tasks are considered.
+        """
+
+    @abstractmethod
+    def claim_chunks(self, task_id: str, chunk_indexes: List[int], worker_id: str) -> bool:
+        """
+        Atomically reserve chunks for a worker.
+
+        Either every chunk is reserved, or none is and False is returned
+        because a live worker holds at least one of them.
+        """
+
+    @abstractmethod
+    def release_chunks(self, task_id: str, worker_id: Optional[str] = None):
+        """Drop the chunk claims of a task, or only those held by one worker."""
+
+class JsonTaskStore(TaskStore):
+    """
+    Keep all tasks in a single tasks.json file.
+
+    Claims are only atomic within one process, use the SQLite backend to run
+    several workers against the same queue.
+    """
+
+    def __init__(self, queue_file: str, read_progress: Optional[Callable[[RewriteTask], Optional[int]]] = None):
+        self.queue_file = Path(queue_file)
+        self.tasks: Dict[str, RewriteTask] = {}
+        self.chunk_claims: Dict[Tuple[str, int], str] = {}
+        self._lock = threading.Lock()
+        self._load_tasks(read_progress)
+
+    def _load_tasks(self, read_progress):
+        from .models import RewriteTask
+        if self.queue_file.exists():
+            with open(self.queue_file, 'r') as f:
+                data = json.load(f)
+                # Handle transition: add task_id if missing
+                for task_data in data:
+                    if 'task_id' not in task_data:
+                        # Generate a task_id for existing tasks
+                        task_data['task_id'] = str(uuid.uuid4())
+                    # Old queues kept a copy of every Q&A pair here, qa_pairs.json has them
+                    task_data.pop('qa_pairs', None)
+                self.tasks = {task.id: task for task in (RewriteTask(**task_data) for task_data in data)}
+
+        # Progress of unfinished tasks lives in their journals, not in tasks.json
+        if read_progress:
+            for task in self.tasks.values():
+                if task.status != TaskStatus.COMPLETED:
+                    processed_chunks = read_progress(task)
+                    if processed_chunks is not None:
+                        task.processed_chunks = processed_chunks
+
+    def _save_tasks(self):
+        # Q&A pairs are kept in each task's journal and qa_pairs.json, summaries in memory_summaries.json, tasks.json only holds metadata
+        with open(self.queue_file, 'w') as f:
+            json.dump([task.model_dump(exclude={"qa_pairs", "memory_summaries"}) for task in self.tasks.values()], f, indent=2, cls=DateTimeEncoder)
+
+    def list_tasks(self, statuses: Optional[List[TaskStatus]] = None) -> List[RewriteTask]:
+        return [task for task in self.tasks.values() if statuses is None or task.status in statuses]
+
+    def get_task(self, task_id: str) -> Optional[RewriteTask]:
+        return self.tasks.get(task_id)
+
+    def find_tasks_by_prefix(self, prefix: str) -> List[RewriteTask]:
+        return [task for task in self.tasks.values() if task.id.startswith(prefix)]
+
+    def save_task(self, task: RewriteTask):
+        with self._lock:
+            self.tasks[task.id] = task
+            self._save_tasks()
+
+    def save_tasks(self, tasks: List[RewriteTask]):
+        # tasks.json is written once for the whole batch
+        with self._lock:
+            for task in tasks:
+                self.tasks[task.id] = task
+            self._save_tasks()
+
+    def update_task(self, task_id: str, change: Callable[[RewriteTask], bool]) -> Optional[RewriteTask]:
+        with self._lock:
+            task = self.tasks.get(task_id)
+            if task is not None and change(task):
+                self._save_tasks()
+            return task
+
+    def delete_task(self, task_id: str):
+        with self._lock:
+            self.tasks.pop(task_id, None)
+            self._save_tasks()
+
+    def update_progress(self, task_id: str, processed_chunks: int):
+        # The task's progress journal already records this, tasks.json is not rewritten per chunk
+        task = self.tasks.get(task_id)
+        if task:
+            task.processed_chunks = processed_chunks
+
+    def claim_task(self, worker_id: str, task_ids: Optional[Collection[str]] = None) -> Optional[RewriteTask]:
+        with self._lock:
+            # Highest priority first, then in creation order
+            for task in sorted(self.tasks.values(), key=lambda task: -task.priority):
+                if task_ids is not None and task.id not in task_ids:
+                    continue
+                interrupted = task.status == TaskStatus.PROCESSING and task.worker_id != worker_id and not worker_is_alive(task.worker_id)
+                if task.status == TaskStatus.PENDING or interrupted:
+                    task.status = TaskStatus.PROCESSING
+                    task.worker_id = worker_id
+                    self._save_tasks()
+                    return task
+        return None
+
+    def claim_chunks(self, task_id: str, chunk_indexes: List[int], worker_id: str) -> bool:
+        with self._lock:
+            for chunk_index in chunk_indexes:
+                holder = self.chunk_claims.get((task_id, chunk_index))
+                if holder and holder != worker_id and worker_is_alive(holder):
+                    return False
+            for chunk_index in chunk_indexes:
+                self.chunk_claims[(task_id, chunk_index)] = worker_id
+            return True
+
+    def release_chunks(self, task_id: str, worker_id: Optional[str] = None):
+        with self._lock:
+            for key, holder in list(self.chunk_claims.items()):
+                if key[0] == task_id and (worker_id is None or holder == worker_id):
+                    del self.chunk_claims[key]
+
+class SqliteTaskStore(TaskStore):
+    """
+    Keep tasks in a SQLite database in WAL mode.
+
+    Lookups by id, id prefix and status use indexes, claims take the next
+    task off an index on (status, priority, created_at) inside BEGIN IMMEDIATE
+    transactions, so several worker processes on one machine
+    can drain the same queue.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS tasks (
+            id TEXT PRIMARY KEY,
+            status TEXT NOT NULL,
+            created_at TEXT NOT NULL,
+            processed_chunks INTEGER NOT NULL DEFAULT 0,
+            worker_id TEXT,
+            priority INTEGER NOT NULL DEFAULT 0,
+            data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_tasks_status ON tasks (status, created_at);
+        CREATE INDEX IF NOT EXISTS idx_tasks_created ON tasks (created_at);
+        CREATE TABLE IF NOT EXISTS chunk_claims (
+            task_id TEXT NOT NULL,
+            chunk_index INTEGER NOT NULL,
+            worker_id TEXT NOT NULL,
+            claimed_at TEXT NOT NULL,
+            PRIMARY KEY (task_id, chunk_index)
+        );
+    """
+
+    def __init__(
+        self,
+        db_file: str,
+        legacy_json_file: Optional[str] = "tasks.json",
+        read_progress: Optional[Callable[[RewriteTask], Optional[int]]] = None
+    ):
+        """
+        Args:
+            db_file: Path of the database, created if missing
+            legacy_json_file: tasks.json imported when the database is created
+            read_progress: Reads a task's processed chunk count from its progress
+                journal, so imported tasks keep progress tasks.json did not record
+        """
+        self.db_file = Path(db_file)
+        is_new = not self.db_file.exists()
+        self._lock = threading.RLock()
+        self.conn = sqlite3.connect(str(self.db_file), timeout=30, isolation_level=None, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(self.SCHEMA)
+        self._migrate()
+
+        # Import the tasks of an existing JSON queue the first time the database is created
+        if is_new and legacy_json_file and Path(legacy_json_file).exists():
+            self.save_tasks(JsonTaskStore(legacy_json_file, read_progress=read_progress).list_tasks())
+
+    def _migrate(self):
+        """Bring a database created by an older version up to the current schema."""
+        with self._lock:
+            # Under the write lock, so two workers starting at once do not both alter the table
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                columns = {row["name"] for row in self.conn.execute("PRAGMA table_info(tasks)")}
+                if "priority" not in columns:
+                    self.conn.execute("ALTER TABLE tasks ADD COLUMN priority INTEGER NOT NULL DEFAULT 0")
+                    self.conn.execute("UPDATE tasks SET priority = COALESCE(json_extract(data, '$.priority'), 0)")
+                # Claims read the next task straight off this index
+                self.conn.execute("CREATE INDEX IF NOT EXISTS idx_tasks_claim ON tasks (status, priority DESC, created_at)")
+                self.conn.execute("COMMIT")
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+
+    def _row_to_task(self, row: sqlite3.Row) -> RewriteTask:
+        from .models import RewriteTask
+        task = RewriteTask.model_validate_json(row["data"])
+        # Columns updated in place take precedence over the metadata blob
+        task.status = TaskStatus(row["status"])
+        task.processed_chunks = row["processed_chunks"]
+        task.worker_id = row["worker_id"]
+        return task
+
+    def _query(self, sql: str, params: tuple = ()) -> List[RewriteTask]:
+        with self._lock:
+            rows = self.conn.execute(sql, params).fetchall()
+        return [self._row_to_task(row) for row in rows]
+
+    def list_tasks(self, statuses: Optional[List[TaskStatus]] = None) -> List[RewriteTask]:
+        if statuses is None:
+            return self._query("SELECT * FROM tasks ORDER BY created_at")
+        placeholders = ",".join("?" for _ in statuses)
+        return self._query(
+            f"SELECT * FROM tasks WHERE status IN ({placeholders}) ORDER BY created_at",
+            tuple(status.value for status in statuses)
+        )
+
+    def list_task_summaries(self, statuses: Optional[List[TaskStatus]] = None) -> List[Dict[str, Any]]:
+        # Read the fields straight from the metadata blob, no task is validated
+        columns = ", ".join(f"json_extract(data, '$.{name}') AS {name}" for name in ("task_id", "input_file", "output_file", "total_chunks", "chunk_size", "memory_size"))
+        columns += ", COALESCE(json_extract(data, '$.failed_chunks'), 0) AS failed_chunks"
+        sql = f"SELECT id, status, processed_chunks, created_at, priority, {columns} FROM tasks"
+        params: tuple = ()
+        if statuses is not None:
+            sql += f" WHERE status IN ({','.join('?' for _ in statuses)})"
+            params = tuple(status.value for status in statuses)
+        with self._lock:
+            rows = self.conn.execute(sql + " ORDER BY created_at", params).fetchall()
+        summaries = []
+        for row in rows:
+            summary = {name: row[name] for name in SUMMARY_FIELDS}
+            summary["status"] = TaskStatus(summary["status"])
+            summary["created_at"] = datetime.fromisoformat(summary["created_at"])
+            summaries.append(summary)
+        return summaries
+
+    def get_task(self, task_id: str) -> Optional[RewriteTask]:
+        tasks = self._query("SELECT * FROM tasks WHERE id = ?", (task_id,))
+        return tasks[0] if tasks else None
+
+    def find_tasks_by_prefix(self, prefix: str) -> List[RewriteTask]:
+        # A range scan on the primary key, unlike LIKE which cannot use the index
+        return self._query(
+            "SELECT * FROM tasks WHERE id >= ? AND id < ? ORDER BY created_at",
+            (prefix, prefix + "\uffff")
+        )
+
+    INSERT_TASK = "INSERT OR REPLACE INTO tasks (id, status, created_at, processed_chunks, worker_id, priority, data) VALUES (?, ?, ?, ?, ?, ?, ?)"
+
+    def _task_row(self, task: RewriteTask) -> tuple:
+        return (
+            task.id,
+            task.status.value,
+            task.created_at.isoformat(),
+            task.processed_chunks,
+            task.worker_id,
+            task.priority,
+            task.model_dump_json(exclude={"qa_pairs", "memory_summaries"})
+        )
+
+    def save_task(self, task: RewriteTask):
+        with self._lock:
+            self.conn.execute(self.INSERT_TASK, self._task_row(task))
+
+    def save_tasks(self, tasks: List[RewriteTask]):
+        # One transaction, so workers see the whole batch or none of it and the WAL is synced once
+        rows = [self._task_row(task) for task in tasks]
+        with self._lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                self.conn.executemany(self.INSERT_TASK, rows)
+                self.conn.execute("COMMIT")
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+
+    def update_task(self, task_id: str, change: Callable[[RewriteTask], bool]) -> Optional[RewriteTask]:
+        # The row is read and written back under the write lock, so no other worker can change it in between
+        with self._lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self.conn.execute("SELECT * FROM tasks WHERE id = ?", (task_id,)).fetchone()
+                task = self._row_to_task(row) if row is not None else None
+                if task is not None and change(task):
+                    self.conn.execute(self.INSERT_TASK, self._task_row(task))
+                self.conn.execute("COMMIT")
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+        return task
+
+    def list_input_hashes(self) -> Dict[str, Optional[str]]:
+        with self._lock:
+            rows = self.conn.execute("SELECT id, json_extract(data, '$.input_hash') AS input_hash FROM tasks").fetchall()
+        return {row["id"]: row["input_hash"] for row in rows}
+
+    def delete_task(self, task_id: str):
+        with self._lock:
+            self.conn.execute("DELETE FROM tasks WHERE id = ?", (task_id,))
+            self.conn.execute("DELETE FROM chunk_claims WHERE task_id = ?", (task_id,))
+
+    def update_progress(self, task_id: str, processed_chunks: int):
+        with self._lock:
+            self.conn.execute("UPDATE tasks SET processed_chunks = ? WHERE id = ?", (processed_chunks, task_id))
+
+    def claim_task(self, worker_id: str, task_ids: Optional[Collection[str]] = None) -> Optional[RewriteTask]:
+        if task_ids is not None and not task_ids:
+            # Nothing to choose from, and "id IN ()" is not valid SQL
+            return None
+        scope = ""
+        scope_params: tuple = ()
+        if task_ids is not None:
+            scope = f" AND id IN ({','.join('?' for _ in task_ids)})"
+            scope_params = tuple(task_ids)
+        with self._lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                # The first pending task in line comes off idx_tasks_claim, without sorting the queue
+                candidates = self.conn.execute(
+                    "SELECT id, priority, created_at FROM tasks WHERE status = ?" + scope + " ORDER BY priority DESC, created_at LIMIT 1",
+                    (TaskStatus.PENDING.value,) + scope_params
+                ).fetchall()
+                # Tasks left behind by workers that are gone; there are at most as many running tasks as workers
+                for row in self.conn.execute(
+                    "SELECT id, priority, created_at, worker_id FROM tasks WHERE status = ?" + scope,
+                    (TaskStatus.PROCESSING.value,) + scope_params
+                ):
+                    if row["worker_id"] != worker_id and not worker_is_alive(row["worker_id"]):
+                        candidates.append(row)
+                if not candidates:
+                    self.conn.execute("COMMIT")
+                    return None
+                claimed_id = min(candidates, key=lambda row: (-row["priority"], row["created_at"]))["id"]
+                self.conn.execute(
+                    "UPDATE tasks SET status = ?, worker_id = ? WHERE id = ?",
+                    (TaskStatus.PROCESSING.value, worker_id, claimed_id)
+                )
+                self.conn.execute("COMMIT")
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+        return self.get_task(claimed_id)
+
+    def claim_chunks(self, task_id: str, chunk_indexes: List[int], worker_id: str) -> bool:
+        with self._lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                holders = self.conn.execute(
+                    "SELECT DISTINCT worker_id FROM chunk_claims WHERE task_id = ? AND worker_id != ?",
+                    (task_id, worker_id)
+                ).fetchall()
+                wanted = set(chunk_indexes)
+                for row in holders:
+                    if not worker_is_alive(row["worker_id"]):
+                        continue
+                    held = self.conn.execute(
+                        "SELECT chunk_index FROM chunk_claims WHERE task_id = ? AND worker_id = ?",
+                        (task_id, row["worker_id"])
+                    ).fetchall()
+                    if any(held_row["chunk_index"] in wanted for held_row in held):
+                        self.conn.execute("COMMIT")
+                        return False
+                claimed_at = datetime.now().isoformat()
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO chunk_claims (task_id, chunk_index, worker_id, claimed_at) VALUES (?, ?, ?, ?)",
+                    [(task_id, chunk_index, worker_id, claimed_at) for chunk_index in chunk_indexes]
+                )
+                self.conn.execute("COMMIT")
+                return True
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+
+    def release_chunks(self, task_id: str, worker_id: Optional[str] = None):
+        with self._lock:
+            if worker_id is None:
+                self.conn.execute("DELETE FROM chunk_claims WHERE task_id = ?", (task_id,))
+            else:
+                self.conn.execute("DELETE FROM chunk_claims WHERE task_id = ? AND worker_id = ?", (task_id, worker_id))
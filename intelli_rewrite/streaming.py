@@ -0,0 +1,90 @@
+import os
+import threading
+from pathlib import Path
+from typing import Tuple
+
+class PartialOutput:
+    """
+    Files a streamed chunk response is appended to as it arrives.
+
+    The answer and the reasoning go to separate files. Once the response is
+    complete a marker file is written, so a restarted run reuses the answer
+    instead of asking again, and a response that broke off can be continued
+    from what was already received.
+    """
+
+    def __init__(self, answer_path: str, reasoning_path: str):
+        self.answer_path = Path(answer_path)
+        self.reasoning_path = Path(reasoning_path)
+        self.done_path = Path(f"{answer_path}.done")
+        self._lock = threading.Lock()
+        self._answer_file = None
+        self._reasoning_file = None
+        self._finished = False
+
+    @property
+    def finished(self) -> bool:
+        return self.done_path.exists()
+
+    def load(self) -> Tuple[str, str]:
+        """Read what has been received so far, as (answer, reasoning)."""
+        with self._lock:
+            self._flush()
+            return _read(self.answer_path), _read(self.reasoning_path)
+
+    def append(self, answer: str = "", reasoning: str = ""):
+        """Append streamed text and flush it, so the files can be followed while the chunk runs."""
+        with self._lock:
+            if self._finished:
+                # A cancelled duplicate request still streaming, the answer is already settled
+                return
+            if self._answer_file is None:
+                self._answer_file = open(self.answer_path, 'a', encoding='utf-8')
+                self._reasoning_file = open(self.reasoning_path, 'a', encoding='utf-8')
+            if answer:
+                self._answer_file.write(answer)
+                self._answer_file.flush()
+            if reasoning:
+                self._reasoning_file.write(reasoning)
+                self._reasoning_file.flush()
+
+    def reset(self):
+        """Drop what was received, the next attempt starts over."""
+        with self._lock:
+            self._close()
+            for path in (self.answer_path, self.reasoning_path, self.done_path):
+                path.unlink(missing_ok=True)
+
+    def finish(self, answer: str, reasoning: str):
+        """Write the final response and mark it complete."""
+        with self._lock:
+            self._finished = True
+            self._close()
+            for path, text in ((self.answer_path, answer), (self.reasoning_path, reasoning)):
+                tmp_path = path.with_name(path.name + ".tmp")
+                tmp_path.write_text(text, encoding='utf-8')
+                os.replace(tmp_path, path)
+            self.done_path.touch()
+
+    def discard(self):
+        """Remove the files once the chunk is committed."""
+        with self._lock:
+            self._finished = True
+            self._close()
+            for path in (self.answer_path, self.reasoning_path, self.done_path):
+                path.unlink(missing_ok=True)
+
+    def _flush(self):
+        if self._answer_file is not None:
+            self._answer_file.flush()
+            self._reasoning_file.flush()
+
+    def _close(self):
+        if self._answer_file is not None:
+            self._answer_file.close()
+            self._reasoning_file.close()
+            self._answer_file = None
+            self._reasoning_file = None
+
+def _read(path: Path) -> str:
+    return path.read_text(encoding='utf-8') if path.exists() else ""
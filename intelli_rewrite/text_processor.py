@@ -1,5 +1,7 @@
+import hashlib
+import re
 from dataclasses import dataclass
-from typing import List
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple
 
 @dataclass
 class TextChunk:
@@ -7,56 +9,267 @@ class TextChunk:
     start_line: int
     end_line: int
     char_count: int
+    token_count: int = 0
+
+    @property
+    def content_hash(self) -> str:
+        """Hash of the chunk text, used to recognize unchanged chunks."""
+        return content_hash(self.content)
+
+def content_hash(content: str) -> str:
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+def approximate_tokens(text: str) -> int:
+    """
+    Estimate the token count of a text without a tokenizer.
+
+    ASCII text averages about 0.3 tokens per character and CJK text about
+    0.6. Non-ASCII characters take 2-3 bytes in UTF-8, so the byte length
+    gives their count without a per-character loop.
+    """
+    chars = len(text)
+    non_ascii = (len(text.encode('utf-8')) - chars) // 2
+    return _estimate_tokens(chars, non_ascii) + (1 if text else 0)
+
+def _estimate_tokens(chars: int, non_ascii: int) -> int:
+    return int((chars - non_ascii) * 0.3 + non_ascii * 0.6)
+
+class StreamTokenCounter:
+    """
+    Estimate the tokens of a text that arrives in pieces, such as a streamed response.
+
+    Uses the estimate of approximate_tokens on the whole text so far, so pieces
+    of a few characters are not each rounded up to a token.
+    """
+
+    def __init__(self):
+        self.chars = 0
+        self.non_ascii = 0
+        self.counted = 0
+
+    def add(self, text: str) -> int:
+        """Add a piece of text, returns the number of tokens it completes."""
+        self.chars += len(text)
+        self.non_ascii += (len(text.encode('utf-8')) - len(text)) // 2
+        total = _estimate_tokens(self.chars, self.non_ascii)
+        new_tokens, self.counted = total - self.counted, total
+        return new_tokens
+
+def make_token_counter(tokenizer: str = "approx") -> Tuple[str, Callable[[str], int]]:
+    """
+    Get a token counting function.
+
+    Args:
+        tokenizer: "approx" for the built-in estimate, or "tiktoken" to use an
+            installed tiktoken encoding (falls back to the estimate if tiktoken
+            or its encoding file is not available offline)
+
+    Returns:
+        Tuple containing the name of the tokenizer actually used and the counter
+    """
+    if tokenizer == "tiktoken":
+        try:
+            import tiktoken
+            encoding = tiktoken.get_encoding("cl100k_base")
+            return "tiktoken", lambda text: len(encoding.encode(text, disallowed_special=()))
+        except Exception:
+            pass
+    return "approx", approximate_tokens
+
+FENCE_RE = re.compile(r'^\s*(```|~~~)')
+HEADING_RE = re.compile(r'^#{1,6}\s')
+
+@dataclass
+class _Unit:
+    """A run of lines that should stay together in one chunk if it fits."""
+    lines: List[str]
+    start_line: int
+    is_heading: bool = False
 
 class TextProcessor:
-    def __init__(self, chunk_size: int = 800):
+    # A heading starts a new chunk once the current chunk is at least this full
+    HEADING_BREAK_RATIO = 0.5
+
+    def __init__(self, chunk_size: int = 800, chunk_tokens: Optional[int] = None, tokenizer: str = "approx"):
+        """
+        Initialize the chunker.
+
+        Args:
+            chunk_size: Budget per chunk in characters, used when chunk_tokens is not set
+            chunk_tokens: Budget per chunk in tokens
+            tokenizer: Token counter to use with chunk_tokens, see make_token_counter
+        """
         self.chunk_size = chunk_size
+        self.chunk_tokens = chunk_tokens
+        self.tokenizer, self.count_tokens = make_token_counter(tokenizer)
+        if chunk_tokens:
+            self.budget = chunk_tokens
+            self.measure = self.count_tokens
+        else:
+            self.budget = chunk_size
+            self.measure = len
 
     def split_into_chunks(self, text: str) -> List[TextChunk]:
-        """Split text into chunks of approximately chunk_size characters, respecting paragraph boundaries."""
-        lines = text.split('\n')
-        chunks = []
-        current_line = 0
-        total_lines = len(lines)
-
-        while current_line < total_lines:
-            # Start a new chunk
-            chunk_start_line = current_line
-            current_chars = 0
-            chunk_end_line = current_line
-            
-            # Process lines until we reach the chunk size
-            while current_line < total_lines:
-                line = lines[current_line]
-                line_chars = len(line)
-                
-                # If adding this line would exceed the chunk size, end the chunk here
-                if current_chars + line_chars > self.chunk_size and current_chars > 0:
-                    break
-                
-                # Add this line to the current chunk
-                current_chars += line_chars
-                chunk_end_line = current_line
-                current_line += 1
-            
-            # If we didn't add any lines (empty lines), move to the next line
-            if chunk_end_line < chunk_start_line:
-                current_line += 1
-                continue
-                
-            # Create the chunk
-            chunk_content = '\n'.join(lines[chunk_start_line:chunk_end_line + 1])
-            chunks.append(TextChunk(
-                content=chunk_content,
-                start_line=chunk_start_line,
-                end_line=chunk_end_line,
-                char_count=current_chars
-            ))
-
-        return chunks
+        """Split text into chunks that fit the budget, respecting paragraph and markdown block boundaries."""
+        return list(self.iter_chunks(text.split('\n')))
 
     def process_file(self, file_path: str) -> List[TextChunk]:
         """Process a file and return its chunks."""
+        return list(self.iter_file_chunks(file_path))
+
+    def iter_file_chunks(self, file_path: str) -> Iterator[TextChunk]:
+        """Read a file line by line and yield its chunks, the file is never fully loaded."""
         with open(file_path, 'r', encoding='utf-8') as f:
-            content = f.read()
-        return self.split_into_chunks(content) 
\ No newline at end of file
+            yield from self.iter_chunks(line.rstrip('\n') for line in f)
+
+    def iter_chunks(self, lines: Iterable[str]) -> Iterator[TextChunk]:
+        """
+        Pack lines into chunks of at most `budget`.
+
+        Fenced code and $$ math blocks are kept whole when they fit, headings
+        start a new chunk once the current one is half full, and units or
+        single lines larger than the budget are split on their own.
+        """
+        current: List[str] = []
+        current_start = 0
+        current_size = 0
+
+        for unit in self._iter_units(lines):
+            unit_size = self.measure('\n'.join(unit.lines))
+
+            if unit_size > self.budget:
+                if current:
+                    yield self._make_chunk(current, current_start)
+                    current, current_size = [], 0
+                yield from self._split_oversized(unit)
+                continue
+
+            starts_section = unit.is_heading and current_size >= self.budget * self.HEADING_BREAK_RATIO
+            if current and (current_size + unit_size > self.budget or starts_section):
+                yield self._make_chunk(current, current_start)
+                current, current_size = [], 0
+
+            if not current:
+                current_start = unit.start_line
+            current.extend(unit.lines)
+            current_size += unit_size
+
+        if current:
+            yield self._make_chunk(current, current_start)
+
+    def _iter_units(self, lines: Iterable[str]) -> Iterator[_Unit]:
+        """Group lines into units: single lines, or whole fenced code / math blocks."""
+        block: Optional[_Unit] = None
+        block_size = 0
+        closing = None
+        # Closer of a block that was given up on, the lines up to it are plain lines
+        draining = None
+
+        for line_number, line in enumerate(lines):
+            if draining is not None:
+                # Inside the block, so neither a heading nor the start of another block
+                if self._closes_block(line, draining):
+                    draining = None
+                yield _Unit(lines=[line], start_line=line_number)
+                continue
+
+            if block is not None:
+                block.lines.append(line)
+                block_size += self.measure(line)
+                if self._closes_block(line, closing):
+                    yield block
+                    block = None
+                elif block_size > self.budget:
+                    # An unterminated or huge block is split at line boundaries anyway, stop buffering it
+                    yield block
+                    block = None
+                    draining = closing
+                continue
+
+            opener = self._opens_block(line)
+            if opener:
+                block = _Unit(lines=[line], start_line=line_number)
+                block_size = self.measure(line)
+                closing = opener
+                continue
+
+            yield _Unit(lines=[line], start_line=line_number, is_heading=bool(HEADING_RE.match(line)))
+
+        if block is not None:
+            yield block
+
+    @staticmethod
+    def _opens_block(line: str) -> Optional[str]:
+        match = FENCE_RE.match(line)
+        if match:
+            return match.group(1)
+        stripped = line.strip()
+        # A $$ line opens a math block unless it also closes it, e.g. "$$ x^2 $$"
+        if stripped.startswith('$$') and stripped.count('$$') % 2 == 1:
+            return '$$'
+        return None
+
+    @staticmethod
+    def _closes_block(line: str, closing: str) -> bool:
+        if closing == '$$':
+            return '$$' in line
+        return line.strip().startswith(closing)
+
+    def _split_oversized(self, unit: _Unit) -> Iterator[TextChunk]:
+        """Split a unit larger than the budget at line boundaries, and long lines at word boundaries."""
+        current: List[str] = []
+        current_start = unit.start_line
+        current_size = 0
+
+        for offset, line in enumerate(unit.lines):
+            line_number = unit.start_line + offset
+            line_size = self.measure(line)
+
+            if line_size > self.budget:
+                if current:
+                    yield self._make_chunk(current, current_start)
+                    current, current_size = [], 0
+                for piece in self._split_line(line):
+                    yield self._make_chunk([piece], line_number)
+                continue
+
+            if current and current_size + line_size > self.budget:
+                yield self._make_chunk(current, current_start)
+                current, current_size = [], 0
+            if not current:
+                current_start = line_number
+            current.append(line)
+            current_size += line_size
+
+        if current:
+            yield self._make_chunk(current, current_start)
+
+    def _split_line(self, line: str) -> Iterator[str]:
+        """Split one over-long line into pieces that fit the budget, preferring sentence and word breaks."""
+        # Cut by characters first, using the line's own measure-to-length ratio
+        chars_per_unit = len(line) / max(1, self.measure(line))
+        max_chars = max(1, int(self.budget * chars_per_unit * 0.95))
+        start = 0
+        while start < len(line):
+            end = min(len(line), start + max_chars)
+            if end < len(line):
+                window = line[start:end]
+                # Prefer the end of a sentence, then whitespace, in the second half of the window,
+                # and keep the separator with the piece before the cut
+                cut = max(window.rfind('. ') + 2, window.rfind('; ') + 2, window.rfind('。') + 1)
+                if cut < max_chars // 2:
+                    cut = window.rfind(' ') + 1
+                if cut >= max_chars // 2:
+                    end = start + cut
+            yield line[start:end]
+            start = end
+
+    def _make_chunk(self, lines: List[str], start_line: int) -> TextChunk:
+        content = '\n'.join(lines)
+        return TextChunk(
+            content=content,
+            start_line=start_line,
+            end_line=start_line + len(lines) - 1,
+            char_count=sum(len(line) for line in lines),
+            token_count=self.count_tokens(content)
+        )
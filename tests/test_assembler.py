@@ -0,0 +1,71 @@
+import random
+
+from intelli_rewrite.assembler import OutputAssembler, SEPARATOR
+from intelli_rewrite.models import QAPair
+
+
+def qa(index: int, answer: str = None, error: str = None) -> QAPair:
+    return QAPair(answer=answer if answer is not None else f"Answer {index}", chunk_index=index, char_count=1, error=error)
+
+
+def read(path) -> str:
+    return path.read_text(encoding="utf-8")
+
+
+def expected(*answers: str) -> str:
+    return "".join(answer + SEPARATOR for answer in answers)
+
+
+def test_output_is_the_same_for_any_arrival_order(tmp_path):
+    outputs = set()
+    for seed in range(5):
+        order = list(range(10))
+        random.Random(seed).shuffle(order)
+        path = tmp_path / f"out{seed}.md"
+        assembler = OutputAssembler(str(path))
+        assembler.write()
+        for index in order:
+            assembler.add(qa(index))
+        outputs.add(read(path))
+
+    assert outputs == {expected(*(f"Answer {i}" for i in range(10)))}
+
+
+def test_only_the_contiguous_prefix_is_written_until_complete(tmp_path):
+    path = tmp_path / "out.md"
+    assembler = OutputAssembler(str(path))
+    assembler.write()
+
+    assembler.add(qa(1))
+    assembler.add(qa(3))
+    assert read(path) == ""
+
+    assembler.add(qa(0))
+    assert read(path) == expected("Answer 0", "Answer 1")
+    assert assembler.assembled == 2
+
+    assembler.write(complete=True)
+    assert read(path) == expected("Answer 0", "Answer 1", "Answer 3")
+
+
+def test_a_replaced_result_is_put_in_place(tmp_path):
+    path = tmp_path / "out.md"
+    assembler = OutputAssembler(str(path), [qa(0), qa(1, error="timeout"), qa(2)])
+    assembler.write()
+    assert "<!-- Chunk 2 failed: timeout -->" in read(path)
+
+    assembler.add(qa(1, "Repaired"))
+
+    assert read(path) == expected("Answer 0", "Repaired", "Answer 2")
+
+
+def test_write_repairs_a_torn_or_repeated_append(tmp_path):
+    path = tmp_path / "out.md"
+    results = [qa(0), qa(1)]
+    path.write_text(expected("Answer 0", "Answer 1", "Answer 1") + "Answ", encoding="utf-8")
+
+    assembler = OutputAssembler(str(path), results)
+    assembler.write()
+
+    assert read(path) == expected("Answer 0", "Answer 1")
+    assert 1 in assembler and 2 not in assembler
@@ -0,0 +1,110 @@
+import json
+import os
+
+from intelli_rewrite.blobs import BlobStore, decompress, file_digest
+from intelli_rewrite.file_manager import FileManager
+from intelli_rewrite.journal import TaskJournal
+from intelli_rewrite.models import QAPair
+from intelli_rewrite.text_processor import content_hash
+
+
+def write(path, text):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(text, encoding="utf-8")
+    return path
+
+
+def test_identical_files_share_one_blob(tmp_path):
+    store = BlobStore(tmp_path / "blobs", codec="gzip")
+    source = write(tmp_path / "input.md", "# Chapter\n")
+
+    (tmp_path / "a").mkdir()
+    (tmp_path / "b").mkdir()
+    first = store.store_file(str(source), str(tmp_path / "a" / "input.md"))
+    second = store.store_file(str(source), str(tmp_path / "b" / "input.md"))
+
+    assert first == second
+    assert os.stat(tmp_path / "a" / "input.md").st_ino == os.stat(tmp_path / "b" / "input.md").st_ino
+    # The blob and both task files
+    assert os.stat(tmp_path / "a" / "input.md").st_nlink == 3
+
+
+def test_storing_again_leaves_linked_files_untouched(tmp_path):
+    store = BlobStore(tmp_path / "blobs", codec="gzip")
+    source = write(tmp_path / "input.md", "# Chapter\n")
+    (tmp_path / "a").mkdir()
+    (tmp_path / "b").mkdir()
+    linked = tmp_path / "a" / "input.md"
+    store.store_file(str(source), str(linked))
+    os.utime(linked, (1_000_000, 1_000_000))
+
+    store.store_file(str(source), str(tmp_path / "b" / "input.md"))
+
+    assert linked.stat().st_mtime == 1_000_000
+
+
+def test_gc_removes_only_unused_blobs(tmp_path):
+    store = BlobStore(tmp_path / "blobs", codec="gzip")
+    (tmp_path / "kept").mkdir()
+    (tmp_path / "dropped").mkdir()
+    store.store_file(str(write(tmp_path / "kept.md", "kept")), str(tmp_path / "kept" / "input.md"))
+    store.store_file(str(write(tmp_path / "dropped.md", "dropped")), str(tmp_path / "dropped" / "input.md"))
+    (tmp_path / "dropped" / "input.md").unlink()
+    referenced = store.put(b"reasoning in use", compressed=True)
+    store.put(b"reasoning of a deleted task", compressed=True)
+    stale_tmp = write(tmp_path / "blobs" / "ab" / "abc.1234.tmp", "partial")
+
+    # Recent blobs are kept, they may be about to be linked
+    assert store.gc({referenced}, min_age=3600) == (0, 0)
+    assert store.gc({referenced}, min_age=0, dry_run=True)[0] == 3
+    assert stale_tmp.exists()
+
+    removed, _ = store.gc({referenced}, min_age=0)
+
+    assert removed == 3
+    assert not stale_tmp.exists()
+    assert (tmp_path / "kept" / "input.md").read_text() == "kept"
+    assert store.get_text(referenced) == "reasoning in use"
+    assert sorted(path.name for path in store.iter_blobs()) == sorted([file_digest(str(tmp_path / "kept.md")), referenced + ".gz"])
+
+
+def test_a_collected_blob_is_stored_again(tmp_path):
+    store = BlobStore(tmp_path / "blobs", codec="gzip")
+    source = write(tmp_path / "input.md", "text")
+    (tmp_path / "a").mkdir()
+    target = tmp_path / "a" / "input.md"
+    store.store_file(str(source), str(target))
+    target.unlink()
+    store.gc(set(), min_age=0)
+
+    store.store_file(str(source), str(target))
+
+    assert target.read_text() == "text"
+    assert target.stat().st_nlink == 2
+
+
+def test_journal_keeps_chunk_text_and_reasoning_out_of_the_pairs(tmp_path):
+    file_manager = FileManager(str(tmp_path / "output"))
+    task_dir = tmp_path / "output" / "task"
+    task_dir.mkdir()
+    chunks = [{"index": i, "content": f"Chunk {i} text", "char_count": 12, "hash": content_hash(f"Chunk {i} text")} for i in range(3)]
+    (task_dir / "chunks.json").write_text(json.dumps(chunks), encoding="utf-8")
+    journal = TaskJournal(file_manager, "task")
+
+    for chunk in chunks[:2]:
+        journal.append(QAPair(
+            question=chunk["content"], question_hash=chunk["hash"], answer=f"Answer {chunk['index']}",
+            reasoning_content="Long reasoning", chunk_index=chunk["index"], char_count=12
+        ), chunk["index"] + 1)
+    journal.compact(journal.load_qa_pairs())
+
+    path = journal.compacted_path
+    raw = decompress(path.read_bytes(), path.suffix)
+    assert b"Answer 0" in raw
+    assert b"Chunk 0 text" not in raw and b"Long reasoning" not in raw
+    qa_pairs = journal.load_qa_pairs()
+    assert [journal.load_question(qa) for qa in qa_pairs] == ["Chunk 0 text", "Chunk 1 text"]
+    assert journal.load_reasoning(qa_pairs[0].reasoning_blob) == "Long reasoning"
+    # A pair is found by its hash when its chunk moved
+    moved = qa_pairs[1].model_copy(update={"chunk_index": 2})
+    assert journal.load_question(moved, chunks[::-1]) == "Chunk 1 text"
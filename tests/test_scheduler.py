@@ -0,0 +1,131 @@
+import threading
+import time
+
+import pytest
+
+from intelli_rewrite.models import RewriteTask
+from intelli_rewrite.scheduler import ChunkScheduler, TaskRun
+
+
+class FatalError(Exception):
+    pass
+
+
+def make_run(chunk_count: int, task_id: str = "task") -> TaskRun:
+    task = RewriteTask(id=task_id, task_id=task_id, input_file="in.md", output_file="out.md", total_chunks=chunk_count)
+    chunks = [{"index": i, "content": f"chunk {i}", "char_count": 7} for i in range(chunk_count)]
+    # The scheduler never touches the journal or the output, commit does
+    return TaskRun(
+        task=task, chunks_data=chunks, pending_chunks=list(chunks),
+        journal=None, qa_json_path="", output_path="", assembler=None
+    )
+
+
+def make_scheduler(rewrite, commit, done=None, failed=None, **kwargs) -> ChunkScheduler:
+    return ChunkScheduler(
+        rewrite=rewrite,
+        commit=commit,
+        on_task_done=done or (lambda run: None),
+        on_task_failed=failed or (lambda run, e: None),
+        **kwargs
+    )
+
+
+def test_results_are_committed_in_chunk_order():
+    committed = []
+    done = []
+
+    def rewrite(task, chunk_data, memory_context, queue_wait):
+        # Later chunks finish first
+        time.sleep(0.01 * (8 - chunk_data["index"]))
+        return chunk_data["index"]
+
+    scheduler = make_scheduler(rewrite, lambda run, result: committed.append(result), done=done.append, concurrency=4)
+    unfinished = scheduler.run([make_run(8)])
+
+    assert committed == list(range(8))
+    assert len(done) == 1
+    assert unfinished == []
+
+
+def test_failed_commit_fails_only_its_task():
+    failed = []
+    done = []
+
+    def commit(run, result):
+        if run.task.id == "bad":
+            raise ValueError("disk full")
+
+    scheduler = make_scheduler(lambda *args: None, commit, done=done.append, failed=lambda run, e: failed.append((run.task.id, e)), concurrency=2)
+    scheduler.run([make_run(3, "bad"), make_run(3, "good")])
+
+    assert [task_id for task_id, _ in failed] == ["bad"]
+    assert [run.task.id for run in done] == ["good"]
+
+
+def run_until_stopped(commit, failed=None):
+    """Stop a run while chunk 0 hangs and chunks 1 and 2 have finished behind it."""
+    stop = threading.Event()
+    release = threading.Event()
+    finished = []
+
+    def rewrite(task, chunk_data, memory_context, queue_wait):
+        if chunk_data["index"] == 0:
+            release.wait(5)
+        else:
+            finished.append(chunk_data["index"])
+            if len(finished) == 2:
+                stop.set()
+        return chunk_data["index"]
+
+    scheduler = make_scheduler(rewrite, commit, failed=failed, concurrency=3)
+    run = make_run(3)
+    try:
+        unfinished = scheduler.run([run], stop=stop, drain_timeout=0.2)
+    finally:
+        release.set()
+    return scheduler, run, unfinished
+
+
+def test_stop_commits_results_finished_behind_a_hanging_chunk():
+    committed = []
+    scheduler, run, unfinished = run_until_stopped(lambda run, result: committed.append(result))
+
+    assert committed == [1, 2]
+    assert unfinished == [run]
+    assert scheduler.abandoned == 1
+
+
+def test_stop_fails_a_task_whose_drain_commit_raises():
+    failed = []
+
+    def commit(run, result):
+        raise ValueError("cancelled meanwhile")
+
+    scheduler, run, unfinished = run_until_stopped(commit, failed=lambda run, e: failed.append(e))
+
+    assert len(failed) == 1
+    assert run.failed
+    assert unfinished == []
+
+
+def test_stop_raises_abort_errors_from_drain_commits():
+    def commit(run, result):
+        raise FatalError("key revoked")
+
+    stop = threading.Event()
+    release = threading.Event()
+
+    def rewrite(task, chunk_data, memory_context, queue_wait):
+        if chunk_data["index"] == 0:
+            release.wait(5)
+        else:
+            stop.set()
+        return chunk_data["index"]
+
+    scheduler = make_scheduler(rewrite, commit, concurrency=2, abort_on=(FatalError,))
+    try:
+        with pytest.raises(FatalError):
+            scheduler.run([make_run(2)], stop=stop, drain_timeout=0.2)
+    finally:
+        release.set()
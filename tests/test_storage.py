@@ -0,0 +1,225 @@
+import json
+import multiprocessing
+import socket
+import sqlite3
+
+import pytest
+
+from intelli_rewrite.enums import TaskStatus
+from intelli_rewrite.models import RewriteTask
+from intelli_rewrite.queue_manager import QueueManager
+from intelli_rewrite.storage import JsonTaskStore, SqliteTaskStore, TaskStore, current_worker_id
+
+
+def make_task(task_id: str, **fields) -> RewriteTask:
+    return RewriteTask(id=task_id, task_id=task_id, input_file="in.md", output_file="out.md", **fields)
+
+
+def dead_worker_id() -> str:
+    process = multiprocessing.get_context("fork").Process(target=lambda: None)
+    process.start()
+    process.join()
+    return f"{socket.gethostname()}:{process.pid}"
+
+
+def claim_all(db_file, barrier, results):
+    store = SqliteTaskStore(db_file, legacy_json_file=None)
+    claimed = []
+    while True:
+        task = store.claim_task(current_worker_id())
+        if task is None:
+            break
+        claimed.append(task.id)
+    # Stay alive until every worker is done, the tasks of a finished worker may be claimed again
+    barrier.wait()
+    results.put(claimed)
+
+
+@pytest.fixture
+def db_file(tmp_path):
+    return str(tmp_path / "tasks.db")
+
+
+def test_a_backend_must_implement_the_whole_interface():
+    class Incomplete(TaskStore):
+        def list_tasks(self, statuses=None):
+            return []
+
+    with pytest.raises(TypeError, match="claim_task"):
+        Incomplete()
+
+
+def test_claim_task_hands_each_task_to_one_process(db_file):
+    store = SqliteTaskStore(db_file, legacy_json_file=None)
+    store.save_tasks([make_task(f"task-{i:03d}") for i in range(60)])
+
+    context = multiprocessing.get_context("fork")
+    barrier = context.Barrier(4)
+    results = context.Queue()
+    workers = [context.Process(target=claim_all, args=(db_file, barrier, results)) for _ in range(4)]
+    for worker in workers:
+        worker.start()
+    claimed = [task_id for _ in workers for task_id in results.get(timeout=30)]
+    for worker in workers:
+        worker.join()
+
+    assert sorted(claimed) == [f"task-{i:03d}" for i in range(60)]
+
+
+def test_claim_task_prefers_priority_and_takes_over_dead_workers(db_file):
+    store = SqliteTaskStore(db_file, legacy_json_file=None)
+    store.save_tasks([
+        make_task("low"),
+        make_task("high", priority=2),
+        make_task("orphan", status=TaskStatus.PROCESSING, worker_id=dead_worker_id(), priority=1)
+    ])
+
+    assert [store.claim_task("me").id for _ in range(3)] == ["high", "orphan", "low"]
+    assert store.claim_task("me") is None
+
+
+def test_claim_task_does_not_sort_the_queue(db_file):
+    store = SqliteTaskStore(db_file, legacy_json_file=None)
+    plan = store.conn.execute(
+        "EXPLAIN QUERY PLAN SELECT id, priority, created_at FROM tasks WHERE status = ? ORDER BY priority DESC, created_at LIMIT 1",
+        (TaskStatus.PENDING.value,)
+    ).fetchall()
+
+    assert [row["detail"] for row in plan] == ["SEARCH tasks USING INDEX idx_tasks_claim (status=?)"]
+
+
+def test_priority_column_is_added_to_older_databases(db_file):
+    conn = sqlite3.connect(db_file)
+    conn.execute(
+        "CREATE TABLE tasks (id TEXT PRIMARY KEY, status TEXT NOT NULL, created_at TEXT NOT NULL, "
+        "processed_chunks INTEGER NOT NULL DEFAULT 0, worker_id TEXT, data TEXT NOT NULL)"
+    )
+    for task in (make_task("old"), make_task("urgent", priority=3)):
+        conn.execute(
+            "INSERT INTO tasks VALUES (?, ?, ?, 0, NULL, ?)",
+            (task.id, task.status.value, task.created_at.isoformat(), json.dumps(task.model_dump(mode="json")))
+        )
+    conn.commit()
+    conn.close()
+
+    store = SqliteTaskStore(db_file, legacy_json_file=None)
+
+    assert {summary["id"]: summary["priority"] for summary in store.list_task_summaries()} == {"old": 0, "urgent": 3}
+    assert store.claim_task("me").id == "urgent"
+
+
+def test_claim_task_with_empty_selection(db_file):
+    store = SqliteTaskStore(db_file, legacy_json_file=None)
+    store.save_task(make_task("a"))
+
+    assert store.claim_task("me", task_ids=[]) is None
+    assert store.claim_task("me", task_ids=["a"]).id == "a"
+
+
+def test_claim_chunks_is_all_or_nothing_across_workers(db_file):
+    first = SqliteTaskStore(db_file, legacy_json_file=None)
+    second = SqliteTaskStore(db_file, legacy_json_file=None)
+    holder = current_worker_id()
+
+    assert first.claim_chunks("a", [0, 1], holder)
+    assert not second.claim_chunks("a", [1, 2], "other-host:1")
+    assert second.claim_chunks("a", [2, 3], "other-host:1")
+
+    # Claims of a worker that is gone can be taken over
+    dead = dead_worker_id()
+    assert first.claim_chunks("b", [0], dead)
+    assert second.claim_chunks("b", [0], "other-host:1")
+
+    second.release_chunks("a", "other-host:1")
+    assert second.claim_chunks("a", [2], "other-host:2")
+
+
+def test_save_tasks_writes_the_whole_batch_or_nothing(db_file):
+    store = SqliteTaskStore(db_file, legacy_json_file=None)
+
+    class Broken:
+        id = "broken"
+
+    with pytest.raises(AttributeError):
+        store.save_tasks([make_task("a"), Broken()])
+    assert store.list_tasks() == []
+
+    store.save_tasks([make_task("a"), make_task("b")])
+    assert [task.id for task in store.list_tasks()] == ["a", "b"]
+
+
+@pytest.fixture(params=["sqlite", "json"])
+def queue_manager(request, tmp_path, monkeypatch):
+    monkeypatch.setenv("OUTPUT_DIR", str(tmp_path / "output"))
+    return QueueManager(str(tmp_path / f"tasks.{request.param}"), backend=request.param)
+
+
+def test_worker_status_changes_leave_cancelled_tasks_cancelled(queue_manager):
+    queue_manager.save_task(make_task("a", status=TaskStatus.PROCESSING))
+    queue_manager.cancel_task("a")
+
+    queue_manager.update_task_status("a", TaskStatus.COMPLETED, failed_chunks=2)
+    queue_manager.update_task_status("a", TaskStatus.PENDING)
+
+    task = queue_manager.get_task("a")
+    assert task.status == TaskStatus.CANCELLED
+    assert task.failed_chunks == 0
+
+
+def test_cancel_leaves_completed_tasks_unchanged(queue_manager):
+    queue_manager.save_task(make_task("a"))
+    queue_manager.update_task_status("a", TaskStatus.COMPLETED, "1 chunk(s) failed", failed_chunks=1)
+
+    assert queue_manager.cancel_task("a").status == TaskStatus.COMPLETED
+    task = queue_manager.get_task("a")
+    assert (task.status, task.failed_chunks, task.error_message) == (TaskStatus.COMPLETED, 1, "1 chunk(s) failed")
+    assert queue_manager.cancel_task("missing") is None
+
+
+def test_status_changes_clear_the_error_of_an_earlier_failure(queue_manager):
+    queue_manager.save_task(make_task("a"))
+    queue_manager.update_task_status("a", TaskStatus.FAILED, "connection reset")
+    queue_manager.update_task_status("a", TaskStatus.PAUSED)
+    assert queue_manager.get_task("a").error_message == "connection reset"
+
+    queue_manager.update_task_status("a", TaskStatus.PROCESSING)
+    assert queue_manager.get_task("a").error_message is None
+
+    queue_manager.update_task_status("a", TaskStatus.FAILED, "connection reset")
+    queue_manager.update_task_status("a", TaskStatus.COMPLETED)
+    assert queue_manager.get_task("a").error_message is None
+
+
+def test_update_task_sees_changes_of_other_connections(db_file):
+    first = SqliteTaskStore(db_file, legacy_json_file=None)
+    second = SqliteTaskStore(db_file, legacy_json_file=None)
+    first.save_task(make_task("a", status=TaskStatus.PROCESSING))
+    stale = first.get_task("a")
+
+    def cancel(task):
+        task.status = TaskStatus.CANCELLED
+        return True
+
+    def complete(task):
+        if task.status == TaskStatus.CANCELLED:
+            return False
+        task.status = TaskStatus.COMPLETED
+        return True
+
+    second.update_task("a", cancel)
+    first.update_task("a", complete)
+
+    assert stale.status == TaskStatus.PROCESSING
+    assert first.get_task("a").status == TaskStatus.CANCELLED
+
+
+def test_legacy_import_keeps_journal_progress(tmp_path):
+    json_file = str(tmp_path / "tasks.json")
+    legacy = JsonTaskStore(json_file)
+    legacy.save_task(make_task("a", status=TaskStatus.PROCESSING, total_chunks=10, processed_chunks=2))
+    legacy.save_task(make_task("b", status=TaskStatus.COMPLETED, total_chunks=5, processed_chunks=5))
+
+    store = SqliteTaskStore(str(tmp_path / "tasks.db"), legacy_json_file=json_file, read_progress=lambda task: 7)
+
+    assert store.get_task("a").processed_chunks == 7
+    assert store.get_task("b").processed_chunks == 5
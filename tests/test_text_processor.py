@@ -0,0 +1,78 @@
+from intelli_rewrite.text_processor import StreamTokenCounter, TextProcessor, approximate_tokens
+
+
+def units(processor, lines):
+    return [unit.lines for unit in processor._iter_units(lines)]
+
+
+def test_small_blocks_stay_whole():
+    lines = ["Intro", "```python", "# not a heading", "x = 1", "```", "$$", "a^2 + b^2", "$$", "After"]
+
+    assert units(TextProcessor(chunk_size=200), lines) == [
+        ["Intro"],
+        ["```python", "# not a heading", "x = 1", "```"],
+        ["$$", "a^2 + b^2", "$$"],
+        ["After"]
+    ]
+
+
+def test_closer_of_an_oversize_block_does_not_open_another():
+    code = [f"value_{i} = {i}  # padding" for i in range(40)]
+    lines = ["```python"] + code + ["```", "Text after the block.", "# Heading", "```", "small", "```", "End"]
+
+    result = list(TextProcessor(chunk_size=200)._iter_units(lines))
+
+    # The block is given up on once it is over the budget, the rest up to its closer are plain lines
+    closer = next(unit for unit in result if unit.lines == ["```"])
+    assert closer.start_line == 41
+    tail = [unit.lines for unit in result if unit.start_line > 41]
+    assert tail == [["Text after the block."], ["# Heading"], ["```", "small", "```"], ["End"]]
+    assert [unit.is_heading for unit in result if unit.start_line > 41] == [False, True, False, False]
+    # Lines inside the block are never headings
+    assert not any(unit.is_heading for unit in result if unit.start_line <= 41)
+
+
+def test_oversize_math_block_is_measured_with_the_token_counter():
+    math = [r"x_{%d} = \frac{a_{%d}}{b_{%d}}" % (i, i, i) for i in range(15)]
+    lines = ["$$"] + math + ["$$", "Done"]
+
+    # Fits 200 tokens, though it is longer than 200 characters
+    by_tokens = units(TextProcessor(chunk_tokens=200), lines)
+    assert by_tokens[0] == ["$$"] + math + ["$$"]
+
+    by_chars = units(TextProcessor(chunk_size=200), lines)
+    assert len(by_chars[0]) < len(math)
+    assert by_chars[-2:] == [["$$"], ["Done"]]
+
+
+def test_chunks_never_split_a_block_that_fits():
+    block = ["```", "def f():", "    return 1", "```"]
+    text = "\n".join(["Paragraph one is here."] * 6 + block + ["Closing paragraph."] * 6)
+
+    chunks = TextProcessor(chunk_size=120).split_into_chunks(text)
+
+    assert any("\n".join(block) in chunk.content for chunk in chunks)
+    assert all(chunk.content.count("```") % 2 == 0 for chunk in chunks)
+
+
+def test_stream_token_counter_matches_the_whole_text_estimate():
+    text = "Streamed answer with some 中文 text. " * 50
+    counter = StreamTokenCounter()
+
+    counted = sum(counter.add(text[i:i + 3]) for i in range(0, len(text), 3))
+
+    assert abs(counted - approximate_tokens(text)) <= 1
+
+
+def test_fence_opener_is_measured_with_the_token_counter():
+    processor = TextProcessor(chunk_tokens=40)
+    opener = "```python  " + "#" * 60
+    fence = [opener] + ["x = 1"] * 6 + ["```"]
+    text = "\n".join(["para " * 6] + fence)
+    fence_tokens = sum(processor.measure(line) for line in fence)
+    assert fence_tokens <= 40 < fence_tokens + processor.measure("para " * 6)
+
+    chunks = processor.split_into_chunks(text)
+
+    # The fence does not fit after the paragraph, so it starts a chunk of its own
+    assert chunks[-1].content == "\n".join(fence)